@@ -38,6 +38,11 @@ Configuration:
 Finally the tests aren't 100% reliable as they rely on quite a bit of network
 traffic, it's possible that the tests fail due to network issues rather than
 logic errors.
+
+Alternatively, ``--github-emulator`` runs the tests against a local stand-in
+for github (see ``github_emulator.py``) which needs neither the ``pytest.ini``
+sections nor a tunnel, the roles are created in the emulator. The
+``benchmark`` tests only run in that mode.
 """
 import base64
 import collections
@@ -60,6 +65,12 @@ import psutil
 import pytest
 import requests
 
+from github_emulator import Emulator
+
+# updated when running against the emulator
+GITHUB_API = 'https://api.github.com'
+_emulator = None
+
 NGROK_CLI = [
     'ngrok', 'start', '--none', '--region', 'eu',
 ]
@@ -68,6 +79,14 @@ def pytest_addoption(parser):
     parser.addoption('--addons-path')
     parser.addoption("--no-delete", action="store_true", help="Don't delete repo after a failed run")
     parser.addoption('--log-github', action='store_true')
+    parser.addoption('--github-emulator', action='store_true',
+                     help="Run against a local github emulator instead of github")
+    parser.addoption('--bench-prs', type=int, default=10,
+                     help="Number of PRs to merge in the benchmarks")
+    parser.addoption('--bench-statuses', type=int, default=3,
+                     help="Number of statuses posted on each benchmark PR")
+    parser.addoption('--bench-failures', type=int, default=1,
+                     help="Number of stagings failed on purpose in the benchmarks")
 
     parser.addoption(
         '--tunnel', action="store", type="choice", choices=['ngrok', 'localtunnel'], default='ngrok',
@@ -86,12 +105,50 @@ def _set_socket_timeout():
     """
     socket.setdefaulttimeout(120.0)
 
+@pytest.fixture(scope='session')
+def github_emulator(pytestconfig, tmp_path_factory):
+    """ Local github emulator if ``--github-emulator`` was provided, with a
+    user per role, ``None`` otherwise
+    """
+    global GITHUB_API, _emulator
+    if not pytestconfig.getoption('--github-emulator'):
+        yield None
+        return
+
+    emulator = Emulator(str(tmp_path_factory.mktemp('github')))
+    for login, name in [
+            ('user', None),
+            ('reviewer', 'Dick Bong'),
+            ('self_reviewer', 'Fanny Chmelar'),
+            ('other', 'Harry Baals')]:
+        emulator.add_user(login, name=name)
+    emulator.start()
+    GITHUB_API, _emulator = emulator.url, emulator
+    try:
+        yield emulator
+    finally:
+        GITHUB_API, _emulator = 'https://api.github.com', None
+        emulator.stop()
+
+@pytest.fixture(scope='session')
+def github_api(github_emulator):
+    """ Base url of the github API the tests run against """
+    return GITHUB_API
+
 @pytest.fixture(scope="session")
-def config(pytestconfig):
+def config(pytestconfig, github_emulator):
     """ Flat version of the pytest config file (pytest.ini), parses to a
     simple dict of {section: {key: value}}
 
     """
+    if github_emulator:
+        user = github_emulator.users['user']
+        cnf = {'github': {'owner': user.login, 'token': user.token}}
+        for role in ['user', 'reviewer', 'self_reviewer', 'other']:
+            u = github_emulator.users[role]
+            cnf['role_' + role] = {'name': u.name, 'token': u.token}
+        return cnf
+
     conf = configparser.ConfigParser(interpolation=None)
     conf.read([pytestconfig.inifile])
     cnf = {
@@ -116,7 +173,7 @@ def rolemap(config):
         else:
             continue
 
-        r = requests.get('https://api.github.com/user', headers={'Authorization': 'token %s' % data['token']})
+        r = requests.get(GITHUB_API + '/user', headers={'Authorization': 'token %s' % data['token']})
         r.raise_for_status()
 
         rolemap[role] = data['user'] = r.json()['login']
@@ -157,10 +214,14 @@ def users(partners, rolemap):
     return rolemap
 
 @pytest.fixture(scope='session')
-def tunnel(pytestconfig, port):
+def tunnel(pytestconfig, port, github_emulator):
     """ Creates a tunnel to localhost:<port> using ngrok or localtunnel, should yield the
     publicly routable address & terminate the process at the end of the session
     """
+    if github_emulator:
+        # the emulator delivers the hooks locally
+        yield 'http://localhost:%d' % port
+        return
 
     tunnel = pytestconfig.getoption('--tunnel')
     if tunnel == 'ngrok':
@@ -273,6 +334,10 @@ def db(request, module, dbcache):
         subprocess.run(['dropdb', rundb], check=True)
 
 def wait_for_hook(n=1):
+    if _emulator is not None:
+        # the emulator knows when the hooks have been handled
+        _emulator.wait_for_deliveries()
+        return
     time.sleep(10 * n)
 
 def wait_for_server(db, port, proc, mod, timeout=120):
@@ -309,17 +374,21 @@ def port():
         return s.getsockname()[1]
 
 @pytest.fixture
-def server(request, db, port, module):
+def server(request, db, port, module, github_emulator):
     opts = ['--log-handler', 'github_requests:WARNING']
     if request.config.getoption('--log-github'):
         opts = []
 
+    env = None
+    if github_emulator:
+        env = dict(os.environ, GITHUB_API_URL=github_emulator.url, GITHUB_URL=github_emulator.url)
+
     p = subprocess.Popen([
         'odoo', '--http-port', str(port),
         '--addons-path', request.config.getoption('--addons-path'),
         '-d', db, *opts,
         '--max-cron-threads', '0', # disable cron threads (we're running crons by hand)
-    ])
+    ], env=env)
 
     try:
         wait_for_server(db, port, p, module)
@@ -343,13 +412,13 @@ def make_repo(request, config, tunnel, users):
 
     # check whether "owner" is a user or an org, as repo-creation endpoint is
     # different
-    q = github.get('https://api.github.com/users/{}'.format(owner))
+    q = github.get(GITHUB_API + '/users/{}'.format(owner))
     q.raise_for_status()
     if q.json().get('type') == 'Organization':
-        endpoint = 'https://api.github.com/orgs/{}/repos'.format(owner)
+        endpoint = GITHUB_API + '/orgs/{}/repos'.format(owner)
     else:
-        endpoint = 'https://api.github.com/user/repos'
-        r = github.get('https://api.github.com/user')
+        endpoint = GITHUB_API + '/user/repos'
+        r = github.get(GITHUB_API + '/user')
         r.raise_for_status()
         assert r.json()['login'] == owner
 
@@ -357,7 +426,7 @@ def make_repo(request, config, tunnel, users):
     def repomaker(name):
         name = 'ignore_%s_%s' % (name, base64.b64encode(os.urandom(6), b'-_').decode())
         fullname = '{}/{}'.format(owner, name)
-        repo_url = 'https://api.github.com/repos/{}'.format(fullname)
+        repo_url = GITHUB_API + '/repos/{}'.format(fullname)
 
         # create repo
         r = github.post(endpoint, json={
@@ -416,22 +485,22 @@ class Repo:
         return self.name.split('/')[0]
 
     def unsubscribe(self, token=None):
-        self._get_session(token).put('https://api.github.com/repos/{}/subscription'.format(self.name), json={
+        self._get_session(token).put(GITHUB_API + '/repos/{}/subscription'.format(self.name), json={
             'subscribed': False,
             'ignored': True,
         })
 
     def add_collaborator(self, login, token):
         # send invitation to user
-        r = self._session.put('https://api.github.com/repos/{}/collaborators/{}'.format(self.name, login))
+        r = self._session.put(GITHUB_API + '/repos/{}/collaborators/{}'.format(self.name, login))
         assert r.ok, r.json()
         # accept invitation on behalf of user
-        r = requests.patch('https://api.github.com/user/repository_invitations/{}'.format(r.json()['id']), headers={
+        r = requests.patch(GITHUB_API + '/user/repository_invitations/{}'.format(r.json()['id']), headers={
             'Authorization': 'token ' + token
         })
         assert r.ok, r.json()
         # sanity check that user is part of collaborators
-        r = self._session.get('https://api.github.com/repos/{}/collaborators'.format(self.name))
+        r = self._session.get(GITHUB_API + '/repos/{}/collaborators'.format(self.name))
         assert r.ok, r.json()
         assert any(login == c['login'] for c in r.json())
 
@@ -443,19 +512,19 @@ class Repo:
         return s
 
     def delete(self):
-        r = self._session.delete('https://api.github.com/repos/{}'.format(self.name))
+        r = self._session.delete(GITHUB_API + '/repos/{}'.format(self.name))
         if r.status_code != 204:
             logging.getLogger(__name__).warning("Unable to delete repository %s", self.name)
 
     def set_secret(self, secret):
         assert self.hook
         r = self._session.get(
-            'https://api.github.com/repos/{}/hooks'.format(self.name))
+            GITHUB_API + '/repos/{}/hooks'.format(self.name))
         response = r.json()
         assert 200 <= r.status_code < 300, response
         [hook] = response
 
-        r = self._session.patch('https://api.github.com/repos/{}/hooks/{}'.format(self.name, hook['id']), json={
+        r = self._session.patch(GITHUB_API + '/repos/{}/hooks/{}'.format(self.name, hook['id']), json={
             'config': {**hook['config'], 'secret': secret},
         })
         assert 200 <= r.status_code < 300, r.json()
@@ -468,7 +537,7 @@ class Repo:
         # FIXME: avoid calling get_ref on a hash & remove this code
         if re.match(r'[0-9a-f]{40}', ref):
             # just check that the commit exists
-            r = self._session.get('https://api.github.com/repos/{}/git/commits/{}'.format(self.name, ref))
+            r = self._session.get(GITHUB_API + '/repos/{}/git/commits/{}'.format(self.name, ref))
             assert 200 <= r.status_code < 300, r.reason
             return r.json()['sha']
 
@@ -477,7 +546,7 @@ class Repo:
         if not ref.startswith('heads'):
             ref = 'heads/' + ref
 
-        r = self._session.get('https://api.github.com/repos/{}/git/ref/{}'.format(self.name, ref))
+        r = self._session.get(GITHUB_API + '/repos/{}/git/ref/{}'.format(self.name, ref))
         assert 200 <= r.status_code < 300, r.reason
         res = r.json()
         assert res['object']['type'] == 'commit'
@@ -493,7 +562,7 @@ class Repo:
         if ref.startswith('heads/'):
             ref = 'refs/' + ref
 
-        r = self._session.get('https://api.github.com/repos/{}/commits/{}'.format(self.name, ref))
+        r = self._session.get(GITHUB_API + '/repos/{}/commits/{}'.format(self.name, ref))
         response = r.json()
         assert 200 <= r.status_code < 300, response
 
@@ -513,7 +582,7 @@ class Repo:
     def log(self, ref_or_sha):
         for page in itertools.count(1):
             r = self._session.get(
-                'https://api.github.com/repos/{}/commits'.format(self.name),
+                GITHUB_API + '/repos/{}/commits'.format(self.name),
                 params={'sha': ref_or_sha, 'page': page}
             )
             assert 200 <= r.status_code < 300, r.json()
@@ -527,14 +596,14 @@ class Repo:
         :param Commit commit:
         :rtype: Dict[str, str]
         """
-        r = self._session.get('https://api.github.com/repos/{}/git/trees/{}'.format(self.name, commit.tree))
+        r = self._session.get(GITHUB_API + '/repos/{}/git/trees/{}'.format(self.name, commit.tree))
         assert 200 <= r.status_code < 300, r.json()
 
         # read tree's blobs
         tree = {}
         for t in r.json()['tree']:
             assert t['type'] == 'blob', "we're *not* doing recursive trees in test cases"
-            r = self._session.get('https://api.github.com/repos/{}/git/blobs/{}'.format(self.name, t['sha']))
+            r = self._session.get(GITHUB_API + '/repos/{}/git/blobs/{}'.format(self.name, t['sha']))
             assert 200 <= r.status_code < 300, r.json()
             tree[t['path']] = base64.b64decode(r.json()['content']).decode()
 
@@ -543,7 +612,7 @@ class Repo:
     def make_ref(self, name, commit, force=False):
         assert self.hook
         assert name.startswith('heads/')
-        r = self._session.post('https://api.github.com/repos/{}/git/refs'.format(self.name), json={
+        r = self._session.post(GITHUB_API + '/repos/{}/git/refs'.format(self.name), json={
             'ref': 'refs/' + name,
             'sha': commit,
         })
@@ -554,12 +623,12 @@ class Repo:
 
     def update_ref(self, name, commit, force=False):
         assert self.hook
-        r = self._session.patch('https://api.github.com/repos/{}/git/refs/{}'.format(self.name, name), json={'sha': commit, 'force': force})
+        r = self._session.patch(GITHUB_API + '/repos/{}/git/refs/{}'.format(self.name, name), json={'sha': commit, 'force': force})
         assert 200 <= r.status_code < 300, r.json()
 
     def protect(self, branch):
         assert self.hook
-        r = self._session.put('https://api.github.com/repos/{}/branches/{}/protection'.format(self.name, branch), json={
+        r = self._session.put(GITHUB_API + '/repos/{}/branches/{}/protection'.format(self.name, branch), json={
             'required_status_checks': None,
             'enforce_admins': True,
             'required_pull_request_reviews': None,
@@ -604,7 +673,7 @@ class Repo:
         for commit in commits:
             if commit.reset:
                 tree = None
-            r = self._session.post('https://api.github.com/repos/{}/git/trees'.format(self.name), json={
+            r = self._session.post(GITHUB_API + '/repos/{}/git/trees'.format(self.name), json={
                 'tree': [
                     {'path': k, 'mode': '100644', 'type': 'blob', 'content': v}
                     for k, v in commit.tree.items()
@@ -624,7 +693,7 @@ class Repo:
             if commit.committer:
                 data['committer'] = commit.committer
 
-            r = self._session.post('https://api.github.com/repos/{}/git/commits'.format(self.name), json=data)
+            r = self._session.post(GITHUB_API + '/repos/{}/git/commits'.format(self.name), json=data)
             assert 200 <= r.status_code < 300, r.json()
 
             hashes.append(r.json()['sha'])
@@ -639,11 +708,11 @@ class Repo:
     def fork(self, *, token=None):
         s = self._get_session(token)
 
-        r = s.post('https://api.github.com/repos/{}/forks'.format(self.name))
+        r = s.post(GITHUB_API + '/repos/{}/forks'.format(self.name))
         assert 200 <= r.status_code < 300, r.json()
 
         repo_name = r.json()['full_name']
-        repo_url = 'https://api.github.com/repos/' + repo_name
+        repo_url = GITHUB_API + '/repos/' + repo_name
         # poll for end of fork
         limit = time.time() + 60
         while s.head(repo_url, timeout=5).status_code != 200:
@@ -655,7 +724,7 @@ class Repo:
 
     def get_pr(self, number):
         # ensure PR exists before returning it
-        self._session.head('https://api.github.com/repos/{}/pulls/{}'.format(
+        self._session.head(GITHUB_API + '/repos/{}/pulls/{}'.format(
             self.name,
             number,
         )).raise_for_status()
@@ -684,7 +753,7 @@ class Repo:
             head = ref
 
         r = self._session.post(
-            'https://api.github.com/repos/{}/pulls'.format(self.name),
+            GITHUB_API + '/repos/{}/pulls'.format(self.name),
             json={
                 'title': title,
                 'body': body,
@@ -701,7 +770,7 @@ class Repo:
     def post_status(self, ref, status, context='default', **kw):
         assert self.hook
         assert status in ('error', 'failure', 'pending', 'success')
-        r = self._session.post('https://api.github.com/repos/{}/statuses/{}'.format(self.name, self.commit(ref).id), json={
+        r = self._session.post(GITHUB_API + '/repos/{}/statuses/{}'.format(self.name, self.commit(ref).id), json={
             'state': status,
             'context': context,
             **kw
@@ -714,7 +783,7 @@ class Repo:
         :param Commit commit:
         :rtype: Dict[str, str]
         """
-        r = self._session.get('https://api.github.com/repos/{}/git/trees/{}'.format(self.name, commit.tree))
+        r = self._session.get(GITHUB_API + '/repos/{}/git/trees/{}'.format(self.name, commit.tree))
         assert 200 <= r.status_code < 300, r.json()
 
         # read tree's blobs
@@ -734,7 +803,7 @@ class Repo:
     def log(self, ref_or_sha):
         for page in itertools.count(1):
             r = self._session.get(
-                'https://api.github.com/repos/{}/commits'.format(self.name),
+                GITHUB_API + '/repos/{}/commits'.format(self.name),
                 params={'sha': ref_or_sha, 'page': page}
             )
             assert 200 <= r.status_code < 300, r.json()
@@ -766,7 +835,7 @@ class PR:
 
     @property
     def _pr(self):
-        r = self.repo._session.get('https://api.github.com/repos/{}/pulls/{}'.format(self.repo.name, self.number))
+        r = self.repo._session.get(GITHUB_API + '/repos/{}/pulls/{}'.format(self.repo.name, self.number))
         assert 200 <= r.status_code < 300, r.json()
         return r.json()
 
@@ -794,7 +863,7 @@ class PR:
 
     @property
     def comments(self):
-        r = self.repo._session.get('https://api.github.com/repos/{}/issues/{}/comments'.format(self.repo.name, self.number))
+        r = self.repo._session.get(GITHUB_API + '/repos/{}/issues/{}/comments'.format(self.repo.name, self.number))
         assert 200 <= r.status_code < 300, r.json()
         return [
             (c['user']['login'], c['body'])
@@ -811,7 +880,7 @@ class PR:
         if token:
             headers['Authorization'] = 'token %s' % token
         r = self.repo._session.post(
-            'https://api.github.com/repos/{}/issues/{}/comments'.format(self.repo.name, self.number),
+            GITHUB_API + '/repos/{}/issues/{}/comments'.format(self.repo.name, self.number),
             json={'body': body},
             headers=headers,
         )
@@ -824,7 +893,7 @@ class PR:
         if token:
             headers['Authorization'] = 'token %s' % token
         r = self.repo._session.patch(
-            'https://api.github.com/repos/{}/issues/comments/{}'.format(self.repo.name, cid),
+            GITHUB_API + '/repos/{}/issues/comments/{}'.format(self.repo.name, cid),
             json={'body': body},
             headers=headers
         )
@@ -837,7 +906,7 @@ class PR:
         if token:
             headers['Authorization'] = 'token %s' % token
         r = self.repo._session.delete(
-            'https://api.github.com/repos/{}/issues/comments/{}'.format(self.repo.name, cid),
+            GITHUB_API + '/repos/{}/issues/comments/{}'.format(self.repo.name, cid),
             headers=headers
         )
         assert r.status_code == 204, r.json()
@@ -847,7 +916,7 @@ class PR:
         headers = {}
         if token:
             headers['Authorization'] = 'token ' + token
-        r = self.repo._session.patch('https://api.github.com/repos/{}/pulls/{}'.format(self.repo.name, self.number), json={
+        r = self.repo._session.patch(GITHUB_API + '/repos/{}/pulls/{}'.format(self.repo.name, self.number), json={
             prop: value
         }, headers=headers)
         assert 200 <= r.status_code < 300, r.json()
@@ -860,7 +929,7 @@ class PR:
 
     @property
     def branch(self):
-        r = self.repo._session.get('https://api.github.com/repos/{}/pulls/{}'.format(
+        r = self.repo._session.get(GITHUB_API + '/repos/{}/pulls/{}'.format(
             self.repo.name,
             self.number,
         ))
@@ -881,7 +950,7 @@ class PR:
         if token:
             headers['Authorization'] = 'token %s' % token
         r = self.repo._session.post(
-            'https://api.github.com/repos/{}/pulls/{}/reviews'.format(self.repo.name, self.number),
+            GITHUB_API + '/repos/{}/pulls/{}/reviews'.format(self.repo.name, self.number),
             json={'body': body, 'event': state,},
             headers=headers
         )
@@ -895,7 +964,7 @@ class LabelsProxy(collections.abc.MutableSet):
     @property
     def _labels(self):
         pr = self._pr
-        r = pr.repo._session.get('https://api.github.com/repos/{}/issues/{}/labels'.format(pr.repo.name, pr.number))
+        r = pr.repo._session.get(GITHUB_API + '/repos/{}/issues/{}/labels'.format(pr.repo.name, pr.number))
         assert r.ok, r.json()
         return {label['name'] for label in r.json()}
 
@@ -919,7 +988,7 @@ class LabelsProxy(collections.abc.MutableSet):
     def add(self, label):
         pr = self._pr
         assert pr.repo.hook
-        r = pr.repo._session.post('https://api.github.com/repos/{}/issues/{}/labels'.format(pr.repo.name, pr.number), json={
+        r = pr.repo._session.post(GITHUB_API + '/repos/{}/issues/{}/labels'.format(pr.repo.name, pr.number), json={
             'labels': [label]
         })
         assert r.ok, r.json()
@@ -927,7 +996,7 @@ class LabelsProxy(collections.abc.MutableSet):
     def discard(self, label):
         pr = self._pr
         assert pr.repo.hook
-        r = pr.repo._session.delete('https://api.github.com/repos/{}/issues/{}/labels/{}'.format(pr.repo.name, pr.number, label))
+        r = pr.repo._session.delete(GITHUB_API + '/repos/{}/issues/{}/labels/{}'.format(pr.repo.name, pr.number, label))
         # discard should do nothing if the item didn't exist in the set
         assert r.ok or r.status_code == 404, r.json()
 
@@ -935,7 +1004,7 @@ class LabelsProxy(collections.abc.MutableSet):
         pr = self._pr
         assert pr.repo.hook
         # because of course that one is not provided by MutableMapping...
-        r = pr.repo._session.post('https://api.github.com/repos/{}/issues/{}/labels'.format(pr.repo.name, pr.number), json={
+        r = pr.repo._session.post(GITHUB_API + '/repos/{}/issues/{}/labels'.format(pr.repo.name, pr.number), json={
             'labels': list(set(itertools.chain.from_iterable(others)))
         })
         assert r.ok, r.json()
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 import logging
+import threading
+import time
 from contextlib import ExitStack
 from datetime import datetime
 
 from dateutil import relativedelta
 
-from odoo import fields, models
+import odoo
+from odoo import api, fields, models
 from odoo.addons.runbot_merge.github import GH
 
 # how long a merged PR survives
@@ -15,12 +18,21 @@ _logger = logging.getLogger(__name__)
 
 class Queue:
     limit = 100
+    # column of the items which must be processed in order, in concurrent mode
+    # items sharing a value are processed one after the other (oldest first)
+    _ordering_key = 'id'
 
     def _process_item(self):
         raise NotImplementedError
 
     def _process(self):
+        workers = int(self.env['ir.config_parameter'].sudo().get_param('forwardport.queue_workers', 1))
+        if workers > 1:
+            return self._process_concurrently(workers)
+
         for b in self.search(self._search_domain(), order='create_date, id', limit=self.limit):
+            start = time.time()
+            wait = (fields.Datetime.now() - b.create_date).total_seconds()
             try:
                 b._process_item()
                 b.unlink()
@@ -28,8 +40,113 @@ class Queue:
             except Exception:
                 _logger.exception("Error while processing %s, skipping", b)
                 self.env.cr.rollback()
+            self._log_item(b, wait, time.time() - start)
             self.clear_caches()
 
+    def _process_concurrently(self, workers):
+        """ Processes the queue with ``workers`` threads, each with its own
+        cursor. Items are claimed one at a time with FOR UPDATE SKIP LOCKED,
+        and only the oldest item of each ``_ordering_key`` can be claimed so
+        items of a same key are still processed in order.
+        """
+        state = {
+            'budget': self.limit,
+            'failed': [0], # ANY(%s) does not like empty arrays
+            'lock': threading.Lock(),
+        }
+        threads = [
+            threading.Thread(
+                target=self._worker,
+                args=(self.env.cr.dbname, self.env.uid, self.env.context, state),
+                name='%s.worker.%d' % (self._name, i),
+            )
+            for i in range(workers)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def _worker(self, dbname, uid, context, state):
+        threading.current_thread().dbname = dbname
+        with api.Environment.manage(), odoo.registry(dbname).cursor() as cr:
+            env = api.Environment(cr, uid, context)
+            Queue = env[self._name]
+            while True:
+                with state['lock']:
+                    if state['budget'] <= 0:
+                        return
+                    state['budget'] -= 1
+                    failed = list(state['failed'])
+                b = Queue._claim(failed)
+                if not b:
+                    cr.rollback()
+                    return
+
+                start = time.time()
+                wait = (fields.Datetime.now() - b.create_date).total_seconds()
+                try:
+                    b._process_item()
+                    b.unlink()
+                    cr.commit()
+                except Exception:
+                    _logger.exception("Error while processing %s, skipping", b)
+                    cr.rollback()
+                    with state['lock']:
+                        state['failed'].append(b.id)
+                Queue._log_item(b, wait, time.time() - start)
+                Queue.clear_caches()
+
+    def _claim(self, excluded_ids):
+        """ Locks and returns the oldest item which is not already being
+        processed and has no older item with the same ordering key
+        """
+        query = self._where_calc(self._search_domain())
+        from_clause, where_clause, params = query.get_sql()
+        self.env.cr.execute("""
+        SELECT "{table}".id FROM {from_clause}
+        WHERE {where_clause}
+          AND NOT ("{table}".id = ANY(%s))
+          AND NOT EXISTS (
+            SELECT FROM "{table}" previous
+            WHERE previous.{key} = "{table}".{key}
+              AND (previous.create_date, previous.id) < ("{table}".create_date, "{table}".id)
+          )
+        ORDER BY "{table}".create_date, "{table}".id
+        LIMIT 1
+        FOR UPDATE OF "{table}" SKIP LOCKED
+        """.format(
+            table=self._table,
+            key=self._ordering_key,
+            from_clause=from_clause,
+            where_clause=where_clause or 'TRUE',
+        ), params + [excluded_ids])
+        return self.browse(id_ for [id_] in self.env.cr.fetchall())
+
+    def _log_item(self, item, wait, duration):
+        _logger.info(
+            "%s: processed %s in %.2fs after waiting %.0fs (%d items left)",
+            self._name, item, duration, wait, self._queue_stats()['depth']
+        )
+
+    def _queue_stats(self):
+        """ Returns the number of items due and the wait time (in seconds)
+        of the oldest one
+        """
+        query = self._where_calc(self._search_domain())
+        from_clause, where_clause, params = query.get_sql()
+        self.env.cr.execute("""
+        SELECT count(*), extract(epoch FROM (now() at time zone 'UTC') - min("{table}".create_date))
+        FROM {from_clause}
+        WHERE {where_clause}
+        """.format(
+            table=self._table,
+            from_clause=from_clause,
+            where_clause=where_clause or 'TRUE',
+        ), params)
+        depth, oldest = self.env.cr.fetchone()
+        return {'depth': depth, 'oldest_wait': oldest or 0}
+
     def _search_domain(self):
         return []
 
@@ -38,6 +155,7 @@ class BatchQueue(models.Model, Queue):
     _description = 'batches which got merged and are candidates for forward-porting'
 
     limit = 10
+    _ordering_key = 'source_pr'
 
     batch_id = fields.Many2one('runbot_merge.batch', required=True)
     source = fields.Selection([
@@ -45,6 +163,17 @@ class BatchQueue(models.Model, Queue):
         ('fp', 'Forward Port Followup'),
         ('insert', 'New branch port')
     ], required=True)
+    source_pr = fields.Many2one(
+        'runbot_merge.pull_requests', compute='_compute_source_pr', store=True,
+        help="source of the forward-port sequence of the batch, its ports "
+             "have to be processed in order"
+    )
+
+    @api.depends('batch_id')
+    def _compute_source_pr(self):
+        for b in self:
+            pr = b.batch_id.prs[:1]
+            b.source_pr = pr.source_id or pr
 
     def _process_item(self):
         batch = self.batch_id
@@ -83,6 +212,7 @@ class UpdateQueue(models.Model, Queue):
     _description = 'if a forward-port PR gets updated & has followups (cherrypick succeeded) the followups need to be updated as well'
 
     limit = 10
+    _ordering_key = 'original_root'
 
     original_root = fields.Many2one('runbot_merge.pull_requests')
     new_root = fields.Many2one('runbot_merge.pull_requests')
@@ -136,6 +266,8 @@ class DeleteBranches(models.Model, Queue):
     _name = 'forwardport.branch_remover'
     _description = "Removes branches of merged PRs"
 
+    _ordering_key = 'pr_id'
+
     pr_id = fields.Many2one('runbot_merge.pull_requests')
 
     def _search_domain(self):
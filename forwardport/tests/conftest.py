@@ -32,13 +32,13 @@ TOKEN_SCOPES = {
     'role_other': {'public_repo'},# 'delete_repo'},
 }
 @pytest.fixture(autouse=True, scope='session')
-def _check_scopes(config):
+def _check_scopes(config, github_api):
     for section, vals in config.items():
         required_scopes = TOKEN_SCOPES.get(section)
         if required_scopes is None:
             continue
 
-        response = requests.get('https://api.github.com/rate_limit', headers={
+        response = requests.get(github_api + '/rate_limit', headers={
             'Authorization': 'token %s' % vals['token']
         })
         assert response.status_code == 200
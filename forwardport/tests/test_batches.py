@@ -86,4 +86,42 @@ def test_single_updated(env, config, make_repo):
     assert pr12_id.parent_id == pr11_id
 
     assert pr22_id.source_id == pr2_id
-    assert pr22_id.parent_id == pr21_id
\ No newline at end of file
+    assert pr22_id.parent_id == pr21_id
+
+
+def test_concurrent_workers(env, config, make_repo):
+    """ Independent batches get forward-ported when the queue is processed by
+    several workers
+    """
+    env['ir.config_parameter'].set_param('forwardport.queue_workers', '2')
+    r1, _ = make_basic(env, config, make_repo, reponame='repo-1')
+    r2, _ = make_basic(env, config, make_repo, reponame='repo-2')
+
+    with r1:
+        r1.make_commits('a', Commit('1', tree={'1': '0'}), ref='heads/aref')
+        pr1 = r1.make_pr(target='a', head='aref')
+        r1.post_status('aref', 'success', 'legal/cla')
+        r1.post_status('aref', 'success', 'ci/runbot')
+        pr1.post_comment('hansen r+', config['role_reviewer']['token'])
+    with r2:
+        r2.make_commits('a', Commit('2', tree={'2': '0'}), ref='heads/bref')
+        pr2 = r2.make_pr(target='a', head='bref')
+        r2.post_status('bref', 'success', 'legal/cla')
+        r2.post_status('bref', 'success', 'ci/runbot')
+        pr2.post_comment('hansen r+', config['role_reviewer']['token'])
+    env.run_crons()
+
+    with r1, r2:
+        r1.post_status('staging.a', 'success', 'legal/cla')
+        r1.post_status('staging.a', 'success', 'ci/runbot')
+        r2.post_status('staging.a', 'success', 'legal/cla')
+        r2.post_status('staging.a', 'success', 'ci/runbot')
+    env.run_crons()
+
+    assert not env['forwardport.batches'].search([])
+    pr1_id, pr11_id, pr2_id, pr21_id = env['runbot_merge.pull_requests'].search([]).sorted('display_name')
+    assert pr1_id.number == pr1.number
+    assert pr2_id.number == pr2.number
+    assert pr11_id.parent_id == pr1_id
+    assert pr21_id.parent_id == pr2_id
+    assert pr11_id.target.name == pr21_id.target.name == 'b'
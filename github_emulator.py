@@ -0,0 +1,1302 @@
+# -*- coding: utf-8 -*-
+"""Offline stand-in for github
+
+Serves the parts of the github REST API used by the merge bot, the
+forward-port bot and the ``Repo`` / ``PR`` helpers of the test suite, on top
+of local bare repositories which are also served to git clients through
+``git http-backend``. Changes made through the API or by pushing emit
+webhooks (signed if the hook has a secret), delivered in order by a
+background thread.
+
+Only tokens are checked (any known token can do anything), and responses
+only contain what the callers actually look at.
+
+Running the test suite against it rather than github (no ``pytest.ini``
+sections or tunnel necessary)::
+
+    pytest --github-emulator --addons-path=... runbot_merge
+
+It can also be started standalone, e.g. to point a development instance at
+it using the ``GITHUB_API_URL`` and ``GITHUB_URL`` environment variables::
+
+    python3 github_emulator.py --port 8999 --user owner:sometoken
+"""
+import argparse
+import base64
+import collections
+import datetime
+import hashlib
+import hmac
+import http.server
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+_logger = logging.getLogger(__name__)
+
+SCOPES = 'admin:repo_hook, delete_repo, public_repo, repo, user:email'
+RATE_LIMIT = 5000
+PER_PAGE = 30
+GIT_PATH = re.compile(r'^/(?P<repo>[^/]+/[^/]+?)(?:\.git)?/(?P<rest>info/refs|git-upload-pack|git-receive-pack)$')
+IDENTITY = re.compile(r'^(?P<name>.*) <(?P<email>.*)> (?P<ts>\d+) (?P<tz>[+-]\d{4})$')
+
+_routes = []
+def route(method, pattern):
+    """ Registers the decorated Emulator method as the handler of ``method``
+    on paths matching ``pattern``, the named groups are passed as keyword
+    arguments
+    """
+    def decorator(fn):
+        _routes.append((method, re.compile('^%s$' % pattern), pattern, fn))
+        return fn
+    return decorator
+
+R = r'/repos/(?P<repo>[^/]+/[^/]+)'
+
+class ApiError(Exception):
+    def __init__(self, status, message, errors=None):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
+        self.errors = errors
+
+def not_found():
+    return ApiError(404, 'Not Found')
+
+def now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+Request = collections.namedtuple('Request', 'method path params json user')
+
+class User:
+    def __init__(self, login, name, email, token, type='User'):
+        self.id = int(hashlib.md5(login.encode()).hexdigest()[:7], 16)
+        self.login = login
+        self.name = name
+        self.email = email
+        self.token = token
+        self.type = type
+
+    def json(self):
+        return {'login': self.login, 'id': self.id, 'type': self.type}
+
+class Issue:
+    def __init__(self, repo, number, user, title, body):
+        self.repo = repo
+        self.number = number
+        self.user = user
+        self.title = title
+        self.body = body
+        self.state = 'open'
+        self.labels = set()
+        self.comments = []
+        self.created_at = now()
+        # pull requests
+        self.is_pull = False
+        self.head_repo = None
+        self.head_ref = None
+        self.head = None
+        self.base = None
+        # commits of the pull request are the ones of head since merge_base,
+        # kept once the head is merged into the base like github does
+        self.merge_base = None
+        self.merged = False
+        self.reviews = []
+
+class Repository:
+    def __init__(self, emulator, owner, name, parent=None):
+        self.emulator = emulator
+        self.id = next(emulator._ids)
+        self.owner = owner
+        self.name = name
+        self.full_name = '%s/%s' % (owner, name)
+        self.parent = parent
+        self.path = os.path.join(emulator.root, owner, name + '.git')
+        self.hooks = []
+        self.issues = {}
+        # {sha: [status]}, oldest first
+        self.statuses = collections.defaultdict(list)
+        self.protected = set()
+        self.collaborators = {owner}
+        self.deployments = {}
+
+    def init(self):
+        if self.parent:
+            subprocess.run(['git', 'clone', '-q', '--bare', self.parent.path, self.path], check=True)
+        else:
+            subprocess.run(['git', 'init', '-q', '--bare', self.path], check=True)
+        self.git('config', 'http.receivepack', 'true')
+        self.git('symbolic-ref', 'HEAD', 'refs/heads/master')
+
+    @property
+    def root(self):
+        return self.parent.root if self.parent else self
+
+    def git(self, *args, input=None, env=None, check=True):
+        """ Runs a git command on the repository, returns its stripped stdout """
+        p = subprocess.run(
+            ['git', '--git-dir=%s' % self.path, *args],
+            input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=dict(os.environ, **(env or {})),
+        )
+        if check and p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, args, p.stdout, p.stderr)
+        return p.stdout.decode().strip()
+
+    def rev_parse(self, ref):
+        """ Returns the sha of the commit ``ref`` (a sha or branch) points to,
+        ``None`` if there is no such commit
+        """
+        if ref.startswith('heads/'):
+            ref = 'refs/' + ref
+        elif not ref.startswith('refs/') and not re.match(r'^[0-9a-f]{40}$', ref):
+            ref = 'refs/heads/' + ref
+        return self.git('rev-parse', '--verify', '-q', ref + '^{commit}', check=False) or None
+
+    def refs(self):
+        return dict(
+            line.split(' ')[::-1]
+            for line in self.git('for-each-ref', '--format=%(objectname) %(refname)').splitlines()
+        )
+
+    def is_ancestor(self, sha, of):
+        return subprocess.run(
+            ['git', '--git-dir=%s' % self.path, 'merge-base', '--is-ancestor', sha, of],
+            stderr=subprocess.DEVNULL,
+        ).returncode == 0
+
+    def read_commit(self, sha):
+        """ Returns the git-data description of commit ``sha`` """
+        if self.git('cat-file', '-t', sha, check=False) != 'commit':
+            raise not_found()
+        headers, _, message = self.git('cat-file', 'commit', sha).partition('\n\n')
+        c = {'sha': sha, 'parents': [], 'message': message}
+        for line in headers.splitlines():
+            if line.startswith(' '):
+                continue # continuation (e.g. gpgsig)
+            k, _, v = line.partition(' ')
+            if k == 'tree':
+                c['tree'] = {'sha': v}
+            elif k == 'parent':
+                c['parents'].append({'sha': v})
+            elif k in ('author', 'committer'):
+                m = IDENTITY.match(v)
+                c[k] = {
+                    'name': m.group('name'),
+                    'email': m.group('email'),
+                    'date': datetime.datetime.utcfromtimestamp(int(m.group('ts'))).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                }
+        return c
+
+    def json(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'full_name': self.full_name,
+            'owner': self.emulator.user(self.owner).json(),
+            'private': False,
+            'fork': bool(self.parent),
+            'default_branch': 'master',
+            'url': '%s/repos/%s' % (self.emulator.url, self.full_name),
+            'html_url': '%s/%s' % (self.emulator.url, self.full_name),
+            'clone_url': '%s/%s.git' % (self.emulator.url, self.full_name),
+        }
+
+class Stats:
+    """ Counters of the emulator's activity, ``api`` counts the API requests
+    per (login, method, route) and ``deliveries`` lists the duration of
+    webhook deliveries (the time the receiver took to handle them) per event
+    """
+    def __init__(self):
+        self.api = collections.Counter()
+        self.deliveries = collections.defaultdict(list)
+        self.failed_deliveries = 0
+
+    def api_calls(self, login=None):
+        return sum(
+            count for (l, _, _), count in self.api.items()
+            if login is None or l == login
+        )
+
+    def report(self):
+        deliveries = {}
+        for event, durations in self.deliveries.items():
+            durations = sorted(durations)
+            deliveries[event] = {
+                'count': len(durations),
+                'mean': sum(durations) / len(durations),
+                'p50': durations[len(durations) // 2],
+                'p95': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+                'max': durations[-1],
+            }
+        return {
+            'api_calls': dict(self.api),
+            'deliveries': deliveries,
+            'failed_deliveries': self.failed_deliveries,
+        }
+
+class Emulator:
+    def __init__(self, root, host='localhost', port=0):
+        self.root = root
+        self._server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.emulator = self
+        self.url = 'http://%s:%d' % (host, self._server.server_address[1])
+        self.users = {}
+        self.tokens = {}
+        self.repos = {}
+        self.comments = {}
+        self.invitations = {}
+        self.rate_limits = collections.Counter()
+        self.stats = Stats()
+        self.lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._deliveries = queue.Queue()
+        self._threads = []
+
+    def start(self):
+        for target in (self._server.serve_forever, self._deliver):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self._threads.append(t)
+        _logger.info("github emulator listening on %s", self.url)
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._deliveries.put(None)
+        for t in self._threads:
+            t.join()
+
+    def add_user(self, login, name=None, email=None, token=None):
+        """ Creates a user which can authenticate with the returned
+        ``User.token``
+        """
+        u = User(
+            login, name or login,
+            email or '%s@users.noreply.github.com' % login,
+            token or uuid.uuid4().hex,
+        )
+        self.users[login] = u
+        self.tokens[u.token] = u
+        return u
+
+    def user(self, login):
+        u = self.users.get(login)
+        if u is None:
+            u = self.users[login] = User(login, login, None, None, type='Organization')
+        return u
+
+    def wait_for_deliveries(self):
+        """ Waits until all the webhooks emitted so far have been handled """
+        self._deliveries.join()
+
+    def reset_stats(self):
+        self.wait_for_deliveries()
+        self.stats = Stats()
+
+    # -- internals
+
+    def repo(self, name):
+        r = self.repos.get(name)
+        if r is None:
+            raise not_found()
+        return r
+
+    def issue(self, repo, number, pull=False):
+        issue = repo.issues.get(int(number))
+        if issue is None or (pull and not issue.is_pull):
+            raise not_found()
+        return issue
+
+    def _create_repo(self, owner, name, parent=None):
+        full_name = '%s/%s' % (owner, name)
+        if full_name in self.repos:
+            raise ApiError(422, 'Repository creation failed.', [{
+                'resource': 'Repository', 'code': 'custom', 'field': 'name',
+                'message': 'name already exists on this account',
+            }])
+        r = Repository(self, owner, name, parent=parent)
+        r.init()
+        self.repos[full_name] = r
+        return r
+
+    def _emit(self, repo, event, payload, sender):
+        payload = dict(payload, repository=repo.json(), sender=sender.json())
+        body = json.dumps(payload).encode()
+        for hook in repo.hooks:
+            if hook['active'] and (event in hook['events'] or '*' in hook['events'] or event == 'ping'):
+                self._deliveries.put((hook['config']['url'], hook['config'].get('secret'), event, body))
+
+    def _deliver(self):
+        while True:
+            item = self._deliveries.get()
+            try:
+                if item is None:
+                    return
+                url, secret, event, body = item
+                headers = {
+                    'Content-Type': 'application/json',
+                    'User-Agent': 'GitHub-Hookshot/emulator',
+                    'X-GitHub-Event': event,
+                    'X-GitHub-Delivery': str(uuid.uuid4()),
+                }
+                if secret:
+                    headers['X-Hub-Signature'] = 'sha1=' + hmac.new(secret.encode(), body, hashlib.sha1).hexdigest()
+                start = time.time()
+                try:
+                    with urllib.request.urlopen(urllib.request.Request(url, data=body, headers=headers, method='POST'), timeout=120) as r:
+                        r.read()
+                except Exception:
+                    _logger.warning("Failed to deliver %s to %s", event, url, exc_info=True)
+                    self.stats.failed_deliveries += 1
+                else:
+                    self.stats.deliveries[event].append(time.time() - start)
+            finally:
+                self._deliveries.task_done()
+
+    def _ref_updated(self, repo, branch, old, new, sender):
+        """ Updates the pull requests from or to ``branch`` after it moved
+        from ``old`` to ``new`` (``None`` if created / deleted)
+        """
+        for r in list(self.repos.values()):
+            for issue in r.issues.values():
+                if not issue.is_pull or issue.state != 'open':
+                    continue
+                if issue.head_repo is repo and issue.head_ref == branch:
+                    if new is None:
+                        issue.state = 'closed'
+                        self._emit(r, 'pull_request', {'action': 'closed', 'number': issue.number, 'pull_request': self._pr_json(issue)}, sender)
+                    elif new != issue.head:
+                        self._update_pull_head(issue, new)
+                        self._emit(r, 'pull_request', {'action': 'synchronize', 'number': issue.number, 'pull_request': self._pr_json(issue)}, sender)
+                elif r is repo and issue.base == branch and new and repo.is_ancestor(issue.head, new):
+                    issue.state = 'closed'
+                    issue.merged = True
+                    self._emit(r, 'pull_request', {'action': 'closed', 'number': issue.number, 'pull_request': self._pr_json(issue)}, sender)
+
+    def _update_pull_head(self, issue, sha):
+        ref = 'refs/pull/%d/head' % issue.number
+        if issue.head_repo is issue.repo:
+            issue.repo.git('update-ref', ref, sha)
+        else:
+            issue.repo.git('fetch', '-q', issue.head_repo.path, '+%s:%s' % (sha, ref))
+        issue.head = sha
+        self._update_merge_base(issue)
+
+    def _update_merge_base(self, issue):
+        base_sha = issue.repo.rev_parse(issue.base)
+        issue.merge_base = base_sha and issue.repo.git('merge-base', issue.head, base_sha, check=False) or None
+
+    def _pr_commits(self, issue):
+        """ Returns the shas of the commits of the pull request, oldest first """
+        return issue.repo.git(
+            'rev-list', '--reverse', '--topo-order', issue.head,
+            *(['^' + issue.merge_base] if issue.merge_base else [])
+        ).split()
+
+    def _write_tree(self, repo, entries, base_tree=None):
+        """ Creates a tree from ``base_tree`` (or an empty one) updated with
+        the github-style tree entries
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {'GIT_INDEX_FILE': os.path.join(tmp, 'index')}
+            if base_tree:
+                repo.git('read-tree', base_tree, env=env)
+            infos = []
+            for entry in entries:
+                if 'content' in entry:
+                    sha = repo.git('hash-object', '-w', '--stdin', input=entry['content'].encode())
+                else:
+                    sha = entry.get('sha')
+                if sha is None:
+                    infos.append('0 %s\t%s' % ('0' * 40, entry['path']))
+                else:
+                    infos.append('%s %s\t%s' % (entry.get('mode', '100644'), sha, entry['path']))
+            if infos:
+                repo.git('update-index', '--index-info', input=('\n'.join(infos) + '\n').encode(), env=env)
+            return repo.git('write-tree', env=env)
+
+    def _write_commit(self, repo, user, message, tree, parents, author=None, committer=None):
+        author = author or {'name': user.name, 'email': user.email}
+        committer = committer or author
+        env = {
+            'GIT_AUTHOR_NAME': author['name'],
+            'GIT_AUTHOR_EMAIL': author['email'],
+            'GIT_COMMITTER_NAME': committer['name'],
+            'GIT_COMMITTER_EMAIL': committer['email'],
+        }
+        if author.get('date'):
+            env['GIT_AUTHOR_DATE'] = author['date']
+        if committer.get('date'):
+            env['GIT_COMMITTER_DATE'] = committer['date']
+        args = ['commit-tree', tree]
+        for p in parents:
+            args += ['-p', p]
+        return repo.git(*args, input=message.encode(), env=env)
+
+    def _commit_json(self, repo, sha):
+        c = repo.read_commit(sha)
+        return {
+            'sha': sha,
+            'url': '%s/repos/%s/commits/%s' % (self.url, repo.full_name, sha),
+            'commit': {
+                'tree': c['tree'],
+                'message': c['message'],
+                'author': c['author'],
+                'committer': c['committer'],
+            },
+            'parents': c['parents'],
+        }
+
+    def _ref_json(self, repo, ref, sha):
+        return {
+            'ref': ref,
+            'url': '%s/repos/%s/git/%s' % (self.url, repo.full_name, ref),
+            'object': {'type': 'commit', 'sha': sha},
+        }
+
+    def _issue_json(self, issue):
+        j = {
+            'id': issue.number,
+            'number': issue.number,
+            'title': issue.title,
+            'body': issue.body,
+            'state': issue.state,
+            'user': issue.user.json(),
+            'labels': [{'name': l} for l in sorted(issue.labels)],
+            'comments': len(issue.comments),
+            'created_at': issue.created_at,
+            'html_url': '%s/%s/issues/%d' % (self.url, issue.repo.full_name, issue.number),
+        }
+        if issue.is_pull:
+            j['pull_request'] = {
+                'url': '%s/repos/%s/pulls/%d' % (self.url, issue.repo.full_name, issue.number),
+            }
+        return j
+
+    def _pr_json(self, issue):
+        repo = issue.repo
+        base_sha = repo.rev_parse(issue.base)
+        return {
+            'id': issue.number,
+            'number': issue.number,
+            'url': '%s/repos/%s/pulls/%d' % (self.url, repo.full_name, issue.number),
+            'html_url': '%s/%s/pull/%d' % (self.url, repo.full_name, issue.number),
+            'title': issue.title,
+            'body': issue.body,
+            'state': issue.state,
+            'draft': False,
+            'merged': issue.merged,
+            'user': issue.user.json(),
+            'labels': [{'name': l} for l in sorted(issue.labels)],
+            'commits': len(self._pr_commits(issue)),
+            'created_at': issue.created_at,
+            'head': {
+                'label': '%s:%s' % (issue.head_repo.owner, issue.head_ref),
+                'ref': issue.head_ref,
+                'sha': issue.head,
+                'user': self.user(issue.head_repo.owner).json(),
+                'repo': issue.head_repo.json(),
+            },
+            'base': {
+                'label': '%s:%s' % (repo.owner, issue.base),
+                'ref': issue.base,
+                'sha': base_sha,
+                'user': self.user(repo.owner).json(),
+                'repo': repo.json(),
+            },
+        }
+
+    def _paginate(self, req, items):
+        page = int(req.params.get('page', 1))
+        per_page = int(req.params.get('per_page', PER_PAGE))
+        headers = {}
+        if page * per_page < len(items):
+            headers['Link'] = '<%s%s?%s>; rel="next"' % (
+                self.url, urllib.parse.quote(req.path),
+                urllib.parse.urlencode(dict(req.params, page=page + 1)),
+            )
+        return 200, items[(page - 1) * per_page:page * per_page], headers
+
+    def _check_user(self, req):
+        if req.user is None:
+            raise ApiError(401, 'Requires authentication')
+
+    # -- users
+
+    @route('GET', r'/user')
+    def get_user(self, req):
+        self._check_user(req)
+        return dict(req.user.json(), name=req.user.name, email=req.user.email)
+
+    @route('GET', r'/user/emails')
+    def get_user_emails(self, req):
+        self._check_user(req)
+        return [{'email': req.user.email, 'primary': True, 'verified': True, 'visibility': 'public'}]
+
+    @route('GET', r'/users/(?P<login>[^/]+)')
+    def get_users(self, req, login):
+        u = self.users.get(login)
+        if u is None:
+            raise not_found()
+        return dict(u.json(), name=u.name)
+
+    @route('GET', r'/rate_limit')
+    def get_rate_limit(self, req):
+        self._check_user(req)
+        rate = {
+            'limit': RATE_LIMIT,
+            'remaining': RATE_LIMIT - self.rate_limits[req.user.login],
+            'reset': int(time.time()) // 3600 * 3600 + 3600,
+        }
+        return {'resources': {'core': rate}, 'rate': rate}
+
+    @route('PATCH', r'/user/repository_invitations/(?P<id>\d+)')
+    def accept_invitation(self, req, id):
+        self._check_user(req)
+        repo, login = self.invitations.pop(int(id), (None, None))
+        if repo is None or login != req.user.login:
+            raise not_found()
+        repo.collaborators.add(login)
+        return 204, None
+
+    # -- repositories
+
+    @route('POST', r'/user/repos')
+    def create_user_repo(self, req):
+        self._check_user(req)
+        return 201, self._create_repo(req.user.login, req.json['name']).json()
+
+    @route('POST', r'/orgs/(?P<org>[^/]+)/repos')
+    def create_org_repo(self, req, org):
+        self._check_user(req)
+        self.user(org)
+        return 201, self._create_repo(org, req.json['name']).json()
+
+    @route('GET', R)
+    def get_repo(self, req, repo):
+        return self.repo(repo).json()
+
+    @route('DELETE', R)
+    def delete_repo(self, req, repo):
+        self._check_user(req)
+        r = self.repos.pop(self.repo(repo).full_name)
+        shutil.rmtree(r.path, ignore_errors=True)
+        return 204, None
+
+    @route('POST', R + r'/forks')
+    def fork(self, req, repo):
+        self._check_user(req)
+        parent = self.repo(repo)
+        fork = self.repos.get('%s/%s' % (req.user.login, parent.name))
+        if fork is None:
+            fork = self._create_repo(req.user.login, parent.name, parent=parent)
+        return 202, fork.json()
+
+    @route('GET', R + r'/hooks')
+    def get_hooks(self, req, repo):
+        return [self._hook_json(h) for h in self.repo(repo).hooks]
+
+    @route('POST', R + r'/hooks')
+    def create_hook(self, req, repo):
+        self._check_user(req)
+        r = self.repo(repo)
+        hook = {
+            'id': next(self._ids),
+            'active': req.json.get('active', True),
+            'events': req.json.get('events', ['push']),
+            'config': dict(req.json['config']),
+        }
+        r.hooks.append(hook)
+        self._emit(r, 'ping', {'zen': 'Keep it logically awesome.', 'hook_id': hook['id'], 'hook': self._hook_json(hook)}, req.user)
+        return 201, self._hook_json(hook)
+
+    @route('PATCH', R + r'/hooks/(?P<id>\d+)')
+    def update_hook(self, req, repo, id):
+        self._check_user(req)
+        hook = next((h for h in self.repo(repo).hooks if h['id'] == int(id)), None)
+        if hook is None:
+            raise not_found()
+        for k in ('active', 'events'):
+            if k in req.json:
+                hook[k] = req.json[k]
+        if 'config' in req.json:
+            hook['config'] = dict(req.json['config'])
+        return self._hook_json(hook)
+
+    def _hook_json(self, hook):
+        config = {k: v for k, v in hook['config'].items() if k != 'secret'}
+        return dict(hook, config=config)
+
+    @route('PUT', R + r'/subscription')
+    def subscribe(self, req, repo):
+        self.repo(repo)
+        return {'subscribed': req.json.get('subscribed', False), 'ignored': req.json.get('ignored', False)}
+
+    @route('PUT', R + r'/collaborators/(?P<login>[^/]+)')
+    def invite(self, req, repo, login):
+        self._check_user(req)
+        r = self.repo(repo)
+        invitation = next(self._ids)
+        self.invitations[invitation] = (r, login)
+        return 201, {'id': invitation, 'invitee': self.user(login).json()}
+
+    @route('GET', R + r'/collaborators')
+    def get_collaborators(self, req, repo):
+        return [self.user(login).json() for login in sorted(self.repo(repo).collaborators)]
+
+    @route('PUT', R + r'/branches/(?P<branch>.+)/protection')
+    def protect(self, req, repo, branch):
+        self._check_user(req)
+        self.repo(repo).protected.add(branch)
+        return {'url': '%s/repos/%s/branches/%s/protection' % (self.url, repo, branch)}
+
+    @route('PUT', R + r'/contents/(?P<path>.+)')
+    def put_contents(self, req, repo, path):
+        self._check_user(req)
+        r = self.repo(repo)
+        branch = req.json.get('branch', 'master')
+        parent = r.rev_parse(branch)
+        tree = self._write_tree(r, [{
+            'path': path,
+            'mode': '100644',
+            'content': base64.b64decode(req.json['content']).decode(),
+        }], base_tree=parent and r.read_commit(parent)['tree']['sha'])
+        sha = self._write_commit(r, req.user, req.json['message'], tree, [parent] if parent else [])
+        r.git('update-ref', 'refs/heads/' + branch, sha)
+        self._ref_updated(r, branch, parent, sha, req.user)
+        return 201, {'content': {'path': path}, 'commit': {'sha': sha}}
+
+    # -- git data
+
+    @route('GET', R + r'/git/refs?/(?P<ref>heads/.+)')
+    def get_ref(self, req, repo, ref):
+        r = self.repo(repo)
+        sha = r.git('rev-parse', '--verify', '-q', 'refs/' + ref, check=False)
+        if not sha:
+            raise not_found()
+        return self._ref_json(r, 'refs/' + ref, sha)
+
+    @route('POST', R + r'/git/refs')
+    def create_ref(self, req, repo):
+        self._check_user(req)
+        r = self.repo(repo)
+        ref, sha = req.json['ref'], req.json['sha']
+        if not re.match(r'^refs/\w+/.+', ref):
+            raise ApiError(422, 'Reference name must contain at least three slash-separated components.')
+        if r.git('rev-parse', '--verify', '-q', ref, check=False):
+            raise ApiError(422, 'Reference already exists')
+        if r.git('cat-file', '-t', sha, check=False) != 'commit':
+            raise ApiError(422, 'Object does not exist')
+        r.git('update-ref', ref, sha)
+        if ref.startswith('refs/heads/'):
+            self._ref_updated(r, ref[11:], None, sha, req.user)
+        return 201, self._ref_json(r, ref, sha)
+
+    @route('PATCH', R + r'/git/refs/(?P<ref>heads/.+)')
+    def update_ref(self, req, repo, ref):
+        self._check_user(req)
+        r = self.repo(repo)
+        branch = ref[6:]
+        old = r.git('rev-parse', '--verify', '-q', 'refs/' + ref, check=False)
+        if not old:
+            raise ApiError(422, 'Reference does not exist')
+        sha = req.json['sha']
+        if r.git('cat-file', '-t', sha, check=False) != 'commit':
+            raise ApiError(422, 'Object does not exist')
+        if not r.is_ancestor(old, sha):
+            if branch in r.protected:
+                raise ApiError(422, 'Cannot force-push to this protected branch')
+            if not req.json.get('force'):
+                raise ApiError(422, 'Update is not a fast forward')
+        r.git('update-ref', 'refs/' + ref, sha)
+        self._ref_updated(r, branch, old, sha, req.user)
+        return self._ref_json(r, 'refs/' + ref, sha)
+
+    @route('DELETE', R + r'/git/refs/(?P<ref>heads/.+)')
+    def delete_ref(self, req, repo, ref):
+        self._check_user(req)
+        r = self.repo(repo)
+        branch = ref[6:]
+        old = r.git('rev-parse', '--verify', '-q', 'refs/' + ref, check=False)
+        if not old:
+            raise ApiError(422, 'Reference does not exist')
+        if branch in r.protected:
+            raise ApiError(422, 'Cannot delete this protected branch')
+        r.git('update-ref', '-d', 'refs/' + ref)
+        self._ref_updated(r, branch, old, None, req.user)
+        return 204, None
+
+    @route('GET', R + r'/git/commits/(?P<sha>[0-9a-f]+)')
+    def get_git_commit(self, req, repo, sha):
+        r = self.repo(repo)
+        return dict(r.read_commit(sha), url='%s/repos/%s/git/commits/%s' % (self.url, repo, sha))
+
+    @route('POST', R + r'/git/commits')
+    def create_git_commit(self, req, repo):
+        self._check_user(req)
+        r = self.repo(repo)
+        for obj in [req.json['tree'], *req.json.get('parents', [])]:
+            if r.git('cat-file', '-t', obj, check=False) not in ('tree', 'commit'):
+                raise ApiError(422, 'Object does not exist')
+        sha = self._write_commit(
+            r, req.user, req.json['message'], req.json['tree'], req.json.get('parents', []),
+            author=req.json.get('author'), committer=req.json.get('committer'),
+        )
+        return 201, r.read_commit(sha)
+
+    @route('GET', R + r'/git/trees/(?P<sha>[0-9a-f]+)')
+    def get_tree(self, req, repo, sha):
+        r = self.repo(repo)
+        if r.git('cat-file', '-t', sha, check=False) != 'tree':
+            raise not_found()
+        entries = []
+        args = ['ls-tree', '-z', sha] if not req.params.get('recursive') else ['ls-tree', '-r', '-z', sha]
+        for record in r.git(*args).split('\0'):
+            if not record:
+                continue
+            meta, path = record.split('\t', 1)
+            mode, type_, obj = meta.split(' ')
+            entries.append({
+                'path': path,
+                'mode': mode,
+                'type': type_,
+                'sha': obj,
+                'url': '%s/repos/%s/git/%ss/%s' % (self.url, repo, type_, obj),
+            })
+        return {'sha': sha, 'tree': entries, 'truncated': False}
+
+    @route('POST', R + r'/git/trees')
+    def create_tree(self, req, repo):
+        self._check_user(req)
+        r = self.repo(repo)
+        base_tree = req.json.get('base_tree')
+        if base_tree and r.git('cat-file', '-t', base_tree, check=False) != 'tree':
+            raise ApiError(422, 'Invalid tree info')
+        sha = self._write_tree(r, req.json['tree'], base_tree=base_tree)
+        return 201, self.get_tree(req._replace(params={}), repo, sha)
+
+    @route('GET', R + r'/git/blobs/(?P<sha>[0-9a-f]+)')
+    def get_blob(self, req, repo, sha):
+        r = self.repo(repo)
+        if r.git('cat-file', '-t', sha, check=False) != 'blob':
+            raise not_found()
+        content = subprocess.run(
+            ['git', '--git-dir=%s' % r.path, 'cat-file', 'blob', sha],
+            stdout=subprocess.PIPE, check=True
+        ).stdout
+        return {'sha': sha, 'size': len(content), 'encoding': 'base64', 'content': base64.b64encode(content).decode()}
+
+    @route('POST', R + r'/merges')
+    def merge(self, req, repo):
+        self._check_user(req)
+        r = self.repo(repo)
+        base = req.json['base']
+        base_sha = r.rev_parse(base)
+        head_sha = r.rev_parse(req.json['head'])
+        if base_sha is None:
+            raise ApiError(404, 'Base does not exist')
+        if head_sha is None:
+            raise ApiError(404, 'Head does not exist')
+        if r.is_ancestor(head_sha, base_sha):
+            return 204, None
+        p = subprocess.run(
+            ['git', '--git-dir=%s' % r.path, 'merge-tree', '--write-tree', '--no-messages', base_sha, head_sha],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        if p.returncode == 1:
+            raise ApiError(409, 'Merge conflict')
+        elif p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, p.args, p.stdout, p.stderr)
+        tree = p.stdout.decode().splitlines()[0]
+        message = req.json.get('commit_message') or 'Merge %s into %s' % (req.json['head'], base)
+        sha = self._write_commit(r, req.user, message, tree, [base_sha, head_sha])
+        r.git('update-ref', 'refs/heads/' + base, sha, base_sha)
+        self._ref_updated(r, base, base_sha, sha, req.user)
+        return 201, self._commit_json(r, sha)
+
+    # -- commits & statuses
+
+    @route('GET', R + r'/commits')
+    def get_commits(self, req, repo):
+        r = self.repo(repo)
+        sha = r.rev_parse(req.params.get('sha', 'master'))
+        if sha is None:
+            raise not_found()
+        return self._paginate(req, [
+            self._commit_json(r, c)
+            for c in r.git('rev-list', sha).split()
+        ])
+
+    @route('GET', R + r'/commits/(?P<ref>.+)/status')
+    def get_combined_status(self, req, repo, ref):
+        r = self.repo(repo)
+        sha = r.rev_parse(ref)
+        if sha is None:
+            raise ApiError(422, 'No commit found for SHA: %s' % ref)
+        latest = {}
+        for status in reversed(r.statuses[sha]):
+            latest.setdefault(status['context'], status)
+        statuses = list(latest.values())
+        states = {s['state'] for s in statuses}
+        if states & {'failure', 'error'}:
+            state = 'failure'
+        elif 'pending' in states or not states:
+            state = 'pending'
+        else:
+            state = 'success'
+        return {'sha': sha, 'state': state, 'statuses': statuses, 'total_count': len(statuses)}
+
+    @route('GET', R + r'/commits/(?P<ref>.+)')
+    def get_commit(self, req, repo, ref):
+        r = self.repo(repo)
+        sha = r.rev_parse(ref)
+        if sha is None:
+            raise ApiError(422, 'No commit found for SHA: %s' % ref)
+        return self._commit_json(r, sha)
+
+    @route('POST', R + r'/statuses/(?P<sha>[0-9a-f]+)')
+    def create_status(self, req, repo, sha):
+        self._check_user(req)
+        r = self.repo(repo)
+        if r.git('cat-file', '-t', sha, check=False) != 'commit':
+            raise ApiError(422, 'No commit found for SHA: %s' % sha)
+        status = {
+            'id': next(self._ids),
+            'state': req.json['state'],
+            'context': req.json.get('context', 'default'),
+            'target_url': req.json.get('target_url'),
+            'description': req.json.get('description'),
+            'creator': req.user.json(),
+            'created_at': now(),
+            'updated_at': now(),
+        }
+        r.statuses[sha].append(status)
+        self._emit(r, 'status', {
+            'id': status['id'],
+            'sha': sha,
+            'name': r.full_name,
+            'context': status['context'],
+            'state': status['state'],
+            'target_url': status['target_url'],
+            'description': status['description'],
+            'commit': self._commit_json(r, sha),
+        }, req.user)
+        return 201, status
+
+    @route('POST', R + r'/deployments')
+    def create_deployment(self, req, repo):
+        self._check_user(req)
+        r = self.repo(repo)
+        deployment = dict(req.json, id=next(self._ids), creator=req.user.json(), created_at=now())
+        r.deployments[deployment['id']] = deployment
+        return 201, deployment
+
+    @route('POST', R + r'/deployments/(?P<id>\d+)/statuses')
+    def create_deployment_status(self, req, repo, id):
+        self._check_user(req)
+        if int(id) not in self.repo(repo).deployments:
+            raise not_found()
+        return 201, dict(req.json, id=next(self._ids), creator=req.user.json(), created_at=now())
+
+    # -- issues
+
+    @route('GET', R + r'/issues/(?P<number>\d+)')
+    def get_issue(self, req, repo, number):
+        return self._issue_json(self.issue(self.repo(repo), number))
+
+    @route('GET', R + r'/issues/(?P<number>\d+)/comments')
+    def get_comments(self, req, repo, number):
+        return self._paginate(req, list(self.issue(self.repo(repo), number).comments))
+
+    @route('POST', R + r'/issues/(?P<number>\d+)/comments')
+    def create_comment(self, req, repo, number):
+        self._check_user(req)
+        r = self.repo(repo)
+        issue = self.issue(r, number)
+        comment = {
+            'id': next(self._ids),
+            'body': req.json['body'],
+            'user': req.user.json(),
+            'created_at': now(),
+            'updated_at': now(),
+            'html_url': '%s/%s/issues/%d' % (self.url, r.full_name, issue.number),
+        }
+        issue.comments.append(comment)
+        self.comments[comment['id']] = issue
+        self._emit(r, 'issue_comment', {'action': 'created', 'issue': self._issue_json(issue), 'comment': comment}, req.user)
+        return 201, comment
+
+    @route('PATCH', R + r'/issues/comments/(?P<id>\d+)')
+    def update_comment(self, req, repo, id):
+        self._check_user(req)
+        issue = self.comments.get(int(id))
+        if issue is None:
+            raise not_found()
+        comment = next(c for c in issue.comments if c['id'] == int(id))
+        changes = {'body': {'from': comment['body']}}
+        comment.update(body=req.json['body'], updated_at=now())
+        self._emit(issue.repo, 'issue_comment', {'action': 'edited', 'changes': changes, 'issue': self._issue_json(issue), 'comment': comment}, req.user)
+        return comment
+
+    @route('DELETE', R + r'/issues/comments/(?P<id>\d+)')
+    def delete_comment(self, req, repo, id):
+        self._check_user(req)
+        issue = self.comments.pop(int(id), None)
+        if issue is None:
+            raise not_found()
+        comment = next(c for c in issue.comments if c['id'] == int(id))
+        issue.comments.remove(comment)
+        self._emit(issue.repo, 'issue_comment', {'action': 'deleted', 'issue': self._issue_json(issue), 'comment': comment}, req.user)
+        return 204, None
+
+    @route('GET', R + r'/issues/(?P<number>\d+)/labels')
+    def get_labels(self, req, repo, number):
+        return [{'name': l} for l in sorted(self.issue(self.repo(repo), number).labels)]
+
+    @route('POST', R + r'/issues/(?P<number>\d+)/labels')
+    def add_labels(self, req, repo, number):
+        self._check_user(req)
+        issue = self.issue(self.repo(repo), number)
+        issue.labels.update(req.json['labels'])
+        return [{'name': l} for l in sorted(issue.labels)]
+
+    @route('PUT', R + r'/issues/(?P<number>\d+)/labels')
+    def set_labels(self, req, repo, number):
+        self._check_user(req)
+        issue = self.issue(self.repo(repo), number)
+        issue.labels = set(req.json['labels'])
+        return [{'name': l} for l in sorted(issue.labels)]
+
+    @route('DELETE', R + r'/issues/(?P<number>\d+)/labels/(?P<name>.+)')
+    def remove_label(self, req, repo, number, name):
+        self._check_user(req)
+        issue = self.issue(self.repo(repo), number)
+        if name not in issue.labels:
+            raise ApiError(404, 'Label does not exist')
+        issue.labels.remove(name)
+        return [{'name': l} for l in sorted(issue.labels)]
+
+    # -- pull requests
+
+    @route('POST', R + r'/pulls')
+    def create_pull(self, req, repo):
+        self._check_user(req)
+        r = self.repo(repo)
+        owner, _, head_ref = req.json['head'].rpartition(':')
+        head_repo = r
+        if owner and owner != r.owner:
+            head_repo = next((
+                candidate for candidate in self.repos.values()
+                if candidate.owner == owner and candidate.root is r.root
+            ), None)
+        base = req.json['base']
+        head = head_repo and head_repo.rev_parse('refs/heads/' + head_ref)
+        if head is None:
+            raise ApiError(422, 'Validation Failed', [{'resource': 'PullRequest', 'field': 'head', 'code': 'invalid'}])
+        if r.rev_parse('refs/heads/' + base) is None:
+            raise ApiError(422, 'Validation Failed', [{'resource': 'PullRequest', 'field': 'base', 'code': 'invalid'}])
+        for issue in r.issues.values():
+            if issue.is_pull and issue.state == 'open' and issue.head_repo is head_repo \
+                    and issue.head_ref == head_ref and issue.base == base:
+                raise ApiError(422, 'Validation Failed', [{
+                    'resource': 'PullRequest', 'code': 'custom',
+                    'message': 'A pull request already exists for %s:%s.' % (head_repo.owner, head_ref),
+                }])
+
+        issue = Issue(r, len(r.issues) + 1, req.user, req.json.get('title') or head_ref, req.json.get('body'))
+        issue.is_pull = True
+        issue.head_repo = head_repo
+        issue.head_ref = head_ref
+        issue.base = base
+        self._update_pull_head(issue, head)
+        if r.is_ancestor(head, r.rev_parse(base)):
+            r.git('update-ref', '-d', 'refs/pull/%d/head' % issue.number)
+            raise ApiError(422, 'Validation Failed', [{
+                'resource': 'PullRequest', 'code': 'custom',
+                'message': 'No commits between %s and %s' % (base, head_ref),
+            }])
+        r.issues[issue.number] = issue
+        payload = self._pr_json(issue)
+        self._emit(r, 'pull_request', {'action': 'opened', 'number': issue.number, 'pull_request': payload}, req.user)
+        return 201, payload
+
+    @route('GET', R + r'/pulls/(?P<number>\d+)')
+    def get_pull(self, req, repo, number):
+        return self._pr_json(self.issue(self.repo(repo), number, pull=True))
+
+    @route('PATCH', R + r'/pulls/(?P<number>\d+)')
+    def update_pull(self, req, repo, number):
+        self._check_user(req)
+        r = self.repo(repo)
+        issue = self.issue(r, number, pull=True)
+        changes = {}
+        for field in ('title', 'body'):
+            if field in req.json and req.json[field] != getattr(issue, field):
+                changes[field] = {'from': getattr(issue, field)}
+                setattr(issue, field, req.json[field])
+        if 'base' in req.json and req.json['base'] != issue.base:
+            if r.rev_parse('refs/heads/' + req.json['base']) is None:
+                raise ApiError(422, 'Validation Failed', [{'resource': 'PullRequest', 'field': 'base', 'code': 'invalid'}])
+            changes['base'] = {'ref': {'from': issue.base}, 'sha': {'from': r.rev_parse(issue.base)}}
+            issue.base = req.json['base']
+            self._update_merge_base(issue)
+        if changes:
+            self._emit(r, 'pull_request', {'action': 'edited', 'changes': changes, 'number': issue.number, 'pull_request': self._pr_json(issue)}, req.user)
+
+        state = req.json.get('state')
+        if state and state != issue.state and not issue.merged:
+            issue.state = state
+            self._emit(r, 'pull_request', {
+                'action': 'closed' if state == 'closed' else 'reopened',
+                'number': issue.number,
+                'pull_request': self._pr_json(issue),
+            }, req.user)
+        return self._pr_json(issue)
+
+    @route('GET', R + r'/pulls/(?P<number>\d+)/commits')
+    def get_pull_commits(self, req, repo, number):
+        r = self.repo(repo)
+        issue = self.issue(r, number, pull=True)
+        return self._paginate(req, [self._commit_json(r, sha) for sha in self._pr_commits(issue)])
+
+    @route('GET', R + r'/pulls/(?P<number>\d+)/reviews')
+    def get_reviews(self, req, repo, number):
+        return self._paginate(req, list(self.issue(self.repo(repo), number, pull=True).reviews))
+
+    @route('POST', R + r'/pulls/(?P<number>\d+)/reviews')
+    def create_review(self, req, repo, number):
+        self._check_user(req)
+        r = self.repo(repo)
+        issue = self.issue(r, number, pull=True)
+        event = req.json.get('event')
+        state = {'APPROVE': 'APPROVED', 'REQUEST_CHANGES': 'CHANGES_REQUESTED', 'COMMENT': 'COMMENTED'}.get(event, 'PENDING')
+        if state in ('CHANGES_REQUESTED', 'COMMENTED') and not req.json.get('body'):
+            raise ApiError(422, 'Unprocessable Entity', [{'message': 'Body is required for %s' % event}])
+        review = {
+            'id': next(self._ids),
+            'user': req.user.json(),
+            'body': req.json.get('body') or '',
+            'state': state,
+            'commit_id': req.json.get('commit_id') or issue.head,
+            'submitted_at': now(),
+        }
+        issue.reviews.append(review)
+        if state != 'PENDING':
+            self._emit(r, 'pull_request_review', {'action': 'submitted', 'review': review, 'pull_request': self._pr_json(issue)}, req.user)
+        return review
+
+    # -- dispatch
+
+    def handle(self, req):
+        """ Returns the (status, body, headers) of the API response to ``req`` """
+        method = 'GET' if req.method == 'HEAD' else req.method
+        for m, regex, pattern, fn in _routes:
+            if m != method:
+                continue
+            match = regex.match(req.path)
+            if not match:
+                continue
+            self.stats.api[(req.user.login if req.user else None, method, pattern)] += 1
+            with self.lock:
+                try:
+                    result = fn(self, req, **match.groupdict())
+                except ApiError as e:
+                    body = {'message': e.message}
+                    if e.errors:
+                        body['errors'] = e.errors
+                    return e.status, body, {}
+            if not isinstance(result, tuple):
+                result = (200, result)
+            if len(result) == 2:
+                result = (*result, {})
+            return result
+        return 404, {'message': 'Not Found'}, {}
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # keep connections alive, the clients pool them
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+    def do_GET(self):
+        self._dispatch()
+    do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _authenticate(self):
+        auth = self.headers.get('Authorization')
+        if not auth:
+            return None
+        kind, _, credentials = auth.partition(' ')
+        if kind.lower() == 'basic':
+            login, _, password = base64.b64decode(credentials).decode().partition(':')
+            credentials = password or login
+        user = self.server.emulator.tokens.get(credentials)
+        if user is None:
+            raise ApiError(401, 'Bad credentials')
+        return user
+
+    def _send(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _dispatch(self):
+        emulator = self.server.emulator
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path).rstrip('/') or '/'
+        body = self._read_body()
+        try:
+            user = self._authenticate()
+        except ApiError as e:
+            return self._send(e.status, json.dumps({'message': e.message}).encode(), [('Content-Type', 'application/json')])
+
+        m = GIT_PATH.match(path)
+        if m:
+            return self._git_backend(emulator, m.group('repo'), m.group('rest'), url.query, body, user)
+
+        req = Request(
+            self.command, path,
+            dict(urllib.parse.parse_qsl(url.query)),
+            json.loads(body) if body else {},
+            user,
+        )
+        try:
+            status, payload, extra = emulator.handle(req)
+        except Exception:
+            _logger.exception("Failed to handle %s %s", self.command, self.path)
+            status, payload, extra = 500, {'message': 'Server Error'}, {}
+
+        headers = [('X-GitHub-Request-Id', uuid.uuid4().hex)]
+        if user:
+            headers.append(('X-OAuth-Scopes', SCOPES))
+        content = b'' if payload is None else json.dumps(payload).encode()
+        if content:
+            headers.append(('Content-Type', 'application/json; charset=utf-8'))
+        if req.method in ('GET', 'HEAD') and status == 200:
+            etag = 'W/"%s"' % hashlib.md5(content).hexdigest()
+            headers.append(('ETag', etag))
+            if self.headers.get('If-None-Match') == etag:
+                # conditional requests don't count against the rate limit
+                status, content = 304, b''
+        if user:
+            if status != 304:
+                emulator.rate_limits[user.login] += 1
+            headers += [
+                ('X-RateLimit-Limit', str(RATE_LIMIT)),
+                ('X-RateLimit-Remaining', str(max(0, RATE_LIMIT - emulator.rate_limits[user.login]))),
+                ('X-RateLimit-Reset', str(int(time.time()) // 3600 * 3600 + 3600)),
+            ]
+        headers += extra.items()
+        self._send(status, content, headers)
+
+    def _git_backend(self, emulator, name, rest, query, body, user):
+        """ Serves git's smart http protocol through ``git http-backend``,
+        pushes update the pull requests and emit the corresponding hooks
+        """
+        repo = emulator.repos.get(name)
+        if repo is None:
+            return self._send(404, b'Repository not found')
+        env = dict(
+            os.environ,
+            GIT_PROJECT_ROOT=emulator.root,
+            GIT_HTTP_EXPORT_ALL='1',
+            PATH_INFO='/%s.git/%s' % (repo.full_name, rest),
+            QUERY_STRING=query,
+            REQUEST_METHOD=self.command,
+            CONTENT_TYPE=self.headers.get('Content-Type', ''),
+            CONTENT_LENGTH=str(len(body)),
+            REMOTE_USER=user.login if user else 'anonymous',
+            REMOTE_ADDR=self.client_address[0],
+        )
+        if self.headers.get('Content-Encoding'):
+            env['HTTP_CONTENT_ENCODING'] = self.headers['Content-Encoding']
+        if self.headers.get('Git-Protocol'):
+            env['GIT_PROTOCOL'] = self.headers['Git-Protocol']
+
+        pushing = rest == 'git-receive-pack'
+        with emulator.lock if pushing else _nolock:
+            before = repo.refs() if pushing else None
+            p = subprocess.run(['git', 'http-backend'], input=body, stdout=subprocess.PIPE, env=env)
+            if pushing:
+                after = repo.refs()
+                sender = user or emulator.user(repo.owner)
+                for ref in sorted(before.keys() | after.keys()):
+                    if ref.startswith('refs/heads/') and before.get(ref) != after.get(ref):
+                        emulator._ref_updated(repo, ref[11:], before.get(ref), after.get(ref), sender)
+
+        sep = b'\r\n\r\n' if b'\r\n\r\n' in p.stdout else b'\n\n'
+        raw_headers, _, content = p.stdout.partition(sep)
+        status = 200
+        headers = []
+        for line in raw_headers.decode().splitlines():
+            k, _, v = line.partition(':')
+            if k.lower() == 'status':
+                status = int(v.split()[0])
+            else:
+                headers.append((k, v.strip()))
+        self._send(status, content, headers)
+
+class _NoLock:
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        pass
+_nolock = _NoLock()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    parser = argparse.ArgumentParser(description="Serve a github stand-in over local bare repositories")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--root', help="where to store the repositories (a temporary directory by default)")
+    parser.add_argument('--user', action='append', default=[], metavar='LOGIN:TOKEN',
+                        help="user which can authenticate with the token, can be repeated")
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix='github_emulator')
+    emulator = Emulator(root, host=args.host, port=args.port)
+    for user in args.user:
+        login, _, token = user.partition(':')
+        emulator.add_user(login, token=token or None)
+    emulator.start()
+    print("GITHUB_API_URL=%s GITHUB_URL=%s" % (emulator.url, emulator.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        emulator.stop()
+        print(json.dumps(emulator.stats.report(), indent=4, default=str))
+
+if __name__ == '__main__':
+    main()
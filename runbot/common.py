@@ -5,8 +5,10 @@ import itertools
 import logging
 import os
 import psycopg2
+import psycopg2.pool
 import re
 import socket
+import threading
 import time
 
 from collections import OrderedDict
@@ -89,6 +91,33 @@ def rfind(filename, pattern):
     return False
 
 
+def scan_log(filename, patterns, chunk_size=1 << 20):
+    """Read filename once and search all patterns in it
+    :param patterns: dict of name: regex pattern, matched per line (re.M)
+    :param chunk_size: approximate size of the blocks of lines read at once
+    returns a tuple (found, timings), found being the set of the names of the
+    patterns found in the file and timings a dict of name: seconds spent
+    searching this pattern
+    """
+    regexps = {name: re.compile(pattern, re.M) for name, pattern in patterns.items()}
+    timings = dict.fromkeys(regexps, 0.0)
+    found = set()
+    with open(filename, 'r') as f:
+        while len(found) < len(regexps):
+            lines = f.readlines(chunk_size)
+            if not lines:
+                break
+            chunk = ''.join(lines)
+            for name, regexp in regexps.items():
+                if name in found:
+                    continue  # no need to search the rest of the file for this one
+                start = time.time()
+                if regexp.search(chunk):
+                    found.add(name)
+                timings[name] += time.time() - start
+    return found, timings
+
+
 def s2human(time):
     """Convert a time in second into an human readable string"""
     return format_timedelta(
@@ -98,19 +127,58 @@ def s2human(time):
     )
 
 
+_pgadmin_pool = None
+_pgadmin_pool_lock = threading.Lock()
+# ThreadedConnectionPool only keeps minconn idle connections, closing the
+# others when they are put back: keep one for the builder main and one for the
+# housekeeping thread. It raises PoolError instead of waiting once maxconn
+# connections are in use, callers above that (e.g. http workers) get a
+# connection of their own that is closed after use.
+PGADMIN_POOL_MINCONN = 2
+PGADMIN_POOL_MAXCONN = 4
+LOCAL_DBS_CACHE_TTL = 10
+# (additionnal conditions): (time, databases)
+_local_dbs_cache = {}
+
+
+def _get_pgadmin_pool():
+    global _pgadmin_pool
+    with _pgadmin_pool_lock:
+        if _pgadmin_pool is None:
+            _pgadmin_pool = psycopg2.pool.ThreadedConnectionPool(PGADMIN_POOL_MINCONN, PGADMIN_POOL_MAXCONN, "dbname=postgres")
+        return _pgadmin_pool
+
+
 @contextlib.contextmanager
 def local_pgadmin_cursor():
-    cnx = None
+    """ Cursor on the local postgres database, the connections being reused
+    between calls of the builder process
+    """
+    pool = _get_pgadmin_pool()
     try:
+        cnx = pool.getconn()
+    except psycopg2.pool.PoolError:
+        pool = None
         cnx = psycopg2.connect("dbname=postgres")
+    broken = False
+    try:
         cnx.autocommit = True  # required for admin commands
         yield cnx.cursor()
+    except (psycopg2.InterfaceError, psycopg2.OperationalError):
+        broken = True
+        raise
     finally:
-        if cnx:
+        if pool is not None:
+            pool.putconn(cnx, close=broken or cnx.closed)
+        else:
             cnx.close()
 
 
 def list_local_dbs(additionnal_conditions=None):
+    key = tuple(additionnal_conditions or ())
+    cached = _local_dbs_cache.get(key)
+    if cached and time.time() - cached[0] < LOCAL_DBS_CACHE_TTL:
+        return list(cached[1])
     additionnal_condition_str = ''
     if additionnal_conditions:
         additionnal_condition_str = 'AND (%s)' % ' OR '.join(additionnal_conditions)
@@ -121,7 +189,14 @@ def list_local_dbs(additionnal_conditions=None):
                 WHERE pg_get_userbyid(datdba) = current_user
                 %s
         """ % additionnal_condition_str)
-        return [d[0] for d in local_cr.fetchall()]
+        dbs = [d[0] for d in local_cr.fetchall()]
+    _local_dbs_cache[key] = (time.time(), dbs)
+    return list(dbs)
+
+
+def invalidate_local_dbs():
+    """ To call after creating or dropping databases """
+    _local_dbs_cache.clear()
 
 
 def pseudo_markdown(text):
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 """Containerize builds
 
-The docker image used for the build is always tagged like this:
+The base docker image used for the builds is tagged like this:
     odoo:runbot_tests
+Images with the requirements of the builds installed derive from it.
 This file contains helpers to containerize builds with Docker.
 When testing this file:
     the first parameter should be a directory containing Odoo.
@@ -11,14 +12,19 @@ When testing this file:
 import argparse
 import configparser
 import datetime
+import hashlib
+import http.client
 import io
 import json
 import logging
 import os
 import re
 import shutil
+import socket
 import subprocess
+import threading
 import time
+import urllib.parse
 
 
 _logger = logging.getLogger(__name__)
@@ -102,16 +108,69 @@ def docker_build(log_path, build_dir):
     # Prepare docker image
     docker_dir = os.path.join(build_dir, 'docker')
     os.makedirs(docker_dir, exist_ok=True)
-    shutil.copy(os.path.join(os.path.dirname(__file__), 'data', 'Dockerfile'), docker_dir)
-    # synchronise the current user with the odoo user inside the Dockerfile
-    with open(os.path.join(docker_dir, 'Dockerfile'), 'a') as df:
-        df.write(DOCKERUSER)
+    with open(os.path.join(os.path.dirname(__file__), 'data', 'Dockerfile')) as df:
+        # synchronise the current user with the odoo user inside the Dockerfile
+        dockerfile = df.read() + DOCKERUSER
+    dockerfile_hash = hashlib.sha256(dockerfile.encode()).hexdigest()
+    hash_path = os.path.join(docker_dir, 'Dockerfile.sha256')
+    if os.path.exists(hash_path) and open(hash_path).read() == dockerfile_hash and docker_image_exists('odoo:runbot_tests'):
+        _logger.debug('Docker image odoo:runbot_tests is up to date')
+        return
+    with open(os.path.join(docker_dir, 'Dockerfile'), 'w') as df:
+        df.write(dockerfile)
     logs = open(log_path, 'w')
     dbuild = subprocess.Popen(['docker', 'build', '--tag', 'odoo:runbot_tests', '.'], stdout=logs, stderr=logs, cwd=docker_dir)
-    dbuild.wait()
+    if dbuild.wait() == 0:
+        with open(hash_path, 'w') as hash_file:
+            hash_file.write(dockerfile_hash)
 
 
-def docker_run(run_cmd, log_path, build_dir, container_name, exposed_ports=None, cpu_limit=None, preexec_fn=None, ro_volumes=None, env_variables=None):
+def docker_base_image_hash(build_dir):
+    """Return the hash of the Dockerfile the base image was last built from"""
+    hash_path = os.path.join(build_dir, 'docker', 'Dockerfile.sha256')
+    return open(hash_path).read() if os.path.exists(hash_path) else ''
+
+
+def docker_build_requirements(log_path, image_dir, tag, requirements, py_version):
+    """Build an image deriving from odoo:runbot_tests with python requirements installed
+    :param log_path: path to the logfile that will contain the docker build output
+    :param image_dir: empty directory used as the docker build context
+    :param tag: tag of the image
+    :param requirements: list of requirements.txt contents to install
+    :param py_version: python version suffix of pip, '3' or ''
+    :return: True if the image was built
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    dockerfile = ['FROM odoo:runbot_tests', 'USER root']
+    for i, content in enumerate(requirements):
+        with open(os.path.join(image_dir, 'requirements-%s.txt' % i), 'w') as requirements_file:
+            requirements_file.write(content)
+        dockerfile.append('COPY requirements-%s.txt /tmp/requirements-%s.txt' % (i, i))
+        dockerfile.append('RUN pip%s install --no-cache-dir -r /tmp/requirements-%s.txt' % (py_version, i))
+    dockerfile.append('USER odoo')
+    with open(os.path.join(image_dir, 'Dockerfile'), 'w') as df:
+        df.write('\n'.join(dockerfile) + '\n')
+    with open(log_path, 'w') as logs:
+        dbuild = subprocess.run(['docker', 'build', '--tag', tag, '.'], stdout=logs, stderr=logs, cwd=image_dir)
+    return dbuild.returncode == 0
+
+
+def docker_image_exists(tag):
+    exists = _with_docker_client('image_exists', tag)
+    if exists is not NotImplemented:
+        return exists
+    dinspect = subprocess.run(['docker', 'image', 'inspect', tag], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    return dinspect.returncode == 0
+
+
+def docker_image_remove(tag):
+    """Removes the image tagged tag, images used by a container are kept"""
+    _logger.info('Removing image %s', tag)
+    if _with_docker_client('image_remove', tag) is NotImplemented:
+        subprocess.run(['docker', 'image', 'rm', tag], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+
+def docker_run(run_cmd, log_path, build_dir, container_name, exposed_ports=None, cpu_limit=None, preexec_fn=None, ro_volumes=None, env_variables=None, image=None, memory_limit=None, cpus=None, overlay=False):
     """Run tests in a docker container
     :param run_cmd: command string to run in container
     :param log_path: path to the logfile that will contain odoo stdout and stderr
@@ -121,6 +180,10 @@ def docker_run(run_cmd, log_path, build_dir, container_name, exposed_ports=None,
     :param exposed_ports: if not None, starting at 8069, ports will be exposed as exposed_ports numbers
     :params ro_volumes: dict of dest:source volumes to mount readonly in builddir
     :params env_variables: list of environment variables
+    :params image: tag of the image to run, odoo:runbot_tests by default
+    :params memory_limit: memory available to the container in MB
+    :params cpus: number of cpus the container can use
+    :params overlay: mount the ro_volumes with a writable overlay kept in the build dir
     """
     container_name = sanitize_container_name(container_name)
     if isinstance(run_cmd, Command):
@@ -130,7 +193,9 @@ def docker_run(run_cmd, log_path, build_dir, container_name, exposed_ports=None,
         cmd_object = Command([], run_cmd.split(' '), [])
     _logger.debug('Docker run command: %s', run_cmd)
     logs = open(log_path, 'w')
-    run_cmd = 'cd /data/build;touch start-%s;%s;cd /data/build;touch end-%s' % (container_name, run_cmd, container_name)
+    # the cgroup counters are saved before the end file so that they are
+    # available once the end of the container is detected
+    run_cmd = 'cd /data/build;touch start-%s;%s;cd /data/build;%s;touch end-%s' % (container_name, run_cmd, _save_cgroup_cmd(container_name), container_name)
     docker_clear_state(container_name, build_dir)  # ensure that no state are remaining
     logs.write("Docker command:\n%s\n=================================================\n" % cmd_object)
     # create start script
@@ -144,8 +209,12 @@ def docker_run(run_cmd, log_path, build_dir, container_name, exposed_ports=None,
     ]
     if ro_volumes:
         for dest, source in ro_volumes.items():
-            logs.write("Adding readonly volume '%s' pointing to %s \n" % (dest, source))
-            docker_command.append('--volume=%s:/data/build/%s:ro' % (source, dest))
+            if overlay:
+                logs.write("Adding overlay volume '%s' on top of %s \n" % (dest, source))
+                docker_command.append('--mount=%s' % docker_overlay_mount(build_dir, dest, source))
+            else:
+                logs.write("Adding readonly volume '%s' pointing to %s \n" % (dest, source))
+                docker_command.append('--volume=%s:/data/build/%s:ro' % (source, dest))
 
     if env_variables:
         for var in env_variables:
@@ -165,24 +234,164 @@ def docker_run(run_cmd, log_path, build_dir, container_name, exposed_ports=None,
             docker_command.extend(['-p', '127.0.0.1:%s:%s' % (hp, dp)])
     if cpu_limit:
         docker_command.extend(['--ulimit', 'cpu=%s' % int(cpu_limit)])
-    docker_command.extend(['odoo:runbot_tests', '/bin/bash', '-c', "%s" % run_cmd])
+    if memory_limit:
+        docker_command.extend(['--memory', '%sm' % int(memory_limit)])
+    if cpus:
+        docker_command.extend(['--cpus', '%s' % cpus])
+    docker_command.extend([image or 'odoo:runbot_tests', '/bin/bash', '-c', "%s" % run_cmd])
     docker_run = subprocess.Popen(docker_command, stdout=logs, stderr=logs, preexec_fn=preexec_fn, close_fds=False, cwd=build_dir)
     _logger.info('Started Docker container %s', container_name)
     return
 
+class DockerApiError(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTP connection over a unix socket """
+
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockerClient():
+    """ Minimal client of the Docker Engine API on the local unix socket
+
+    The connection is kept alive between the requests and shared by the
+    threads of the process, requests being serialized. Only the calls that
+    don't need the docker output to be streamed to a file use it, running
+    and building containers still go through the docker CLI.
+    """
+
+    def __init__(self, socket_path='/var/run/docker.sock'):
+        self.socket_path = socket_path
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _request(self, method, path, params=None, ok_statuses=(200,)):
+        """ Returns the decoded json response and status, retrying once on
+        a new connection if the kept alive one was closed by docker
+        """
+        if params:
+            path = '%s?%s' % (path, urllib.parse.urlencode(params))
+        with self._lock:
+            for retry in (True, False):
+                if self._connection is None:
+                    self._connection = UnixHTTPConnection(self.socket_path)
+                try:
+                    self._connection.request(method, path)
+                    response = self._connection.getresponse()
+                    body = response.read()
+                    break
+                except (OSError, http.client.HTTPException):
+                    self._connection.close()
+                    self._connection = None
+                    if not retry:
+                        raise
+        if response.status not in ok_statuses:
+            raise DockerApiError('%s %s returned %s: %s' % (method, path, response.status, body[:200]))
+        return (json.loads(body) if body else None), response.status
+
+    def ps(self):
+        """ Returns the names of the running containers """
+        containers, _ = self._request('GET', '/containers/json')
+        return [name.lstrip('/') for container in containers for name in container['Names']]
+
+    def inspect(self, container_name):
+        """ Returns the state of the container or None if it does not exist """
+        container, status = self._request('GET', '/containers/%s/json' % urllib.parse.quote(container_name), ok_statuses=(200, 404))
+        return container['State'] if status == 200 else None
+
+    def stop(self, container_name, timeout=10):
+        self._request('POST', '/containers/%s/stop' % urllib.parse.quote(container_name), {'t': timeout}, ok_statuses=(204, 304, 404))
+
+    def gateway_ip(self):
+        """ Returns the gateway of the default bridge """
+        network, _ = self._request('GET', '/networks/bridge')
+        return network['IPAM']['Config'][0]['Gateway']
+
+    def image_exists(self, tag):
+        _, status = self._request('GET', '/images/%s/json' % urllib.parse.quote(tag), ok_statuses=(200, 404))
+        return status == 200
+
+    def image_remove(self, tag):
+        self._request('DELETE', '/images/%s' % urllib.parse.quote(tag), ok_statuses=(200, 404, 409))
+
+
+_docker_client = None
+
+
+def get_docker_client():
+    """Return the process-wide docker client, or None if the docker socket
+    cannot be used, the docker CLI being used instead
+    """
+    global _docker_client
+    if _docker_client is None:
+        client = DockerClient()
+        if os.access(client.socket_path, os.R_OK | os.W_OK):
+            _docker_client = client
+        else:
+            _logger.info('Docker socket %s not available, using the docker CLI', client.socket_path)
+            _docker_client = False
+    return _docker_client or None
+
+
+def _with_docker_client(api_method, *args):
+    """Call the docker client method, returns NotImplemented if the docker
+    CLI has to be used instead
+    """
+    client = get_docker_client()
+    if client:
+        try:
+            return getattr(client, api_method)(*args)
+        except (OSError, http.client.HTTPException, DockerApiError, ValueError, KeyError) as e:
+            _logger.warning('Docker api call %s failed, using the docker CLI: %s', api_method, e)
+    return NotImplemented
+
+
+def docker_overlay_mount(build_dir, dest, source):
+    """Return the docker mount of an overlay of source in dest, the writes
+    going to an upper dir of the build. The overlay is mounted by docker on
+    an anonymous volume, removed with the container.
+    """
+    overlay_dir = os.path.join(build_dir, '.overlay', dest.replace('/', '_'))
+    upper_dir = os.path.join(overlay_dir, 'upper')
+    work_dir = os.path.join(overlay_dir, 'work')
+    os.makedirs(upper_dir, exist_ok=True)
+    os.makedirs(work_dir, exist_ok=True)
+    return ','.join([
+        'type=volume',
+        'dst=/data/build/%s' % dest,
+        'volume-driver=local',
+        'volume-opt=type=overlay',
+        'volume-opt=device=overlay',
+        '"volume-opt=o=lowerdir=%s,upperdir=%s,workdir=%s"' % (source, upper_dir, work_dir),
+    ])
+
+
 def docker_stop(container_name, build_dir=None):
     """Stops the container named container_name"""
     container_name = sanitize_container_name(container_name)
     _logger.info('Stopping container %s', container_name)
     if build_dir:
         end_file = os.path.join(build_dir, 'end-%s' % container_name)
-        subprocess.run(['touch', end_file])
+        open(end_file, 'a').close()
     else:
         _logger.info('Stopping docker without defined build_dir')
-    subprocess.run(['docker', 'stop', container_name])
+    if _with_docker_client('stop', container_name) is NotImplemented:
+        subprocess.run(['docker', 'stop', container_name])
 
 def docker_is_running(container_name):
     container_name = sanitize_container_name(container_name)
+    state = _with_docker_client('inspect', container_name)
+    if state is not NotImplemented:
+        return bool(state and state['Running'])
     dinspect = subprocess.run(['docker', 'container', 'inspect', container_name], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
     return True if dinspect.returncode == 0 else False
 
@@ -208,20 +417,72 @@ def docker_clear_state(container_name, build_dir):
         os.remove(os.path.join(build_dir, 'start-%s' % container_name))
     if os.path.exists(os.path.join(build_dir, 'end-%s' % container_name)):
         os.remove(os.path.join(build_dir, 'end-%s' % container_name))
+    shutil.rmtree(os.path.join(build_dir, 'cgroup-%s' % container_name), ignore_errors=True)
+
+CGROUP_FILES = ['cpu.stat', 'memory.peak', 'io.stat', 'pids.peak']
+
+def _save_cgroup_cmd(container_name):
+    """Return the shell command copying the cgroup v2 counters of the container in the build dir"""
+    return 'mkdir -p cgroup-{name};for f in {files};do cat /sys/fs/cgroup/$f > cgroup-{name}/$f 2>/dev/null;done'.format(
+        name=container_name, files=' '.join(CGROUP_FILES))
+
+def docker_cgroup_stats(container_name, build_dir):
+    """Return the resources used by the container, read from the cgroup
+    counters saved when its command ended. Counters that are not available
+    (cgroup v1, older kernels or killed containers) are missing.
+    """
+    container_name = sanitize_container_name(container_name)
+    contents = {}
+    for cgroup_file in CGROUP_FILES:
+        path = os.path.join(build_dir, 'cgroup-%s' % container_name, cgroup_file)
+        if os.path.exists(path):
+            with open(path) as f:
+                contents[cgroup_file] = f.read().strip()
+    stats = {}
+    cpu = dict(line.split() for line in contents.get('cpu.stat', '').splitlines() if len(line.split()) == 2)
+    for key in ('usage', 'user', 'system'):
+        if cpu.get('%s_usec' % key, '').isdigit():
+            stats['cgroup.cpu_%s_sec' % key] = int(cpu['%s_usec' % key]) / 1e6
+    if contents.get('memory.peak', '').isdigit():
+        stats['cgroup.memory_peak_mb'] = int(contents['memory.peak']) / 1024 / 1024
+    if contents.get('pids.peak', '').isdigit():
+        stats['cgroup.pids_peak'] = int(contents['pids.peak'])
+    if contents.get('io.stat'):
+        io = {'rbytes': 0, 'wbytes': 0}
+        for line in contents['io.stat'].splitlines():
+            for counter in line.split()[1:]:
+                key, _, value = counter.partition('=')
+                if key in io and value.isdigit():
+                    io[key] += int(value)
+        stats['cgroup.io_read_mb'] = io['rbytes'] / 1024 / 1024
+        stats['cgroup.io_write_mb'] = io['wbytes'] / 1024 / 1024
+    return stats
+
+_gateway_ip = None
 
 def docker_get_gateway_ip():
-    """Return the host ip of the docker default bridge gateway"""
-    docker_net_inspect = subprocess.run(['docker', 'network', 'inspect', 'bridge'], stdout=subprocess.PIPE)
-    if docker_net_inspect.returncode != 0:
-        return None
-    if docker_net_inspect.stdout:
+    """Return the host ip of the docker default bridge gateway, cached as it
+    does not change"""
+    global _gateway_ip
+    if _gateway_ip:
+        return _gateway_ip
+    gateway_ip = _with_docker_client('gateway_ip')
+    if gateway_ip is NotImplemented:
+        docker_net_inspect = subprocess.run(['docker', 'network', 'inspect', 'bridge'], stdout=subprocess.PIPE)
+        if docker_net_inspect.returncode != 0 or not docker_net_inspect.stdout:
+            return None
         try:
-            return json.loads(docker_net_inspect.stdout)[0]['IPAM']['Config'][0]['Gateway']
+            gateway_ip = json.loads(docker_net_inspect.stdout)[0]['IPAM']['Config'][0]['Gateway']
         except KeyError:
             return None
+    _gateway_ip = gateway_ip
+    return _gateway_ip
 
 def docker_ps():
     """Return a list of running containers names"""
+    names = _with_docker_client('ps')
+    if names is not NotImplemented:
+        return names
     try:
         docker_ps = subprocess.run(['docker', 'ps', '--format', '{{.Names}}'], stderr=subprocess.DEVNULL, stdout=subprocess.PIPE)
     except FileNotFoundError:
@@ -231,6 +492,99 @@ def docker_ps():
         return []
     return docker_ps.stdout.decode().strip().split('\n')
 
+class DockerEventWatcher():
+    """ Follow the `docker events` stream and keep track of running containers
+
+    Containers started before the watcher are seeded from `docker ps`, later
+    transitions are recorded from the start/die events so that callers can
+    know if a container is still running without polling docker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = set()
+        self._seen = set()  # only used until the watcher is seeded
+        self._seeded = False
+        self._process = None
+        self._thread = None
+
+    def start(self):
+        cmd = [
+            'docker', 'events',
+            '--filter', 'type=container',
+            '--filter', 'event=start',
+            '--filter', 'event=die',
+            '--format', '{{json .}}',
+        ]
+        try:
+            self._process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            _logger.warning('Docker not found, cannot watch docker events')
+            return False
+        self._thread = threading.Thread(target=self._read_events, name='docker_events', daemon=True)
+        self._thread.start()
+        # events received after this point take precedence over the seed
+        with self._lock:
+            for name in docker_ps():
+                if name and name not in self._seen:
+                    self._running.add(name)
+            self._seen = set()
+            self._seeded = True
+        _logger.info('Watching docker events')
+        return True
+
+    def stop(self):
+        if self._process and self._process.poll() is None:
+            self._process.terminate()
+
+    def is_alive(self):
+        return bool(self._process and self._process.poll() is None and self._thread.is_alive())
+
+    def _read_events(self):
+        for line in self._process.stdout:
+            try:
+                event = json.loads(line)
+                name = event['Actor']['Attributes']['name']
+                action = event.get('status') or event.get('Action')
+            except (ValueError, KeyError):
+                _logger.warning('Unexpected docker event: %s', line)
+                continue
+            with self._lock:
+                if not self._seeded:
+                    self._seen.add(name)
+                if action == 'start':
+                    self._running.add(name)
+                elif action == 'die':
+                    self._running.discard(name)
+        _logger.warning('Docker events stream closed')
+
+    def is_running(self, container_name):
+        container_name = sanitize_container_name(container_name)
+        with self._lock:
+            return container_name in self._running
+
+
+_docker_event_watcher = None
+
+
+def start_docker_event_watcher():
+    """Start the process-wide docker events watcher"""
+    global _docker_event_watcher
+    if _docker_event_watcher and _docker_event_watcher.is_alive():
+        return _docker_event_watcher
+    watcher = DockerEventWatcher()
+    if watcher.start():
+        _docker_event_watcher = watcher
+    return _docker_event_watcher
+
+
+def get_docker_event_watcher():
+    """Return the docker events watcher if one is started and alive"""
+    if _docker_event_watcher and _docker_event_watcher.is_alive():
+        return _docker_event_watcher
+    return None
+
+
 def build(args):
     """Build container from CLI"""
     _logger.info('Building the base image container')
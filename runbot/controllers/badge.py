@@ -1,12 +1,48 @@
 # -*- coding: utf-8 -*-
 import hashlib
+import threading
+from collections import OrderedDict
 
 import werkzeug
-from matplotlib.font_manager import FontProperties
-from matplotlib.textpath import TextToPath
 
 from odoo.http import request, route, Controller
 
+# advance widths of DejaVu Sans printable ascii glyphs, in font units (2048 per em)
+DEJAVU_SANS_WIDTHS = {
+    ' ': 651, '!': 821, '"': 942, '#': 1716, '$': 1303, '%': 1946, '&': 1597, "'": 563,
+    '(': 799, ')': 799, '*': 1024, '+': 1716, ',': 651, '-': 739, '.': 651, '/': 690,
+    '0': 1303, '1': 1303, '2': 1303, '3': 1303, '4': 1303, '5': 1303, '6': 1303, '7': 1303,
+    '8': 1303, '9': 1303, ':': 690, ';': 690, '<': 1716, '=': 1716, '>': 1716, '?': 1087,
+    '@': 2048, 'A': 1401, 'B': 1405, 'C': 1430, 'D': 1577, 'E': 1294, 'F': 1178, 'G': 1587,
+    'H': 1540, 'I': 604, 'J': 604, 'K': 1343, 'L': 1141, 'M': 1767, 'N': 1532, 'O': 1612,
+    'P': 1235, 'Q': 1612, 'R': 1423, 'S': 1300, 'T': 1251, 'U': 1499, 'V': 1401, 'W': 2025,
+    'X': 1403, 'Y': 1251, 'Z': 1403, '[': 799, '\\': 690, ']': 799, '^': 1716, '_': 1024,
+    '`': 1024, 'a': 1255, 'b': 1300, 'c': 1126, 'd': 1300, 'e': 1260, 'f': 721, 'g': 1300,
+    'h': 1298, 'i': 569, 'j': 569, 'k': 1186, 'l': 569, 'm': 1995, 'n': 1298, 'o': 1253,
+    'p': 1300, 'q': 1300, 'r': 842, 's': 1067, 't': 803, 'u': 1298, 'v': 1212, 'w': 1675,
+    'x': 1212, 'y': 1212, 'z': 1075, '{': 1303, '|': 690, '}': 1303, '~': 1716,
+}
+FONT_SIZE = 11
+UNITS_PER_EM = 2048
+CACHE_SIZE = 1000
+
+# (repo_id, branch, theme, state): (etag, svg)
+_badge_cache = OrderedDict()
+# the cache is shared by the http worker threads
+_badge_cache_lock = threading.Lock()
+
+
+def text_width(s):
+    """ Width in pixels of s rendered in DejaVu Sans 11px """
+    if all(c in DEJAVU_SANS_WIDTHS for c in s):
+        return int(sum(DEJAVU_SANS_WIDTHS[c] for c in s) * FONT_SIZE / UNITS_PER_EM + 1)
+    # non ascii branch names are rare enough to pay for matplotlib
+    from matplotlib.font_manager import FontProperties
+    from matplotlib.textpath import TextToPath
+    fp = FontProperties(family='DejaVu Sans', size=FONT_SIZE)
+    w, h, d = TextToPath().get_text_width_height_descent(s, fp, False)
+    return int(w + 1)
+
 
 class RunbotBadge(Controller):
 
@@ -16,42 +52,62 @@ class RunbotBadge(Controller):
     ], type="http", auth="public", methods=['GET', 'HEAD'])
     def badge(self, repo_id, branch, theme='default'):
 
-        domain = [('repo_id', '=', repo_id),
-                  ('branch_id.branch_name', '=', branch),
-                  ('branch_id.sticky', '=', True),
-                  ('hidden', '=', False),
-                  ('parent_id', '=', False),
-                  ('global_state', 'in', ['testing', 'running', 'done']),
-                  ('global_result', 'not in', ['skipped', 'manually_killed']),
-                  ]
-
-        last_update = '__last_update'
-        builds = request.env['runbot.build'].sudo().search_read(
-            domain, ['global_state', 'global_result', 'build_age', last_update],
-            order='id desc', limit=1)
-
-        if not builds:
+        # same as searching the last build with sudo on domain
+        # repo_id, branch_id.branch_name, branch_id.sticky, hidden=False, parent_id=False,
+        # global_state in (testing, running, done), global_result not in (skipped, manually_killed)
+        request.env.cr.execute("""
+            SELECT bu.global_state, bu.global_result
+            FROM runbot_build bu
+            JOIN runbot_branch br ON (br.id = bu.branch_id)
+            WHERE bu.repo_id = %s
+            AND br.branch_name = %s
+            AND br.sticky
+            AND (bu.hidden = 'f' OR bu.hidden IS NULL)
+            AND bu.parent_id IS NULL
+            AND bu.global_state IN ('testing', 'running', 'done')
+            AND (bu.global_result NOT IN ('skipped', 'manually_killed') OR bu.global_result IS NULL)
+            ORDER BY bu.id DESC
+            LIMIT 1
+        """, [repo_id, branch])
+        row = request.env.cr.fetchone()
+
+        if not row:
             return request.not_found()
 
-        build = builds[0]
-        etag = request.httprequest.headers.get('If-None-Match')
-        retag = hashlib.md5(str(build[last_update]).encode()).hexdigest()
-
-        if etag == retag:
-            return werkzeug.wrappers.Response(status=304)
-
-        if build['global_state'] in ('testing', 'waiting'):
-            state = build['global_state']
+        global_state, global_result = row
+        if global_state in ('testing', 'waiting'):
+            state = global_state
             cache_factor = 1
         else:
             cache_factor = 2
-            if build['global_result'] == 'ok':
+            if global_result == 'ok':
                 state = 'success'
-            elif build['global_result'] == 'warn':
+            elif global_result == 'warn':
                 state = 'warning'
             else:
                 state = 'failed'
 
+        # the badge only depends on the key, so does the etag
+        key = (repo_id, branch, theme, state)
+        with _badge_cache_lock:
+            cached = _badge_cache.get(key)
+            if cached:
+                _badge_cache.move_to_end(key)
+        retag = cached[0] if cached else hashlib.md5(repr(key).encode()).hexdigest()
+        five_minutes = 5 * 60
+        headers = [
+            ('Content-Type', 'image/svg+xml'),
+            ('Cache-Control', 'max-age=%d' % (five_minutes * cache_factor,)),
+            ('ETag', retag),
+        ]
+
+        etag = request.httprequest.headers.get('If-None-Match')
+        if etag == retag:
+            return werkzeug.wrappers.Response(status=304, headers=headers)
+
+        if cached:
+            return request.make_response(cached[1], headers=headers)
+
         # from https://github.com/badges/shields/blob/master/colorscheme.json
         color = {
             'testing': "#dfb317",
@@ -61,11 +117,6 @@ class RunbotBadge(Controller):
             'warning': "#fe7d37",
         }[state]
 
-        def text_width(s):
-            fp = FontProperties(family='DejaVu Sans', size=11)
-            w, h, d = TextToPath().get_text_width_height_descent(s, fp, False)
-            return int(w + 1)
-
         class Text(object):
             __slot__ = ['text', 'color', 'width']
 
@@ -78,10 +129,9 @@ class RunbotBadge(Controller):
             'left': Text(branch, '#555'),
             'right': Text(state, color),
         }
-        five_minutes = 5 * 60
-        headers = [
-            ('Content-Type', 'image/svg+xml'),
-            ('Cache-Control', 'max-age=%d' % (five_minutes * cache_factor,)),
-            ('ETag', retag),
-        ]
-        return request.render("runbot.badge_" + theme, data, headers=headers)
+        svg = request.env['ir.ui.view'].render_template("runbot.badge_" + theme, data)
+        with _badge_cache_lock:
+            _badge_cache[key] = (retag, svg)
+            while len(_badge_cache) > CACHE_SIZE:
+                _badge_cache.popitem(last=False)
+        return request.make_response(svg, headers=headers)
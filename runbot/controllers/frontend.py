@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import operator
 import werkzeug
 from collections import OrderedDict
 
@@ -17,12 +16,20 @@ from odoo.exceptions import UserError
 
 class Runbot(Controller):
 
-    def _pending(self):
+    def _pending(self, aggregated=False):
+        """ :param aggregated: read the counts from the dashboard aggregates,
+        refreshed by the scheduler, instead of counting builds
+        """
         ICP = request.env['ir.config_parameter'].sudo().get_param
         warn = int(ICP('runbot.pending.warning', 5))
         crit = int(ICP('runbot.pending.critical', 12))
-        pending_count = request.env['runbot.build'].search_count([('local_state', '=', 'pending'), ('build_type', '!=', 'scheduled')])
-        scheduled_count = request.env['runbot.build'].search_count([('local_state', '=', 'pending'), ('build_type', '=', 'scheduled')])
+        if aggregated:
+            counts = request.env['runbot.dashboard']._get_build_counts()
+            pending_count = counts.get(('pending', False), 0)
+            scheduled_count = counts.get(('pending', True), 0)
+        else:
+            pending_count = request.env['runbot.build'].search_count([('local_state', '=', 'pending'), ('build_type', '!=', 'scheduled')])
+            scheduled_count = request.env['runbot.build'].search_count([('local_state', '=', 'pending'), ('build_type', '=', 'scheduled')])
         level = ['info', 'warning', 'danger'][int(pending_count > warn) + int(pending_count > crit)]
         return pending_count, level, scheduled_count
 
@@ -194,28 +201,13 @@ class Runbot(Controller):
 
     @route(['/runbot/dashboard'], type='http', auth="public", website=True)
     def dashboard(self, refresh=None):
-        cr = request.cr
         RB = request.env['runbot.build']
         repos = request.env['runbot.repo'].search([])   # respect record rules
 
-        cr.execute("""SELECT bu.id
-                        FROM runbot_branch br
-                        JOIN LATERAL (SELECT *
-                                        FROM runbot_build bu
-                                       WHERE bu.branch_id = br.id
-                                    ORDER BY id DESC
-                                       LIMIT 3
-                                     ) bu ON (true)
-                        JOIN runbot_repo r ON (r.id = br.repo_id)
-                       WHERE br.sticky
-                         AND br.repo_id in %s
-                    ORDER BY r.sequence, r.name, br.branch_name, bu.id DESC
-                   """, [tuple(repos._ids)])
-
-        builds = RB.browse(map(operator.itemgetter(0), cr.fetchall()))
-
-        count = RB.search_count
-        pending = self._pending()
+        dashboard = request.env['runbot.dashboard']
+        builds = RB.browse(dashboard._get_sticky_build_ids(repos.ids))
+
+        pending = self._pending(aggregated=True)
         qctx = {
             'refresh': refresh,
             'host_stats': [],
@@ -232,9 +224,9 @@ class Runbot(Controller):
                 r.update({
                     'name': repo.name,
                     'base': repo.base,
-                    'testing': count([('repo_id', '=', repo.id), ('local_state', '=', 'testing')]),
-                    'running': count([('repo_id', '=', repo.id), ('local_state', '=', 'running')]),
-                    'pending': count([('repo_id', '=', repo.id), ('local_state', '=', 'pending')]),
+                    'testing': dashboard._get_state_count('testing', repo_ids=repo.ids),
+                    'running': dashboard._get_state_count('running', repo_ids=repo.ids),
+                    'pending': dashboard._get_state_count('pending', repo_ids=repo.ids),
                 })
             b = r['branches'].setdefault(branch.id, {'name': branch.branch_name, 'builds': list()})
             b['builds'].append(build)
@@ -246,46 +238,23 @@ class Runbot(Controller):
                 qctx['host_stats'].append({
                     'fqdn': fqdn(),
                     'host': result['host'],
-                    'testing': count([('local_state', '=', 'testing'), ('host', '=', result['host'])]),
-                    'running': count([('local_state', '=', 'running'), ('host', '=', result['host'])]),
+                    'testing': dashboard._get_state_count('testing', host=result['host']),
+                    'running': dashboard._get_state_count('running', host=result['host']),
                 })
 
         return request.render("runbot.sticky-dashboard", qctx)
 
     def _glances_ctx(self):
         repos = request.env['runbot.repo'].search([])   # respect record rules
-        default_config_id = request.env.ref('runbot.runbot_build_config_default').id
-        query = """
-            SELECT split_part(r.name, ':', 2),
-                   br.branch_name,
-                   (array_agg(bu.global_result order by bu.id desc))[1]
-              FROM runbot_build bu
-              JOIN runbot_branch br on (br.id = bu.branch_id)
-              JOIN runbot_repo r on (r.id = br.repo_id)
-             WHERE br.sticky
-               AND br.repo_id in %s
-               AND (bu.hidden = 'f' OR bu.hidden IS NULL)
-               AND (
-                    bu.global_state in ('running', 'done')
-               )
-               AND bu.global_result not in ('skipped', 'manually_killed')
-               AND (bu.config_id = r.repo_config_id
-                    OR bu.config_id =  br.branch_config_id
-                    OR bu.config_id =  %s)
-          GROUP BY 1,2,r.sequence,br.id
-          ORDER BY r.sequence, (br.branch_name='master'), br.id
-        """
-        cr = request.env.cr
-        cr.execute(query, (tuple(repos.ids), default_config_id))
         ctx = OrderedDict()
-        for row in cr.fetchall():
+        for row in request.env['runbot.dashboard']._get_glances(repos.ids):
             ctx.setdefault(row[0], []).append(row[1:])
         return ctx
 
     @route('/runbot/glances', type='http', auth='public', website=True)
     def glances(self, refresh=None):
         glances_ctx = self._glances_ctx()
-        pending = self._pending()
+        pending = self._pending(aggregated=True)
         qctx = {
             'refresh': refresh,
             'pending_total': pending[0],
@@ -299,7 +268,7 @@ class Runbot(Controller):
             '/runbot/monitoring/<int:config_id>/<int:view_id>'], type='http', auth='user', website=True)
     def monitoring(self, config_id=None, view_id=None, refresh=None, **kwargs):
         glances_ctx = self._glances_ctx()
-        pending = self._pending()
+        pending = self._pending(aggregated=True)
         hosts_data = request.env['runbot.host'].search([])
 
         last_monitored = None
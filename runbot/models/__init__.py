@@ -5,6 +5,11 @@ from . import branch
 from . import build
 from . import event
 from . import build_dependency
+from . import build_port
+from . import build_artifact
+from . import db_template
+from . import docker_image
+from . import module_index
 from . import build_config
 from . import ir_cron
 from . import host
@@ -12,3 +17,4 @@ from . import build_error
 from . import build_stat
 from . import build_stat_regex
 from . import res_config_settings
+from . import dashboard
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import fnmatch
-import glob
 import logging
 import pwd
 import re
@@ -8,14 +7,14 @@ import shutil
 import subprocess
 import time
 import datetime
-from ..common import dt2time, fqdn, now, grep, local_pgadmin_cursor, s2human, Commit, dest_reg, os, list_local_dbs, pseudo_markdown
-from ..container import docker_build, docker_stop, docker_state, Command
+from ..common import dt2time, fqdn, now, grep, local_pgadmin_cursor, s2human, Commit, dest_reg, os, list_local_dbs, invalidate_local_dbs, pseudo_markdown
+from ..container import docker_build, docker_stop, docker_state, get_docker_event_watcher, Command
 from ..fields import JsonDictField
 from odoo.addons.runbot.models.repo import RunbotException
 from odoo import models, fields, api, registry
 from odoo.exceptions import UserError, ValidationError
 from odoo.http import request
-from odoo.tools import appdirs
+from odoo.tools import appdirs, table_exists
 from collections import defaultdict
 from psycopg2 import sql
 from subprocess import CalledProcessError
@@ -80,7 +79,11 @@ class runbot_build(models.Model):
     log_ids = fields.One2many('ir.logging', 'build_id', string='Logs')
     error_log_ids = fields.One2many('ir.logging', 'build_id', domain=[('level', 'in', ['WARNING', 'ERROR', 'CRITICAL'])], string='Error Logs')
     config_data = JsonDictField('Config Data')
+    fingerprint = fields.Char('Fingerprint', index=True, readonly=True, copy=False,
+                              help="Hash of the commit, config, extra params, config data and dependencies hashes, equal for duplicate builds")
     stat_ids = fields.One2many('runbot.build.stat', 'build_id', strings='Statistics values')
+    docker_image = fields.Char('Docker image', readonly=True, copy=False,
+                               help="Image having the build requirements installed, empty to install them at runtime in the base image")
 
     # state machine
 
@@ -300,49 +303,20 @@ class runbot_build(models.Model):
             for dep_vals in dep_create_vals:
                 self.env['runbot.build.dependency'].sudo().create(dep_vals)
 
+        build_id._update_fingerprint()
         if not self.env.context.get('force_rebuild') and not vals.get('build_type') == 'rebuild':
             # detect duplicate
-            duplicate_id = None
+            # Note: dependencies are only compared by hash, because the same hash could be found on
+            # 2 different branches (pr + branch) or on duplicate repos.
             domain = [
+                ('fingerprint', '=', build_id.fingerprint),
                 ('repo_id', 'in', (build_id.repo_id.duplicate_id.id, build_id.repo_id.id)),  # before, was only looking in repo.duplicate_id looks a little better to search in both
                 ('id', '!=', build_id.id),
-                ('name', '=', build_id.name),
                 ('duplicate_id', '=', False),
                 # ('build_type', '!=', 'indirect'),  # in case of performance issue, this little fix may improve performance a little but less duplicate will be detected when pushing an empty branch on repo with duplicates
                 '|', ('local_result', '=', False), ('local_result', '!=', 'skipped'),  # had to reintroduce False posibility for selections
-                ('config_id', '=', build_id.config_id.id),
-                ('extra_params', '=', build_id.extra_params),
-                ('config_data', '=', build_id.config_data or False),
             ]
-            candidates = self.search(domain)
-
-            nb_deps = len(build_id.dependency_ids)
-            if candidates and nb_deps:
-                # check that all depedencies are matching.
-
-                # Note: We avoid to compare closest_branch_id, because the same hash could be found on
-                # 2 different branches (pr + branch).
-                # But we may want to ensure that the hash is comming from the right repo, we dont want to compare community
-                # hash with enterprise hash.
-                # this is unlikely to happen so branch comparaison is disabled
-                self.env.cr.execute("""
-                    SELECT DUPLIDEPS.build_id
-                    FROM runbot_build_dependency as DUPLIDEPS
-                    JOIN runbot_build_dependency as BUILDDEPS
-                    ON BUILDDEPS.dependency_hash = DUPLIDEPS.dependency_hash
-                    AND BUILDDEPS.build_id = %s
-                    AND DUPLIDEPS.build_id in %s
-                    GROUP BY DUPLIDEPS.build_id
-                    HAVING COUNT(DUPLIDEPS.*) = %s
-                    ORDER BY DUPLIDEPS.build_id  -- remove this in case of performance issue, not so usefull
-                    LIMIT 1
-                """, (build_id.id, tuple(candidates.ids), nb_deps))
-                filtered_candidates_ids = self.env.cr.fetchall()
-
-                if filtered_candidates_ids:
-                    duplicate_id = filtered_candidates_ids[0]
-            else:
-                duplicate_id = candidates[0].id if candidates else False
+            duplicate_id = self.search(domain, limit=1).id
 
             if duplicate_id:
                 extra_info.update({'local_state': 'duplicate', 'duplicate_id': duplicate_id})
@@ -361,8 +335,40 @@ class runbot_build(models.Model):
 
         if build_id.local_state == 'duplicate' and build_id.duplicate_id.global_state in ('running', 'done'):
             build_id._github_status()
+        if build_id.local_state == 'pending':
+            build_id._notify_scheduler()
         return build_id
 
+    _fingerprint_query = """
+        UPDATE runbot_build bu
+        SET fingerprint = md5(concat_ws('|',
+            bu.name,
+            bu.config_id,
+            COALESCE(bu.extra_params, ''),
+            COALESCE(bu.config_data::text, ''),
+            (
+                SELECT string_agg(dep.dependency_hash, ',' ORDER BY dep.dependency_hash)
+                FROM runbot_build_dependency dep
+                WHERE dep.build_id = bu.id
+            )
+        ))
+        WHERE %s"""
+
+    def init(self):
+        # builds created before the fingerprint existed, dependencies may not
+        # be initialized yet on install but there are no builds then
+        if table_exists(self._cr, 'runbot_build_dependency'):
+            self._cr.execute(self._fingerprint_query % "bu.fingerprint IS NULL")
+
+    def _update_fingerprint(self):
+        """ Computes the fingerprint of the builds, in one query for all of them """
+        if not self:
+            return
+        self.flush()
+        self.env['runbot.build.dependency'].flush()
+        self.env.cr.execute(self._fingerprint_query % "bu.id IN %s", [tuple(self.ids)])
+        self.invalidate_cache(['fingerprint'], self.ids)
+
     def write(self, values):
         # some validation to ensure db consistency
         if 'local_state' in values:
@@ -375,10 +381,22 @@ class runbot_build(models.Model):
         res = super(runbot_build, self).write(values)
         for build in self:
             assert bool(not build.duplicate_id) ^ (build.local_state == 'duplicate')  # don't change duplicate state without removing duplicate id.
+        if any(field in values for field in ('name', 'config_id', 'extra_params', 'config_data')):
+            self._update_fingerprint()
+        if values.get('local_state') == 'done':
+            self.env['runbot.build.port']._release(self)
         if 'log_counter' in values: # not 100% usefull but more correct ( see test_ir_logging)
             self.flush()
+        if values.get('requested_action') or values.get('local_state') == 'pending':
+            self._notify_scheduler()
         return res
 
+    def _notify_scheduler(self):
+        """ Wakes up the builders listening on the runbot_build channel, once
+        the transaction is committed
+        """
+        self.env.cr.execute("NOTIFY runbot_build")
+
     def update_build_end(self):
         for build in self:
             build.build_end = now()
@@ -574,9 +592,10 @@ class runbot_build(models.Model):
 
         existing_db = list_local_dbs(additionnal_conditions=additionnal_conditions)
 
-        for db in _filter(dest_list=existing_db, label='db'):
-            self._logger('Removing database')
-            self._local_pg_dropdb(db)
+        dbs = list(_filter(dest_list=existing_db, label='db'))
+        if dbs:
+            _logger.debug('Removing databases %s', ', '.join(dbs))
+            self._local_pg_dropdb(*dbs)
 
         root = self.env['runbot.repo']._root()
         builds_dir = os.path.join(root, 'build')
@@ -587,32 +606,56 @@ class runbot_build(models.Model):
             dests = _filter(dest_list=os.listdir(builds_dir), label='workspace')
 
         for dest in dests:
-            build_dir = os.path.join(builds_dir, dest)
-            for f in os.listdir(build_dir):
-                path = os.path.join(build_dir, f)
-                if os.path.isdir(path) and f not in ('logs', 'tests'):
-                    shutil.rmtree(path)
-                elif f == 'logs':
-                    log_path = os.path.join(build_dir, 'logs')
-                    for f in os.listdir(log_path):
-                        log_file_path = os.path.join(log_path, f)
-                        if os.path.isdir(log_file_path):
-                            shutil.rmtree(log_file_path)
-                        elif not f.endswith('.txt'):
-                            os.unlink(log_file_path)
-
-    def _find_port(self):
-        # currently used port
-        ids = self.search([('local_state', 'not in', ['pending', 'done']), ('host', '=', fqdn())])
-        ports = set(i['port'] for i in ids.read(['port']))
-
-        # starting port
-        icp = self.env['ir.config_parameter']
-        port = int(icp.get_param('runbot.runbot_starting_port', default=2000))
-
-        # find next free port
-        while port in ports:
-            port += 3
+            self._clean_workspace(os.path.join(builds_dir, dest))
+
+    def _clean_workspace(self, build_dir):
+        """ Remove everything but the text logs and tests of a build directory """
+        overlay_path = os.path.join(build_dir, '.overlay')
+        if os.path.isdir(overlay_path):
+            # the kernel creates the work dir of the overlays as root without
+            # any permission, it can only be removed as a whole once empty
+            for f in os.listdir(overlay_path):
+                if os.path.isdir(os.path.join(overlay_path, f, 'work', 'work')):
+                    os.rmdir(os.path.join(overlay_path, f, 'work', 'work'))
+        for f in os.listdir(build_dir):
+            path = os.path.join(build_dir, f)
+            if os.path.isdir(path) and f not in ('logs', 'tests'):
+                shutil.rmtree(path)
+            elif f == 'logs':
+                log_path = os.path.join(build_dir, 'logs')
+                for f in os.listdir(log_path):
+                    log_file_path = os.path.join(log_path, f)
+                    if os.path.isdir(log_file_path):
+                        shutil.rmtree(log_file_path)
+                    elif not f.endswith('.txt'):
+                        os.unlink(log_file_path)
+
+    def _local_cleanup_expired(self, limit=100, delay=0.1):
+        """ Remove the expired databases and workspaces recorded in the
+        artifacts inventory of the host, waiting delay seconds between two
+        workspaces to spare the disks
+        """
+        expired = self.env['runbot.build.artifact']._pop_expired(fqdn(), limit)
+        dbs = [name for kind, name in expired if kind == 'database']
+        if dbs:
+            _logger.debug('Removing databases %s', ', '.join(dbs))
+            self._local_pg_dropdb(*dbs)
+        builds_dir = os.path.join(self.env['runbot.repo']._root(), 'build')
+        for kind, name in expired:
+            if kind == 'workspace' and os.path.isdir(os.path.join(builds_dir, name)):
+                self._clean_workspace(os.path.join(builds_dir, name))
+                time.sleep(delay)
+        # the artifacts are only forgotten once they are removed
+        self.env.cr.commit()
+        return len(expired)
+
+    def _claim_port(self, port=None):
+        """ Leases a free port of the build host, see runbot.build.port """
+        self.ensure_one()
+        self.flush(['host'])
+        port = self.env['runbot.build.port']._claim(self, port)
+        if not port:
+            raise UserError("No free port on host %s for build %s" % (self.host, self.id))
         return port
 
     def _logger(self, *l):
@@ -633,7 +676,7 @@ class runbot_build(models.Model):
                 raise UserError("Build %s does not have correct host" % build.id)
             # allocate port and schedule first job
             values = {
-                'port': self._find_port(),
+                'port': build._claim_port(),
                 'job_start': now(),
                 'build_start': now(),
                 'job_end': False,
@@ -648,6 +691,7 @@ class runbot_build(models.Model):
                 # notify pending build - avoid confusing users by saying nothing
                 build._github_status()
                 os.makedirs(build._path('logs'), exist_ok=True)
+                self.env['runbot.build.artifact']._register(build, 'workspace', build.dest)
             except Exception:
                 _logger.exception('Failed initiating build %s', build.dest)
                 build._log('_schedule', 'Failed initiating build')
@@ -666,6 +710,8 @@ class runbot_build(models.Model):
 
             if build.requested_action == 'wake_up':
                 if docker_state(build._get_docker_name(), build._path()) == 'RUNNING':
+                    if not self.env['runbot.build.port']._claim(build, build.port):
+                        build._log('wake_up', 'Port %s is leased to another build' % build.port, level='WARNING')
                     build.write({'requested_action': False, 'local_state': 'running'})
                     build._log('wake_up', 'Waking up failed, **docker is already running**', log_type='markdown', level='SEPARATOR')
                 elif not os.path.exists(build._path()):
@@ -675,7 +721,7 @@ class runbot_build(models.Model):
                     try:
                         log_path = build._path('logs', 'wake_up.txt')
 
-                        port = self._find_port()
+                        port = build._claim_port()
                         build.write({
                             'job_start': now(),
                             'job_end': False,
@@ -693,9 +739,36 @@ class runbot_build(models.Model):
                         build.write({'requested_action': False, 'local_state': 'done'})
                 continue
 
+    def _get_step_timeout(self):
+        self.ensure_one()
+        icp = self.env['ir.config_parameter']
+        return min(self.active_step.cpu_limit, int(icp.get_param('runbot.runbot_timeout', default=10000)))
+
+    def _docker_state(self):
+        """Return the state of the build's current container, without polling
+        docker if the events watcher knows the container is running"""
+        self.ensure_one()
+        docker_name = self._get_docker_name()
+        watcher = get_docker_event_watcher()
+        if watcher and watcher.is_running(docker_name):
+            return 'RUNNING'
+        return docker_state(docker_name, self._path())
+
+    def _requires_scheduling(self, is_running):
+        """Return False if the build container is known to be running and
+        nothing else (timeout, failfast) needs the scheduler attention"""
+        self.ensure_one()
+        if not is_running(self._get_docker_name()):
+            return True
+        if self.local_state == 'testing':
+            if self.triggered_result and not self.active_step.ignore_triggered_result:
+                if self._get_worst_result([self.triggered_result, self.local_result]) != self.local_result:
+                    return True
+            return self.job_time > self._get_step_timeout()
+        return False
+
     def _schedule(self):
         """schedule the build"""
-        icp = self.env['ir.config_parameter']
         for build in self:
             if build.local_state not in ['testing', 'running']:
                 raise UserError("Build %s is not testing/running: %s" % (build.id, build.local_state))
@@ -707,9 +780,9 @@ class runbot_build(models.Model):
                         build.local_result = build.triggered_result
                         build._github_status()  # failfast
             # check if current job is finished
-            _docker_state = docker_state(build._get_docker_name(), build._path())
+            _docker_state = build._docker_state()
             if _docker_state == 'RUNNING':
-                timeout = min(build.active_step.cpu_limit, int(icp.get_param('runbot.runbot_timeout', default=10000)))
+                timeout = build._get_step_timeout()
                 if build.local_state != 'running' and build.job_time > timeout:
                     build._log('_schedule', '%s time exceeded (%ss)' % (build.active_step.name if build.active_step else "?", build.job_time))
                     build._kill(result='killed')
@@ -742,6 +815,7 @@ class runbot_build(models.Model):
 
             # compute statistics before starting next job
             build.active_step._make_stats(build)
+            build.active_step._make_resource_stats(build)
 
             build.active_step.log_end(build)
 
@@ -796,12 +870,8 @@ class runbot_build(models.Model):
         return commit._source_path('openerp', *path)
 
     def _get_available_modules(self, commit):
-        for manifest_file_name in commit.repo.manifest_files.split(','):  # '__manifest__.py' '__openerp__.py'
-            for addons_path in (commit.repo.addons_paths or '').split(','):  # '' 'addons' 'odoo/addons'
-                sep = os.path.join(addons_path, '*')
-                for manifest_path in glob.glob(commit._source_path(sep, manifest_file_name)):
-                    module = os.path.basename(os.path.dirname(manifest_path))
-                    yield (addons_path, module, manifest_file_name)
+        for module in self.env['runbot.module.index']._get_modules(commit):
+            yield (module['addons_path'], module['name'], module['manifest'])
 
     def _docker_source_folder(self, commit):
         # in case some build have commits with the same repo name (ex: foo/bar, foo-ent/bar)
@@ -867,26 +937,35 @@ class runbot_build(models.Model):
 
         return sorted(modules_to_install)
 
-    def _local_pg_dropdb(self, dbname):
+    def _local_pg_dropdb(self, *dbnames):
+        if not dbnames:
+            return
         with local_pgadmin_cursor() as local_cr:
             pid_col = 'pid' if local_cr.connection.server_version >= 90200 else 'procpid'
-            query = 'SELECT pg_terminate_backend({}) FROM pg_stat_activity WHERE datname=%s'.format(pid_col)
-            local_cr.execute(query, [dbname])
-            local_cr.execute('DROP DATABASE IF EXISTS "%s"' % dbname)
+            query = 'SELECT pg_terminate_backend({}) FROM pg_stat_activity WHERE datname IN %s'.format(pid_col)
+            local_cr.execute(query, [tuple(dbnames)])
+            # DROP DATABASE cannot run in a transaction block, thus not in a multi-statement query
+            for dbname in dbnames:
+                local_cr.execute('DROP DATABASE IF EXISTS "%s"' % dbname)
+        invalidate_local_dbs()
         # cleanup filestore
         datadir = appdirs.user_data_dir()
-        paths = [os.path.join(datadir, pn, 'filestore', dbname) for pn in 'OpenERP Odoo'.split()]
+        paths = [os.path.join(datadir, pn, 'filestore', dbname) for pn in 'OpenERP Odoo'.split() for dbname in dbnames]
         cmd = ['rm', '-rf'] + paths
         _logger.debug(' '.join(cmd))
         subprocess.call(cmd)
 
-    def _local_pg_createdb(self, dbname):
+    def _local_pg_createdb(self, dbname, template=None):
         icp = self.env['ir.config_parameter']
-        db_template = icp.get_param('runbot.runbot_db_template', default='template1')
+        db_template = template or icp.get_param('runbot.runbot_db_template', default='template1')
         self._local_pg_dropdb(dbname)
         _logger.debug("createdb %s", dbname)
         with local_pgadmin_cursor() as local_cr:
             local_cr.execute(sql.SQL("""CREATE DATABASE {} TEMPLATE %s LC_COLLATE 'C' ENCODING 'unicode'""").format(sql.Identifier(dbname)), (db_template,))
+        invalidate_local_dbs()
+        for build in self:
+            if dbname.startswith('%s-' % build.dest):
+                self.env['runbot.build.artifact']._register(build, 'database', dbname)
 
     def _log(self, func, message, level='INFO', log_type='runbot', path='runbot'):
         self.ensure_one()
@@ -904,20 +983,21 @@ class runbot_build(models.Model):
 
     def _kill(self, result=None):
         host = fqdn()
-        for build in self:
-            if build.host != host:
-                continue
+        builds = self.filtered(lambda build: build.host == host)
+        if not builds:
+            return
+        for build in builds:
             build._log('kill', 'Kill build %s' % build.dest)
             docker_stop(build._get_docker_name(), build._path())
-            v = {'local_state': 'done', 'requested_action': False, 'active_step': False, 'duplicate_id': False, 'job_end': now()}  # what if duplicate? state done?
-            if not build.build_end:
-                v['build_end'] = now()
-            if result:
-                v['local_result'] = result
-            build.write(v)
-            self.env.cr.commit()
+        builds.filtered(lambda build: not build.build_end).write({'build_end': now()})
+        v = {'local_state': 'done', 'requested_action': False, 'active_step': False, 'duplicate_id': False, 'job_end': now()}  # what if duplicate? state done?
+        if result:
+            v['local_result'] = result
+        builds.write(v)
+        self.env.cr.commit()
+        for build in builds:
             build._github_status()
-            self.invalidate_cache()
+        self.invalidate_cache()
 
     def _ask_kill(self, lock=True, message=None):
         if lock:
@@ -987,7 +1067,8 @@ class runbot_build(models.Model):
         python_params = python_params or []
         py_version = py_version if py_version is not None else build._get_py_version()
         pres = []
-        for commit in self._get_all_commit():
+        # requirements are already installed in the build image if it has one
+        for commit in self._get_all_commit() if not self.docker_image else []:
             if os.path.isfile(commit._source_path('requirements.txt')):
                 repo_dir = self._docker_source_folder(commit)
                 requirement_path = os.path.join(repo_dir, 'requirements.txt')
@@ -1117,6 +1198,23 @@ class runbot_build(models.Model):
         new_step = step_ids[next_index]  # job to do, state is job_state (testing or running)
         return {'active_step': new_step.id, 'local_state': new_step._step_state()}
 
+    def _sources_overlay(self):
+        """ Whether the sources are mounted with a writable overlay instead of read only """
+        icp = self.env['ir.config_parameter'].sudo()
+        return icp.get_param('runbot.runbot_sources_mount', default='readonly') == 'overlay'
+
+    def _acquire_docker_image(self, py_version):
+        """ Runs the build in an image having its requirements installed if
+        one is ready on the host
+        """
+        self.ensure_one()
+        icp = self.env['ir.config_parameter'].sudo()
+        if not self.docker_image and icp.get_param('runbot.runbot_docker_images'):
+            self.docker_image = self.env['runbot.docker.image']._acquire(self, py_version)
+            if self.docker_image:
+                self._log('docker_image', 'Using image %s with the requirements installed' % self.docker_image)
+        return self.docker_image
+
     def _get_py_version(self):
         """return the python name to use from build instance"""
         (server_commit, server_file) = self._get_server_info()
@@ -0,0 +1,62 @@
+import logging
+
+from odoo import models, fields
+
+_logger = logging.getLogger(__name__)
+
+
+class RunbotBuildArtifact(models.Model):
+    _name = "runbot.build.artifact"
+    _description = "Build artifact on a host"
+    _log_access = False
+    _order = 'id'
+
+    _sql_constraints = [('host_kind_name_unique', 'unique (host, kind, name)', 'An artifact can only be recorded once per host')]
+
+    host = fields.Char('Host', required=True, index=True)
+    build_id = fields.Many2one('runbot.build', 'Build', ondelete='set null', index=True)
+    kind = fields.Selection([('database', 'Database'), ('workspace', 'Workspace')], required=True)
+    name = fields.Char('Name', required=True, help="Database name or build directory")
+
+    def _register(self, build, kind, name):
+        """ Records an artifact of the build on its host, idempotent """
+        self.env.cr.execute("""
+            INSERT INTO runbot_build_artifact (host, build_id, kind, name)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (host, kind, name) DO UPDATE SET build_id = EXCLUDED.build_id
+        """, [build.host, build.id, kind, name])
+
+    def _pop_expired(self, host, limit):
+        """ Removes from the inventory and returns the (kind, name) of the
+        expired artifacts of the host, oldest first. Artifacts expire once
+        their build is done and its gc date is past, the gc date being
+        computed here like runbot.build gc_date so that it follows the
+        db_gc_days settings. Artifacts of deleted builds are expired.
+        """
+        icp = self.env['ir.config_parameter']
+        self.env['runbot.build'].flush(['local_state', 'job_end', 'parent_id', 'gc_delay'])
+        self.env.cr.execute("""
+            DELETE FROM runbot_build_artifact
+            WHERE id IN (
+                SELECT artifact.id
+                FROM runbot_build_artifact artifact
+                LEFT JOIN runbot_build build ON build.id = artifact.build_id
+                CROSS JOIN LATERAL (
+                    SELECT COALESCE(build.job_end, build.create_date) + interval '1 day' * (
+                        CASE WHEN build.parent_id IS NULL THEN %(days_main)s ELSE %(days_child)s END + COALESCE(build.gc_delay, 0)
+                    ) AS gc_date
+                ) expiry
+                WHERE artifact.host = %(host)s
+                AND (build.id IS NULL OR (build.local_state = 'done' AND expiry.gc_date < (now() AT TIME ZONE 'UTC')))
+                ORDER BY expiry.gc_date NULLS FIRST
+                LIMIT %(limit)s
+                FOR UPDATE OF artifact SKIP LOCKED
+            )
+            RETURNING kind, name
+        """, {
+            'host': host,
+            'limit': limit,
+            'days_main': int(icp.get_param('runbot.db_gc_days', default=30)),
+            'days_child': int(icp.get_param('runbot.db_gc_days_child', default=15)),
+        })
+        return self.env.cr.fetchall()
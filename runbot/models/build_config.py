@@ -4,8 +4,8 @@ import logging
 import re
 import shlex
 import time
-from ..common import now, grep, time2str, rfind, Commit, s2human, os
-from ..container import docker_run, docker_get_gateway_ip, Command
+from ..common import now, grep, time2str, rfind, scan_log, Commit, s2human, os
+from ..container import docker_run, docker_get_gateway_ip, docker_cgroup_stats, Command
 from odoo import models, fields, api
 from odoo.exceptions import UserError, ValidationError
 from odoo.tools.safe_eval import safe_eval, test_python_expr
@@ -57,6 +57,20 @@ class Config(models.Model):
         self.ensure_one()
         return [ordered_step.step_id for ordered_step in self.step_order_ids.sorted('sequence')]
 
+    def _get_cost(self):
+        """ Returns the (cpu, memory, db connections) needed by a build of this
+        config, the highest cost of its steps since they run one at a time
+        """
+        self.ensure_one()
+        steps = self.step_ids()
+        if not steps:
+            return (0, 0, 0)
+        return (
+            max(step.cpu_cost for step in steps),
+            max(step.memory_cost for step in steps),
+            max(step.db_connection_cost for step in steps),
+        )
+
     def _check_step_ids_order(self):
         install_job = False
         step_ids = self.step_ids()
@@ -110,6 +124,8 @@ class ConfigStep(models.Model):
     install_modules = fields.Char('Modules to install', help="List of module patterns to install, use * to install all available modules, prefix the pattern with dash to remove the module.", default='')
     db_name = fields.Char('Db Name', compute='_compute_db_name', inverse='_inverse_db_name', track_visibility='onchange')
     cpu_limit = fields.Integer('Cpu limit', default=3600, track_visibility='onchange')
+    db_template_modules = fields.Char('Template modules', track_visibility='onchange',
+                                      help="Comma separated list of modules installed in a pooled template database the build database is created from, to avoid installing them again in each build")
     coverage = fields.Boolean('Coverage', default=False, track_visibility='onchange')
     flamegraph = fields.Boolean('Allow Flamegraph', default=False, track_visibility='onchange')
     test_enable = fields.Boolean('Test enable', default=True, track_visibility='onchange')
@@ -130,6 +146,18 @@ class ConfigStep(models.Model):
     force_build = fields.Boolean("As a forced rebuild, don't use duplicate detection", default=False, track_visibility='onchange')
     force_host = fields.Boolean('Use same host as parent for children', default=False, track_visibility='onchange')  # future
     make_orphan = fields.Boolean('No effect on the parent result', help='Created build result will not affect parent build result', default=False, track_visibility='onchange')
+    # resources scheduler
+    cpu_cost = fields.Float('Cpu cost', default=1, track_visibility='onchange', help="Number of cpus used by a build during this step")
+    memory_cost = fields.Integer('Memory cost (MB)', default=2048, track_visibility='onchange', help="Memory used by a build during this step")
+    db_connection_cost = fields.Integer('Db connections cost', default=2, track_visibility='onchange', help="Postgresql connections used by a build during this step")
+    memory_limit = fields.Integer('Memory limit (MB)', default=0, track_visibility='onchange', help="Memory the container of the step can use, 0 for no limit")
+    cpus_limit = fields.Float('Cpus limit', default=0, track_visibility='onchange', help="Number of cpus the container of the step can use, 0 for no limit")
+
+    @api.onchange('job_type')
+    def _onchange_job_type(self):
+        if self.job_type == 'create_build':
+            # only waits for the children
+            self.cpu_cost = self.memory_cost = self.db_connection_cost = 0
 
     @api.constrains('python_code')
     def _check_python_code(self):
@@ -251,13 +279,23 @@ class ConfigStep(models.Model):
                 })
                 build._log('create_build', 'created with config %s' % create_config.name, log_type='subbuild', path=str(children.id))
 
+    def _docker_run_python(self, build):
+        """ docker_run of the python steps, running like the other steps """
+        def run(*args, **kwargs):
+            kwargs.setdefault('image', build.docker_image)
+            kwargs.setdefault('memory_limit', self.memory_limit)
+            kwargs.setdefault('cpus', self.cpus_limit)
+            kwargs.setdefault('overlay', build._sources_overlay())
+            return docker_run(*args, **kwargs)
+        return run
+
     def make_python_ctx(self, build):
         return {
             'self': self,
             'fields': fields,
             'models': models,
             'build': build,
-            'docker_run': docker_run,
+            'docker_run': self._docker_run_python(build),
             '_logger': _logger,
             'log_path': build._path('logs', '%s.txt' % self.name),
             'glob': glob.glob,
@@ -298,6 +336,7 @@ class ConfigStep(models.Model):
         # adjust job_end to record an accurate job_20 job_time
         build._log('run', 'Start running build %s' % build.dest)
         # run server
+        build._acquire_docker_image(build._get_py_version())
         cmd = build._cmd(local_only=False)
         if os.path.exists(build._get_server_commit()._source_path('addons/im_livechat')):
             cmd += ["--workers", "2"]
@@ -328,7 +367,7 @@ class ConfigStep(models.Model):
         build_port = build.port
         self.env.cr.commit()  # commit before docker run to be 100% sure that db state is consistent with dockers
         self.invalidate_cache()
-        res = docker_run(cmd, log_path, build_path, docker_name, exposed_ports=[build_port, build_port + 1], ro_volumes=exports)
+        res = docker_run(cmd, log_path, build_path, docker_name, exposed_ports=[build_port, build_port + 1], ro_volumes=exports, image=build.docker_image, memory_limit=self.memory_limit, cpus=self.cpus_limit, overlay=build._sources_overlay())
         build.repo_id._reload_nginx()
         return res
 
@@ -347,15 +386,31 @@ class ConfigStep(models.Model):
             python_params = ['-m', 'coverage', 'run', '--branch', '--source', '/data/build'] + coverage_extra_params
         elif self.flamegraph:
             python_params = ['-m', 'flamegraph', '-o', self._perfs_data_path()]
+        build._acquire_docker_image(py_version)
         cmd = build._cmd(python_params, py_version, sub_command=self.sub_command)
+        extra_params = build.extra_params or self.extra_params or ''
         # create db if needed
         db_suffix = build.config_data.get('db_name') or self.db_name
         db_name = "%s-%s" % (build.dest, db_suffix)
         if self.create_db:
-            build._local_pg_createdb(db_name)
+            template = self.env['runbot.db.template']
+            if self.db_template_modules and not extra_params:
+                template = template._acquire(build, self.db_template_modules, py_version)
+            if template.state == 'ready':
+                build._log('install', 'Creating database from template %s' % template.name)
+                build._local_pg_createdb(db_name, template=template.name)
+                template._copy_filestore(build, db_name)
+            elif template:
+                build._local_pg_dropdb(db_name)
+                build._local_pg_createdb(template.name)
+                db_template = self.env['ir.config_parameter'].get_param('runbot.runbot_db_template', default='template1')
+                odoo_cmd = build._cmd(py_version=py_version, sub_command=self.sub_command).cmd
+                db_user = dict(cmd.config_tuples)['db_user']  # the same role as odoo
+                cmd.pres.append(template._populate_commands(build, odoo_cmd, db_name, db_template, db_user))
+            else:
+                build._local_pg_createdb(db_name)
         cmd += ['-d', db_name]
         # list module to install
-        extra_params = build.extra_params or self.extra_params or ''
         if mods and '-i' not in extra_params:
             cmd += ['-i', mods]
         config_path = build._server("tools/config.py")
@@ -411,7 +466,7 @@ class ConfigStep(models.Model):
         max_timeout = int(self.env['ir.config_parameter'].get_param('runbot.runbot_timeout', default=10000))
         timeout = min(self.cpu_limit, max_timeout)
         env_variables = self.additionnal_env.split(',') if self.additionnal_env else []
-        return docker_run(cmd, log_path, build._path(), build._get_docker_name(), cpu_limit=timeout, ro_volumes=exports, env_variables=env_variables)
+        return docker_run(cmd, log_path, build._path(), build._get_docker_name(), cpu_limit=timeout, ro_volumes=exports, env_variables=env_variables, image=build.docker_image, memory_limit=self.memory_limit, cpus=self.cpus_limit, overlay=build._sources_overlay())
 
     def log_end(self, build):
         if self.job_type == 'create_build':
@@ -474,6 +529,8 @@ class ConfigStep(models.Model):
 
     def _make_results(self, build):
         build_values = {}
+        if self.job_type == 'install_odoo' and self.db_template_modules:
+            self.env['runbot.db.template']._check_populated(build)
         log_time = self._get_log_last_write(build)
         if log_time:
             build_values['job_end'] = log_time
@@ -511,39 +568,53 @@ class ConfigStep(models.Model):
             build._log('coverage_result', 'Coverage file not found', level='WARNING')
         return build_values
 
-    def _check_log(self, build):
+    def _get_log_patterns(self):
+        """ Patterns searched in the step log file, as a dict of name: regex """
+        return {
+            'module_loaded': re.escape('.modules.loading: Modules loaded.'),
+            'error': _re_error,
+            'warning': _re_warning,
+            'build_ended': re.escape('Initiating shutdown'),
+        }
+
+    def _scan_log(self, build):
+        """ Search all the log patterns in a single read of the log file
+        returns the set of names of the patterns found
+        """
+        log_path = build._path('logs', '%s.txt' % self.name)
+        if not os.path.isfile(log_path):
+            return set()
+        found, timings = scan_log(log_path, self._get_log_patterns())
+        _logger.info('Log checkers timings for %s: %s', build.dest, ', '.join('%s: %.3fs' % timing for timing in timings.items()))
+        return found
+
+    def _check_log(self, build, found):
         log_path = build._path('logs', '%s.txt' % self.name)
         if not os.path.isfile(log_path):
             build._log('_make_tests_results', "Log file not found at the end of test job", level="ERROR")
             return 'ko'
         return 'ok'
 
-    def _check_module_loaded(self, build):
-        log_path = build._path('logs', '%s.txt' % self.name)
-        if not grep(log_path, ".modules.loading: Modules loaded."):
+    def _check_module_loaded(self, build, found):
+        if 'module_loaded' not in found:
             build._log('_make_tests_results', "Modules loaded not found in logs", level="ERROR")
             return 'ko'
         return 'ok'
 
-    def _check_error(self, build, regex=None):
-        log_path = build._path('logs', '%s.txt' % self.name)
-        regex = regex or _re_error
-        if rfind(log_path, regex):
+    def _check_error(self, build, found):
+        if 'error' in found:
             build._log('_make_tests_results', 'Error or traceback found in logs', level="ERROR")
             return 'ko'
         return 'ok'
 
-    def _check_warning(self, build, regex=None):
-        log_path = build._path('logs', '%s.txt' % self.name)
-        regex = regex or _re_warning
-        if rfind(log_path, regex):
+    def _check_warning(self, build, found):
+        if 'warning' in found:
             build._log('_make_tests_results', 'Warning found in logs', level="WARNING")
             return 'warn'
         return 'ok'
 
-    def _check_build_ended(self, build):
-        log_path = build._path('logs', '%s.txt' % self.name)
-        if not grep(log_path, "Initiating shutdown"):
+    def _check_build_ended(self, build, found):
+        if 'build_ended' not in found:
             build._log('_make_tests_results', 'No "Initiating shutdown" found in logs, maybe because of cpu limit.', level="ERROR")
             return 'ko'
         return 'ok'
@@ -554,8 +625,9 @@ class ConfigStep(models.Model):
             return time2str(time.localtime(os.path.getmtime(log_path)))
 
     def _get_checkers_result(self, build, checkers):
+        found = self._scan_log(build)
         for checker in checkers:
-            result = checker(build)
+            result = checker(build, found)
             if result != 'ok':
                 return result
         return 'ok'
@@ -576,6 +648,14 @@ class ConfigStep(models.Model):
             build_values['local_result'] = build._get_worst_result([build.local_result, local_result])
         return build_values
 
+    def _make_resource_stats(self, build):
+        """ Records the resources used by the container of the step """
+        if not self._is_docker_step():
+            return
+        key_values = docker_cgroup_stats(build._get_docker_name(), build._path())
+        existing = self.env['runbot.build.stat'].search([('build_id', '=', build.id), ('config_step_id', '=', self.id)]).mapped('key')
+        self.env['runbot.build.stat']._write_key_values(build, self, {key: value for key, value in key_values.items() if key not in existing})
+
     def _make_stats(self, build):
         if not ((build.branch_id.make_stats or build.config_data.get('make_stats')) and self.make_stats):
             return
@@ -0,0 +1,56 @@
+from odoo import models, fields
+
+
+class RunbotBuildPort(models.Model):
+    _name = "runbot.build.port"
+    _description = "Build port lease"
+    _log_access = False
+
+    _sql_constraints = [('host_port_unique', 'unique (host, port)', 'A port can only be used by one build per host')]
+
+    host = fields.Char('Host', required=True)
+    port = fields.Integer('Port', required=True)
+    build_id = fields.Many2one('runbot.build', 'Build', required=True, ondelete='cascade', index=True)
+
+    def init(self):
+        # leases of the builds using a port before leases existed
+        self._cr.execute("""
+            INSERT INTO runbot_build_port (host, port, build_id)
+            SELECT host, port, id
+            FROM runbot_build
+            WHERE local_state NOT IN ('pending', 'done', 'duplicate')
+            AND host IS NOT NULL
+            AND port IS NOT NULL
+            ON CONFLICT (host, port) DO NOTHING
+        """)
+
+    def _claim(self, build, port=None):
+        """ Leases a free port of the build host to the build, or the given
+        port if it is free. Ports leased by committed transactions are
+        skipped. A port claimed concurrently by another transaction makes
+        the insert fail with a serialization error, the cursors being
+        repeatable read, which aborts the transaction so that it is retried
+        by the next scheduler turn.
+        :return: the port, or False if none could be claimed
+        """
+        start = port or int(self.env['ir.config_parameter'].get_param('runbot.runbot_starting_port', default=2000))
+        stop = port or 65533
+        self.env.cr.execute("""
+            INSERT INTO runbot_build_port (host, port, build_id)
+            SELECT %(host)s, candidate, %(build_id)s
+            FROM generate_series(%(start)s, %(stop)s, 3) AS candidate
+            WHERE NOT EXISTS (
+                SELECT 1 FROM runbot_build_port WHERE host = %(host)s AND port = candidate
+            )
+            ORDER BY candidate
+            LIMIT 1
+            ON CONFLICT (host, port) DO NOTHING
+            RETURNING port
+        """, {'host': build.host, 'build_id': build.id, 'start': start, 'stop': stop})
+        row = self.env.cr.fetchone()
+        return row[0] if row else False
+
+    def _release(self, builds):
+        """ Frees the ports leased to the builds """
+        if builds:
+            self.env.cr.execute("DELETE FROM runbot_build_port WHERE build_id IN %s", [tuple(builds.ids)])
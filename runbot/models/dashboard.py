@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import models
+
+_logger = logging.getLogger(__name__)
+
+
+class RunbotDashboard(models.AbstractModel):
+    """ Aggregates displayed by the dashboard and glances pages, kept in
+    materialized views refreshed by the scheduler so that auto-refreshing
+    pages don't scan runbot_build on each load.
+    """
+    _name = 'runbot.dashboard'
+    _description = 'Dashboard aggregates'
+
+    _materialized_views = ['runbot_dashboard_build_count', 'runbot_dashboard_last_build', 'runbot_dashboard_glances']
+
+    def init(self):
+        # the views look for the last builds of each branch
+        self._cr.execute("CREATE INDEX IF NOT EXISTS runbot_build_branch_id_id_index ON runbot_build (branch_id, id)")
+        for view in self._materialized_views:
+            self._cr.execute("DROP MATERIALIZED VIEW IF EXISTS %s" % view)
+
+        # number of active builds per repo, host and state
+        self._cr.execute("""
+            CREATE MATERIALIZED VIEW runbot_dashboard_build_count AS (
+                SELECT
+                    repo_id,
+                    COALESCE(host, '') AS host,
+                    local_state,
+                    build_type = 'scheduled' AS scheduled,
+                    count(*) AS count
+                FROM runbot_build
+                WHERE local_state IN ('pending', 'testing', 'running')
+                GROUP BY 1, 2, 3, 4
+            )""")
+        self._cr.execute("""
+            CREATE UNIQUE INDEX runbot_dashboard_build_count_unique
+            ON runbot_dashboard_build_count (repo_id, host, local_state, scheduled)""")
+
+        # last 3 builds of each sticky branch
+        self._cr.execute("""
+            CREATE MATERIALIZED VIEW runbot_dashboard_last_build AS (
+                SELECT br.repo_id, br.id AS branch_id, bu.id AS build_id
+                FROM runbot_branch br
+                JOIN LATERAL (
+                    SELECT id
+                    FROM runbot_build bu
+                    WHERE bu.branch_id = br.id
+                    ORDER BY id DESC
+                    LIMIT 3
+                ) bu ON (true)
+                WHERE br.sticky
+            )""")
+        self._cr.execute("""
+            CREATE UNIQUE INDEX runbot_dashboard_last_build_unique
+            ON runbot_dashboard_last_build (build_id)""")
+
+        # last result of each sticky branch
+        self._cr.execute("""
+            CREATE MATERIALIZED VIEW runbot_dashboard_glances AS (
+                SELECT
+                    r.id AS repo_id,
+                    r.sequence AS repo_sequence,
+                    split_part(r.name, ':', 2) AS repo_name,
+                    br.id AS branch_id,
+                    br.branch_name,
+                    bu.global_result AS result
+                FROM runbot_branch br
+                JOIN runbot_repo r ON (r.id = br.repo_id)
+                JOIN LATERAL (
+                    SELECT global_result
+                    FROM runbot_build bu
+                    WHERE bu.branch_id = br.id
+                    AND (bu.hidden = 'f' OR bu.hidden IS NULL)
+                    AND bu.global_state in ('running', 'done')
+                    AND bu.global_result not in ('skipped', 'manually_killed')
+                    AND (bu.config_id = r.repo_config_id
+                         OR bu.config_id = br.branch_config_id
+                         OR bu.config_id = (SELECT res_id FROM ir_model_data WHERE module = 'runbot' AND name = 'runbot_build_config_default'))
+                    ORDER BY bu.id DESC
+                    LIMIT 1
+                ) bu ON (true)
+                WHERE br.sticky
+            )""")
+        self._cr.execute("""
+            CREATE UNIQUE INDEX runbot_dashboard_glances_unique
+            ON runbot_dashboard_glances (branch_id)""")
+
+    def _refresh(self):
+        """ Refresh the aggregates, without blocking the pages reading them """
+        self.flush()
+        for view in self._materialized_views:
+            self._cr.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY %s" % view)
+
+    def _get_build_counts(self, repo_ids=None, host=None):
+        """ Returns a dict of (local_state, scheduled): number of builds """
+        where = []
+        params = []
+        if repo_ids is not None:
+            where.append('repo_id IN %s')
+            params.append(tuple(repo_ids) or (0,))
+        if host is not None:
+            where.append('host = %s')
+            params.append(host)
+        self._cr.execute("""
+            SELECT local_state, scheduled, sum(count)
+            FROM runbot_dashboard_build_count
+            WHERE %s
+            GROUP BY local_state, scheduled
+        """ % (' AND '.join(where) or 'true'), params)
+        return {(state, scheduled): int(count) for state, scheduled, count in self._cr.fetchall()}
+
+    def _get_state_count(self, state, repo_ids=None, host=None):
+        counts = self._get_build_counts(repo_ids, host)
+        return counts.get((state, False), 0) + counts.get((state, True), 0)
+
+    def _get_sticky_build_ids(self, repo_ids):
+        """ Returns the ids of the last builds of sticky branches, in dashboard order """
+        self._cr.execute("""
+            SELECT lb.build_id
+            FROM runbot_dashboard_last_build lb
+            JOIN runbot_branch br ON (br.id = lb.branch_id)
+            JOIN runbot_repo r ON (r.id = lb.repo_id)
+            WHERE lb.repo_id IN %s
+            ORDER BY r.sequence, r.name, br.branch_name, lb.build_id DESC
+        """, [tuple(repo_ids) or (0,)])
+        return [row[0] for row in self._cr.fetchall()]
+
+    def _get_glances(self, repo_ids):
+        """ Returns (repo name, branch name, last result) rows, in glances order """
+        self._cr.execute("""
+            SELECT repo_name, branch_name, result
+            FROM runbot_dashboard_glances
+            WHERE repo_id IN %s
+            ORDER BY repo_sequence, (branch_name = 'master'), branch_id
+        """, [tuple(repo_ids) or (0,)])
+        return self._cr.fetchall()
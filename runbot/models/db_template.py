@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import shutil
+
+from odoo import models, fields, api
+from ..common import now, os
+
+_logger = logging.getLogger(__name__)
+
+
+class RunbotDbTemplate(models.Model):
+    _name = "runbot.db.template"
+    _description = "Pooled template database"
+    _order = 'last_used desc, id desc'
+
+    _sql_constraints = [('host_key_unique', 'unique (host, key)', 'A template can only be pooled once per host')]
+
+    name = fields.Char('Database', required=True)
+    host = fields.Char('Host', required=True)
+    key = fields.Char('Key', required=True, help="Hash of the commits, modules and python version the template was installed with")
+    modules = fields.Char('Installed modules')
+    state = fields.Selection([('creating', 'Creating'), ('ready', 'Ready')], default='creating', required=True)
+    build_id = fields.Many2one('runbot.build', 'Creating build', ondelete='set null')
+    last_used = fields.Datetime('Last used')
+
+    @api.model
+    def _get_key(self, build, modules, py_version):
+        commits = sorted('%s:%s' % (commit.repo.id, commit.sha) for commit in build._get_all_commit())
+        modules = sorted(module.strip() for module in modules.split(',') if module.strip())
+        return hashlib.sha256(repr((commits, modules, py_version)).encode()).hexdigest()
+
+    def _filestore_path(self):
+        self.ensure_one()
+        return os.path.join(self.env['runbot.repo']._root(), 'db_templates', self.name)
+
+    def _marker(self):
+        """ Name of the file written in the creating build dir once the template is installed """
+        self.ensure_one()
+        return '%s.ok' % self.name
+
+    @api.model
+    def _acquire(self, build, modules, py_version):
+        """ Returns the template the database of the build can be created
+        from if it is ready, a new template the build has to install if
+        there is none yet, or an empty recordset if another build is
+        installing it.
+        """
+        modules = ','.join(sorted(module.strip() for module in modules.split(',') if module.strip()))
+        key = self._get_key(build, modules, py_version)
+        self.env.cr.execute("""
+            INSERT INTO runbot_db_template (name, host, key, modules, state, build_id, last_used)
+            VALUES (%s, %s, %s, %s, 'creating', %s, now() AT TIME ZONE 'UTC')
+            ON CONFLICT (host, key) DO NOTHING
+            RETURNING id
+        """, ['runbot-template-%s' % key[:16], build.host, key, modules, build.id])
+        row = self.env.cr.fetchone()
+        if row:
+            return self.browse(row[0])
+
+        template = self.search([('host', '=', build.host), ('key', '=', key)])
+        if template.state == 'ready':
+            template.last_used = now()
+            return template
+        if not template.build_id or template.build_id.local_state == 'done':
+            # the creating build was killed before the template was installed
+            template._drop()
+        return self.browse()
+
+    def _populate_commands(self, build, odoo_cmd, db_name, db_template, db_user):
+        """ Returns the shell commands installing the template then creating
+        the build database from it, falling back to an empty database if the
+        template could not be installed. The commands always succeed so that
+        a failed template never prevents the step from running.
+        """
+        self.ensure_one()
+        filestore = '/data/build/datadir/filestore/%s'
+        install = odoo_cmd + ['-d', self.name, '-i', self.modules, '--stop-after-init', '--max-cron-threads=0']
+        return [
+            '{', '('] + install + [
+            '&&', 'touch', '/data/build/%s' % self._marker(),
+            '&&', 'createdb', '-U', db_user, '-T', self.name, db_name,
+            '&&', '{', '[', '!', '-d', filestore % self.name, ']', '||', 'cp', '-r', filestore % self.name, filestore % db_name, ';', '}',
+            ')', '||', 'createdb', '-U', db_user, '--lc-collate=C', '-E', 'unicode', '-T', db_template, db_name, '||', 'true', ';', '}',
+        ]
+
+    def _copy_filestore(self, build, db_name):
+        self.ensure_one()
+        if os.path.isdir(self._filestore_path()):
+            shutil.copytree(self._filestore_path(), build._path('datadir', 'filestore', db_name))
+
+    @api.model
+    def _check_populated(self, build):
+        """ Marks the templates installed by the build as ready, or drops
+        them if their installation failed
+        """
+        for template in self.search([('build_id', '=', build.id), ('state', '=', 'creating')]):
+            if not os.path.exists(build._path(template._marker())):
+                build._log('db_template', 'Template database %s could not be installed' % template.name, level='WARNING')
+                template._drop()
+                continue
+            build_filestore = build._path('datadir', 'filestore', template.name)
+            if os.path.isdir(build_filestore):
+                shutil.rmtree(template._filestore_path(), ignore_errors=True)
+                shutil.copytree(build_filestore, template._filestore_path())
+            template.write({'state': 'ready', 'last_used': now()})
+            build._log('db_template', 'Template database %s installed with %s' % (template.name, template.modules))
+            self._evict(build.host)
+
+    @api.model
+    def _evict(self, host):
+        """ Drops the least recently used ready templates of the host above the pool size """
+        pool_size = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_db_template_pool_size', default=5))
+        self.search([('host', '=', host), ('state', '=', 'ready')])[pool_size:]._drop()
+
+    def _drop(self):
+        for template in self:
+            _logger.info('Dropping template database %s', template.name)
+            self.env['runbot.build']._local_pg_dropdb(template.name)
+            shutil.rmtree(template._filestore_path(), ignore_errors=True)
+        self.unlink()
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import shutil
+import threading
+
+from odoo import models, fields, api
+from ..common import now, os
+from ..container import docker_base_image_hash, docker_build_requirements, docker_image_remove
+
+_logger = logging.getLogger(__name__)
+
+# images being built by this process, by tag
+_image_threads = {}
+
+
+def _build_image(tag, image_dir, requirements, py_version):
+    """ Builds the image then leaves an ok or failed marker in its
+    directory, the database being updated on the next acquisition
+    """
+    try:
+        success = docker_build_requirements('%s.txt' % image_dir, image_dir, tag, requirements, py_version)
+    except Exception:
+        _logger.exception('Failed to build image %s', tag)
+        success = False
+    with open(os.path.join(image_dir, 'ok' if success else 'failed'), 'w'):
+        pass
+
+
+class RunbotDockerImage(models.Model):
+    _name = "runbot.docker.image"
+    _description = "Docker image with build requirements"
+    _order = 'last_used desc, id desc'
+
+    _sql_constraints = [('host_key_unique', 'unique (host, key)', 'An image can only be built once per host')]
+
+    name = fields.Char('Tag', required=True)
+    host = fields.Char('Host', required=True)
+    key = fields.Char('Key', required=True, help="Hash of the base image, requirements and python version the image was built with")
+    py_version = fields.Char('Python version')
+    state = fields.Selection([('building', 'Building'), ('ready', 'Ready'), ('failed', 'Failed')], default='building', required=True)
+    last_used = fields.Datetime('Last used')
+
+    @api.model
+    def _get_requirements(self, build):
+        """ Returns the content of the requirements.txt of the build commits """
+        requirements = []
+        for commit in build._get_all_commit():
+            if os.path.isfile(commit._source_path('requirements.txt')):
+                with open(commit._source_path('requirements.txt')) as requirements_file:
+                    requirements.append(requirements_file.read())
+        return requirements
+
+    @api.model
+    def _get_key(self, requirements, py_version):
+        base_hash = docker_base_image_hash(self.env['runbot.host']._get_work_path())
+        return hashlib.sha256(repr((base_hash, requirements, py_version)).encode()).hexdigest()
+
+    def _image_dir(self):
+        self.ensure_one()
+        return os.path.join(self.env['runbot.repo']._root(), 'docker', 'images', self.key[:16])
+
+    @api.model
+    def _acquire(self, build, py_version):
+        """ Returns the tag of the image having the requirements of the build
+        installed, or False if the build has to install them at runtime
+        because the image is not built yet. A missing image is built in the
+        background for the next builds.
+        """
+        requirements = self._get_requirements(build)
+        if not requirements:
+            return False
+        py_version = str(py_version)
+        key = self._get_key(requirements, py_version)
+        self.env.cr.execute("""
+            INSERT INTO runbot_docker_image (name, host, key, py_version, state, last_used)
+            VALUES (%s, %s, %s, %s, 'building', now() AT TIME ZONE 'UTC')
+            ON CONFLICT (host, key) DO NOTHING
+            RETURNING id
+        """, ['odoo:runbot_%s' % key[:16], build.host, key, py_version])
+        row = self.env.cr.fetchone()
+        if row:
+            self.browse(row[0])._start_build(requirements)
+            return False
+
+        image = self.search([('host', '=', build.host), ('key', '=', key)])
+        if image.state == 'building':
+            image._check_built(requirements)
+        if image.state == 'ready':
+            image.last_used = now()
+            return image.name
+        return False
+
+    def _start_build(self, requirements):
+        self.ensure_one()
+        image_dir = self._image_dir()
+        shutil.rmtree(image_dir, ignore_errors=True)
+        os.makedirs(image_dir, exist_ok=True)
+        _logger.info('Building image %s', self.name)
+        thread = threading.Thread(target=_build_image, args=(self.name, image_dir, requirements, self.py_version), name='docker_image', daemon=True)
+        _image_threads[self.name] = thread
+        thread.start()
+
+    def _check_built(self, requirements):
+        """ Updates the state of the image from the markers left by the build """
+        self.ensure_one()
+        image_dir = self._image_dir()
+        if os.path.exists(os.path.join(image_dir, 'ok')):
+            _logger.info('Image %s is ready', self.name)
+            self.state = 'ready'
+            _image_threads.pop(self.name, None)
+            self._evict(self.host)
+        elif os.path.exists(os.path.join(image_dir, 'failed')):
+            _logger.warning('Image %s could not be built, see %s.txt', self.name, image_dir)
+            self.state = 'failed'
+            _image_threads.pop(self.name, None)
+        elif self.name not in _image_threads or not _image_threads[self.name].is_alive():
+            # the builder was restarted while building the image
+            self._start_build(requirements)
+
+    @api.model
+    def _evict(self, host):
+        """ Removes the least recently used ready images of the host above the
+        pool size, images used by builds that are not done are kept
+        """
+        pool_size = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_docker_image_pool_size', default=10))
+        candidates = self.search([('host', '=', host), ('state', '=', 'ready')])[pool_size:]
+        if not candidates:
+            return
+        used = self.env['runbot.build'].search([
+            ('host', '=', host),
+            ('local_state', 'in', ('pending', 'testing', 'running')),
+            ('docker_image', 'in', candidates.mapped('name')),
+        ]).mapped('docker_image')
+        candidates.filtered(lambda image: image.name not in used)._remove()
+
+    def _remove(self):
+        for image in self:
+            docker_image_remove(image.name)
+            shutil.rmtree(image._image_dir(), ignore_errors=True)
+            if os.path.exists('%s.txt' % image._image_dir()):
+                os.remove('%s.txt' % image._image_dir())
+        self.unlink()
@@ -25,8 +25,36 @@ class runbot_event(models.Model):
             parent_class.init()
 
         self._cr.execute("""
+CREATE UNLOGGED TABLE IF NOT EXISTS runbot_logging_staging (
+    id serial PRIMARY KEY,
+    create_date timestamp without time zone,
+    type varchar,
+    dbname varchar,
+    name varchar,
+    level varchar,
+    message text,
+    path varchar,
+    line varchar,
+    func varchar,
+    build_id integer,
+    active_step_id integer
+);
+
 CREATE OR REPLACE FUNCTION runbot_set_logging_build() RETURNS TRIGGER AS $runbot_set_logging_build$
 BEGIN
+  IF (current_setting('runbot.logging_flush', true) = 'on') THEN
+    -- lines flushed from runbot_logging_staging are already resolved
+    RETURN NEW;
+  END IF;
+  IF (NEW.build_id IS NULL AND NEW.dbname IS NOT NULL AND NEW.dbname != current_database()
+      AND EXISTS (SELECT 1 FROM ir_config_parameter WHERE key = 'runbot.runbot_logging_bulk' AND value NOT IN ('', '0', 'False'))) THEN
+    -- bulk mode: stage the line without locking the build, see _flush_staged_logs
+    INSERT INTO runbot_logging_staging(create_date, type, dbname, name, level, message, path, line, func, build_id, active_step_id)
+    SELECT NEW.create_date, NEW.type, NEW.dbname, NEW.name, NEW.level, NEW.message, NEW.path, NEW.line, NEW.func, b.id, b.active_step
+    FROM runbot_build b
+    WHERE b.id = split_part(NEW.dbname, '-', 1)::integer;
+    RETURN NULL;
+  END IF;
   IF (NEW.build_id IS NULL AND NEW.dbname IS NOT NULL AND NEW.dbname != current_database()) THEN
     NEW.build_id := split_part(NEW.dbname, '-', 1)::integer;
     SELECT active_step INTO NEW.active_step_id FROM runbot_build WHERE runbot_build.id = NEW.build_id;
@@ -72,6 +100,59 @@ FOR EACH ROW EXECUTE PROCEDURE runbot_set_logging_build();
 
         """)
 
+    def _flush_staged_logs(self):
+        """ Move the lines staged in bulk logging mode to ir_logging.
+        Applies the same rules as the runbot_set_logging_build trigger, but with
+        one update per build instead of one per line.
+        """
+        self.env['runbot.build'].flush(['log_counter', 'triggered_result', 'active_step'])
+        self._cr.execute("SELECT set_config('runbot.logging_flush', 'on', true)")
+        self._cr.execute("""
+            WITH staged AS (
+                DELETE FROM runbot_logging_staging RETURNING *
+            ), lines AS (
+                SELECT s.*, b.log_counter AS counter,
+                    CASE WHEN s.type = 'server' THEN row_number() OVER (PARTITION BY s.build_id, s.type = 'server' ORDER BY s.id) END AS rank
+                FROM staged s
+                JOIN runbot_build b ON b.id = s.build_id
+            ), inserted AS (
+                INSERT INTO ir_logging(create_date, type, dbname, name, level, message, path, line, func, build_id, active_step_id)
+                SELECT
+                    create_date,
+                    CASE WHEN rank = counter THEN 'runbot' ELSE type END,
+                    dbname,
+                    name,
+                    CASE WHEN rank = counter THEN 'SEPARATOR' ELSE level END,
+                    CASE WHEN rank = counter THEN 'Log limit reached (full logs are still available in the log file)' ELSE message END,
+                    path,
+                    line,
+                    CASE WHEN rank = counter THEN '' ELSE func END,
+                    build_id,
+                    active_step_id
+                FROM lines
+                WHERE rank IS NULL OR rank <= counter
+                ORDER BY id
+            ), builds AS (
+                SELECT
+                    build_id,
+                    count(rank) AS server_lines,
+                    (array_agg(CASE WHEN UPPER(level) = 'WARNING' THEN 'warn' ELSE 'ko' END ORDER BY id DESC)
+                        FILTER (WHERE UPPER(level) NOT IN ('INFO', 'SEPARATOR') AND (rank IS NULL OR rank < counter)))[1] AS result
+                FROM lines
+                GROUP BY build_id
+            )
+            UPDATE runbot_build b
+            SET log_counter = b.log_counter - builds.server_lines,
+                triggered_result = COALESCE(builds.result, b.triggered_result)
+            FROM builds
+            WHERE b.id = builds.build_id
+            RETURNING b.id
+        """)
+        build_ids = [r[0] for r in self._cr.fetchall()]
+        self._cr.execute("SELECT set_config('runbot.logging_flush', 'off', true)")
+        self.env['runbot.build'].browse(build_ids).invalidate_cache(['log_counter', 'triggered_result'])
+        return build_ids
+
     def _markdown(self):
         """ Apply pseudo markdown parser for message.
         """
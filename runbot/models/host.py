@@ -21,25 +21,77 @@ class RunboHost(models.Model):
     last_success = fields.Datetime('Last success')
     assigned_only = fields.Boolean('Only accept assigned build', default=False)
     nb_worker = fields.Integer('Number of max paralel build', help="0 to use icp value", default=0)
-    nb_testing = fields.Integer(compute='_compute_nb')
-    nb_running = fields.Integer(compute='_compute_nb')
+    nb_testing = fields.Integer('Number of testing builds', readonly=True, default=0, help="Maintained by a trigger on the builds local state")
+    nb_running = fields.Integer('Number of running builds', readonly=True, default=0, help="Maintained by a trigger on the builds local state")
     last_exception = fields.Char('Last exception')
     exception_count = fields.Integer('Exception count')
     psql_conn_count = fields.Integer('SQL connections count', default=0)
-
-    def _compute_nb(self):
-        groups = self.env['runbot.build'].read_group(
-            [('host', 'in', self.mapped('name')), ('local_state', 'in', ('testing', 'running'))],
-            ['host', 'local_state'],
-            ['host', 'local_state'],
-            lazy=False
-        )
-        count_by_host_state = {host.name: {} for host in self}
-        for group in groups:
-            count_by_host_state[group['host']][group['local_state']] = group['__count']
-        for host in self:
-            host.nb_testing = count_by_host_state[host.name].get('testing', 0)
-            host.nb_running = count_by_host_state[host.name].get('running', 0)
+    cpu_capacity = fields.Float('Cpu capacity', help="Cpus available for builds when scheduling by resources, 0 to use the number of workers")
+    memory_capacity = fields.Integer('Memory capacity (MB)', help="Memory available for builds when scheduling by resources, 0 for no limit")
+    db_connection_capacity = fields.Integer('Db connections capacity', help="Postgresql connections available for builds when scheduling by resources, 0 for no limit")
+
+    def init(self):
+        # the counters are updated in the transaction changing the build, a
+        # host row being only locked by the transactions changing its builds
+        self._cr.execute("""
+            CREATE OR REPLACE FUNCTION runbot_host_update_nb() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'UPDATE' THEN
+                    IF NEW.local_state IS NOT DISTINCT FROM OLD.local_state AND NEW.host IS NOT DISTINCT FROM OLD.host THEN
+                        RETURN NULL;
+                    END IF;
+                END IF;
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    IF OLD.local_state IN ('testing', 'running') THEN
+                        UPDATE runbot_host SET
+                            nb_testing = nb_testing - (OLD.local_state = 'testing')::int,
+                            nb_running = nb_running - (OLD.local_state = 'running')::int
+                        WHERE name = OLD.host;
+                    END IF;
+                END IF;
+                IF TG_OP IN ('UPDATE', 'INSERT') THEN
+                    IF NEW.local_state IN ('testing', 'running') THEN
+                        UPDATE runbot_host SET
+                            nb_testing = nb_testing + (NEW.local_state = 'testing')::int,
+                            nb_running = nb_running + (NEW.local_state = 'running')::int
+                        WHERE name = NEW.host;
+                    END IF;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS runbot_host_update_nb ON runbot_build;
+            CREATE TRIGGER runbot_host_update_nb
+            AFTER INSERT OR DELETE OR UPDATE OF local_state, host ON runbot_build
+            FOR EACH ROW EXECUTE PROCEDURE runbot_host_update_nb();
+        """)
+        self._recompute_nb()
+
+    def _recompute_nb(self):
+        """ Recounts the testing and running builds of the hosts, in case the
+        counters drifted (e.g. builds changed with triggers disabled)
+        """
+        query = """
+            UPDATE runbot_host h SET
+                nb_testing = coalesce(counts.nb_testing, 0),
+                nb_running = coalesce(counts.nb_running, 0)
+            FROM runbot_host h2
+            LEFT JOIN (
+                SELECT host,
+                    count(*) FILTER (WHERE local_state = 'testing') AS nb_testing,
+                    count(*) FILTER (WHERE local_state = 'running') AS nb_running
+                FROM runbot_build
+                WHERE local_state IN ('testing', 'running')
+                GROUP BY host
+            ) counts ON counts.host = h2.name
+            WHERE h.id = h2.id
+        """
+        if self.ids:
+            self._cr.execute(query + " AND h.id IN %s", [tuple(self.ids)])
+        else:
+            self._cr.execute(query)
+        self.invalidate_cache(['nb_testing', 'nb_running'])
 
     @api.model_create_single
     def create(self, values):
@@ -86,6 +138,14 @@ class RunboHost(models.Model):
         icp = self.env['ir.config_parameter']
         return self.nb_worker or int(icp.sudo().get_param('runbot.runbot_workers', default=6))
 
+    def _get_capacity(self):
+        """ Returns the (cpu, memory, db connections) available for builds """
+        return (
+            self.cpu_capacity or self.get_nb_worker(),
+            self.memory_capacity or float('inf'),
+            self.db_connection_capacity or float('inf'),
+        )
+
     def get_running_max(self):
         icp = self.env['ir.config_parameter']
         return int(icp.get_param('runbot.runbot_running_max', default=75))
@@ -0,0 +1,82 @@
+import ast
+import glob
+import json
+import logging
+
+from odoo import models, fields, api, registry
+from psycopg2.extensions import TransactionRollbackError
+from ..common import os
+
+_logger = logging.getLogger(__name__)
+
+
+class RunbotModuleIndex(models.Model):
+    _name = "runbot.module.index"
+    _description = "Modules of a commit"
+    _log_access = False
+
+    _sql_constraints = [('repo_sha_unique', 'unique (repo_id, sha)', 'A commit can only be indexed once')]
+
+    repo_id = fields.Many2one('runbot.repo', 'Repository', required=True, ondelete='cascade')
+    sha = fields.Char('Sha', required=True)
+    addons_paths = fields.Char('Addons paths', help="Addons paths of the repository when the commit was indexed")
+    manifest_files = fields.Char('Manifest files', help="Manifest files of the repository when the commit was indexed")
+    modules = fields.Text('Modules', help="Json list of the modules with their addons path, manifest file, installable flag and dependencies")
+
+    @api.model
+    def _scan(self, commit):
+        """ Returns the modules found in the sources of the commit """
+        modules = []
+        for manifest_file_name in commit.repo.manifest_files.split(','):  # '__manifest__.py' '__openerp__.py'
+            for addons_path in (commit.repo.addons_paths or '').split(','):  # '' 'addons' 'odoo/addons'
+                sep = os.path.join(addons_path, '*')
+                for manifest_path in sorted(glob.glob(commit._source_path(sep, manifest_file_name))):
+                    try:
+                        with open(manifest_path) as manifest_file:
+                            manifest = ast.literal_eval(manifest_file.read())
+                    except (OSError, ValueError, SyntaxError) as e:
+                        _logger.warning('Could not read manifest %s: %s', manifest_path, e)
+                        manifest = {}
+                    modules.append({
+                        'name': os.path.basename(os.path.dirname(manifest_path)),
+                        'addons_path': addons_path,
+                        'manifest': manifest_file_name,
+                        'installable': bool(manifest.get('installable', True)),
+                        'depends': list(manifest.get('depends', [])),
+                    })
+        return modules
+
+    @api.model
+    def _index(self, commit):
+        """ Scans the exported sources of the commit and stores its modules.
+        All hosts export a new commit at about the same time, the index is
+        written in its own short transaction so that a concurrent write does
+        not abort the scheduler transaction, the modules being returned anyway.
+        """
+        modules = self._scan(commit)
+        try:
+            with registry(self.env.cr.dbname).cursor() as cr:
+                cr.execute("""
+                    INSERT INTO runbot_module_index (repo_id, sha, addons_paths, manifest_files, modules)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (repo_id, sha) DO UPDATE
+                    SET addons_paths = EXCLUDED.addons_paths, manifest_files = EXCLUDED.manifest_files, modules = EXCLUDED.modules
+                """, [commit.repo.id, commit.sha, commit.repo.addons_paths or '', commit.repo.manifest_files, json.dumps(modules)])
+        except TransactionRollbackError:
+            _logger.info('%s was indexed concurrently', commit)
+        self.invalidate_cache()
+        return modules
+
+    @api.model
+    def _get_modules(self, commit):
+        """ Returns the modules of the commit from the index, indexing it if
+        the commit was exported before being indexed or if the addons paths or
+        manifest files of the repository changed since. Commits that are not
+        exported on this host and not indexed yet have no modules.
+        """
+        index = self.search([('repo_id', '=', commit.repo.id), ('sha', '=', commit.sha)])
+        if index and index.addons_paths == (commit.repo.addons_paths or '') and index.manifest_files == commit.repo.manifest_files:
+            return json.loads(index.modules)
+        if not os.path.isdir(commit._source_path()):
+            return []
+        return self._index(commit)
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import concurrent.futures
 import datetime
 import dateutil
 import json
@@ -19,7 +20,8 @@ from odoo.modules.module import get_module_resource
 from odoo.tools import config
 from odoo.osv import expression
 from ..common import fqdn, dt2time, Commit, dest_reg, os
-from ..container import docker_ps, docker_stop
+from ..container import docker_ps, docker_stop, get_docker_event_watcher, sanitize_container_name
+from ..source_store import SourceStore
 from psycopg2.extensions import TransactionRollbackError
 
 _logger = logging.getLogger(__name__)
@@ -27,6 +29,14 @@ _logger = logging.getLogger(__name__)
 class RunbotException(Exception):
     pass
 
+def parse_ref_date(date):
+    """ Parses the committer date of a ref, ignoring its timezone """
+    try:
+        return datetime.datetime.strptime(date[:19], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return dateutil.parser.parse(date[:19])
+
+
 class runbot_repo(models.Model):
 
     _name = "runbot.repo"
@@ -139,6 +149,10 @@ class runbot_repo(models.Model):
         self.ensure_one()
         return os.path.join(self._root(), 'sources', self._get_repo_name_part(), sha, *path)
 
+    def _source_store(self):
+        """Return the content addressed store shared by all sources exports"""
+        return SourceStore(os.path.join(self._root(), 'source_store'))
+
     @api.depends('name')
     def _get_path(self):
         """compute the server path of repo from the name"""
@@ -203,15 +217,23 @@ class runbot_repo(models.Model):
         _logger.info('git export: checkouting to %s (new)' % export_path)
         os.makedirs(export_path)
 
-        p1 = subprocess.Popen(['git', '--git-dir=%s' % self.path, 'archive', sha], stdout=subprocess.PIPE)
-        p2 = subprocess.Popen(['tar', '-xmC', export_path], stdin=p1.stdout, stdout=subprocess.PIPE)
-        p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
-        (out, err) = p2.communicate()
-        if err:
-            raise RunbotException("Archive %s failed. Did you force push the branch since build creation? (%s)" % (sha, err))
+        icp = self.env['ir.config_parameter']
+        if icp.get_param('runbot.runbot_export_mode', default='archive') == 'store':
+            try:
+                linked, written = self._source_store().export(self.path, sha, export_path)
+            except (subprocess.CalledProcessError, OSError) as e:
+                shutil.rmtree(export_path, ignore_errors=True)
+                raise RunbotException("Export %s failed. Did you force push the branch since build creation? (%s)" % (sha, e))
+            _logger.info('git export: %s files linked from store, %s written', linked, written)
+        else:
+            p1 = subprocess.Popen(['git', '--git-dir=%s' % self.path, 'archive', sha], stdout=subprocess.PIPE)
+            p2 = subprocess.Popen(['tar', '-xmC', export_path], stdin=p1.stdout, stdout=subprocess.PIPE)
+            p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
+            (out, err) = p2.communicate()
+            if err:
+                raise RunbotException("Archive %s failed. Did you force push the branch since build creation? (%s)" % (sha, err))
 
         # migration scripts link if necessary
-        icp = self.env['ir.config_parameter']
         ln_param = icp.get_param('runbot_migration_ln', default='')
         migration_repo_id = int(icp.get_param('runbot_migration_repo_id', default=0))
         if ln_param and migration_repo_id and self.server_files:
@@ -221,6 +243,9 @@ class runbot_repo(models.Model):
             except FileNotFoundError:
                 _logger.warning('Impossible to create migration symlink')
 
+        # the modules of the commit are scanned once for all its builds
+        self.env['runbot.module.index']._index(Commit(self, sha))
+
         # TODO get result and fallback on cleaing in case of problem
         return export_path
 
@@ -273,23 +298,32 @@ class runbot_repo(models.Model):
         if os.path.exists(fname_fetch_head):
             return os.path.getmtime(fname_fetch_head)
 
+    def _refs_changed(self):
+        """Return the repos whose refs were fetched since they were last read,
+        marking them as read"""
+        changed = self.browse()
+        for repo in self:
+            try:
+                get_ref_time = round(repo._get_fetch_head_time(), 4)
+            except Exception:
+                _logger.exception('Fail to get refs for repo %s', repo.name)
+                continue
+            if not repo.get_ref_time or get_ref_time > repo.get_ref_time:
+                repo.set_ref_time(get_ref_time)
+                changed |= repo
+        return changed
+
     def _get_refs(self):
-        """Find new refs
+        """Find refs
         :return: list of tuples with following refs informations:
         name, sha, date, author, author_email, subject, committer, committer_email
         """
         self.ensure_one()
-
-        get_ref_time = round(self._get_fetch_head_time(), 4)
-        if not self.get_ref_time or get_ref_time > self.get_ref_time:
-            self.set_ref_time(get_ref_time)
-            fields = ['refname', 'objectname', 'committerdate:iso8601', 'authorname', 'authoremail', 'subject', 'committername', 'committeremail']
-            fmt = "%00".join(["%(" + field + ")" for field in fields])
-            git_refs = self._git(['for-each-ref', '--format', fmt, '--sort=-committerdate', 'refs/heads', 'refs/pull'])
-            git_refs = git_refs.strip()
-            return [tuple(field for field in line.split('\x00')) for line in git_refs.split('\n')]
-        else:
-            return []
+        fields = ['refname', 'objectname', 'committerdate:iso8601', 'authorname', 'authoremail', 'subject', 'committername', 'committeremail']
+        fmt = "%00".join(["%(" + field + ")" for field in fields])
+        git_refs = self._git(['for-each-ref', '--format', fmt, '--sort=-committerdate', 'refs/heads', 'refs/pull'])
+        git_refs = git_refs.strip()
+        return [tuple(field for field in line.split('\x00')) for line in git_refs.split('\n')]
 
     def _find_or_create_branches(self, refs):
         """Parse refs and create branches that does not exists yet
@@ -315,39 +349,43 @@ class runbot_repo(models.Model):
         return ref_branches
 
     def _find_new_commits(self, refs, ref_branches):
-        """Find new commits in bare repo
-        :param refs: list of tuples returned by _get_refs()
-        :param ref_branches: dict structure {branch.name: branch.id}
+        """Find new commits in bare repos and create their builds
+        :param refs: dict {repo: list of tuples returned by _get_refs()}, with
+                     dates parsed
+        :param ref_branches: dict {repo: {branch.name: branch.id}}
                              described in _find_or_create_branches
         """
-        self.ensure_one()
-        Branch = self.env['runbot.branch']
         Build = self.env['runbot.build']
-        icp = self.env['ir.config_parameter']
-        max_age = int(icp.get_param('runbot.runbot_max_age', default=30))
+        branch_ids = [ref_branches[repo][ref[0]] for repo in refs for ref in refs[repo]]
+        if not branch_ids:
+            return Build
 
         self.env.cr.execute("""
             SELECT DISTINCT ON (branch_id) name, branch_id
             FROM runbot_build WHERE branch_id in %s AND build_type = 'normal' AND parent_id is null ORDER BY branch_id,id DESC;
-        """, (tuple([ref_branches[r[0]] for r in refs]),))
+        """, (tuple(branch_ids),))
         # generate a set of tuples (branch_id, sha)
         builds_candidates = {(r[1], r[0]) for r in self.env.cr.fetchall()}
 
-        for name, sha, date, author, author_email, subject, committer, committer_email in refs:
-            branch = Branch.browse(ref_branches[name])
-
-            # skip the build for old branches (Could be checked before creating the branch in DB ?)
-            if dateutil.parser.parse(date[:19]) + datetime.timedelta(days=max_age) < datetime.datetime.now():
-                continue
+        branches = {branch.id: branch for branch in self.env['runbot.branch'].browse(branch_ids)}
+        rebuilt_branches = self.env['runbot.branch']
+        skipped_branches = self.env['runbot.branch']
+        builds_info = []
+        for repo in self:
+            for name, sha, date, author, author_email, subject, committer, committer_email in refs.get(repo, []):
+                branch = branches[ref_branches[repo][name]]
 
-            # create build (and mark previous builds as skipped) if not found
-            if not (branch.id, sha) in builds_candidates:
+                # create build (and mark previous builds as skipped) if not found
+                if (branch.id, sha) in builds_candidates:
+                    continue
                 if branch.no_auto_build or branch.no_build or (branch.repo_id.no_build and not branch.rebuild_requested):
                     continue
                 if branch.rebuild_requested:
-                    branch.rebuild_requested = False
-                _logger.debug('repo %s branch %s new build found revno %s', self.name, branch.name, sha)
-                build_info = {
+                    rebuilt_branches |= branch
+                if not branch.sticky:
+                    skipped_branches |= branch
+                _logger.debug('repo %s branch %s new build found revno %s', repo.name, branch.name, sha)
+                builds_info.append({
                     'branch_id': branch.id,
                     'name': sha,
                     'author': author,
@@ -355,41 +393,53 @@ class runbot_repo(models.Model):
                     'committer': committer,
                     'committer_email': committer_email,
                     'subject': subject,
-                    'date': dateutil.parser.parse(date[:19]),
+                    'date': date,
                     'build_type': 'normal',
-                }
-                if not branch.sticky:
-                    # pending builds are skipped as we have a new ref
-                    builds_to_skip = Build.search(
-                        [('branch_id', '=', branch.id), ('local_state', '=', 'pending')],
-                        order='sequence asc')
-                    builds_to_skip._skip(reason='New ref found')
-                    if builds_to_skip:
-                        build_info['sequence'] = builds_to_skip[0].sequence
+                })
+        rebuilt_branches.write({'rebuild_requested': False})
 
-                Build.create(build_info)
+        # pending builds are skipped as we have a new ref
+        sequences = {}
+        builds_to_skip = Build.search([('branch_id', 'in', skipped_branches.ids), ('local_state', '=', 'pending')], order='sequence asc')
+        for build in builds_to_skip:
+            sequences.setdefault(build.branch_id.id, build.sequence)
+        builds_to_skip._skip(reason='New ref found')
+        for build_info in builds_info:
+            if build_info['branch_id'] in sequences:
+                build_info['sequence'] = sequences[build_info['branch_id']]
+
+        return Build.create(builds_info)
 
     def _create_pending_builds(self):
         """ Find new commits in physical repos"""
+        max_age = int(self.env['ir.config_parameter'].get_param('runbot.runbot_max_age', default=30))
+        min_date = datetime.datetime.now() - datetime.timedelta(days=max_age)
+        repos = self._refs_changed()
+        # the git commands don't need the database, fill the cache with what
+        # they read before running them in threads
+        repos.mapped('path')
+        repos.mapped('short_name')
+
         refs = {}
-        ref_branches = {}
-        for repo in self:
-            try:
-                ref = repo._get_refs()
-                max_age = int(self.env['ir.config_parameter'].get_param('runbot.runbot_max_age', default=30))
-                good_refs = [r for r in ref if dateutil.parser.parse(r[2][:19]) + datetime.timedelta(days=max_age) > datetime.datetime.now()]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(repos), 8))) as executor:
+            futures = {repo: executor.submit(repo._get_refs) for repo in repos}
+            for repo, future in futures.items():
+                try:
+                    ref = [(name, sha, parse_ref_date(date)) + infos for name, sha, date, *infos in future.result()]
+                except Exception:
+                    _logger.exception('Fail to get refs for repo %s', repo.name)
+                    continue
+                good_refs = [r for r in ref if r[2] > min_date]
                 if good_refs:
                     refs[repo] = good_refs
-            except Exception:
-                _logger.exception('Fail to get refs for repo %s', repo.name)
-            if repo in refs:
-                ref_branches[repo] = repo._find_or_create_branches(refs[repo])
 
         # keep _find_or_create_branches separated from build creation to ease
         # closest branch detection
+        ref_branches = {}
         for repo in self:
             if repo in refs:
-                repo._find_new_commits(refs[repo], ref_branches[repo])
+                ref_branches[repo] = repo._find_or_create_branches(refs[repo])
+        self._find_new_commits(refs, ref_branches)
 
     def _clone(self):
         """ Clone the remote repo if needed """
@@ -459,12 +509,17 @@ class runbot_repo(models.Model):
     def _scheduler(self, host):
         nb_workers = host.get_nb_worker()
 
+        self.env['ir.logging']._flush_staged_logs()
+        self._commit()
         self._gc_testing(host)
         self._commit()
         for build in self._get_builds_with_requested_actions(host):
             build._process_requested_actions()
             self._commit()
-        for build in self._get_builds_to_schedule(host):
+        is_running = self._get_container_is_running()
+        self._kill_timed_out_builds(host, is_running)
+        self._commit()
+        for build in self._get_builds_to_schedule(host, is_running):
             build._schedule()
             self._commit()
         self._assign_pending_builds(host, nb_workers, [('build_type', '!=', 'scheduled')])
@@ -485,12 +540,75 @@ class runbot_repo(models.Model):
     def _get_builds_with_requested_actions(self, host):
         return self.env['runbot.build'].search(self.build_domain_host(host, [('requested_action', 'in', ['wake_up', 'deathrow'])]))
 
-    def _get_builds_to_schedule(self, host):
-        return self.env['runbot.build'].search(self.build_domain_host(host, [('local_state', 'in', ['testing', 'running'])]))
+    def _get_container_is_running(self):
+        """ Returns a function telling if a container is running, from the
+        docker events watcher if any or else from a single docker ps
+        """
+        watcher = get_docker_event_watcher()
+        if watcher:
+            return watcher.is_running
+        running = set(docker_ps())
+        return lambda container_name: sanitize_container_name(container_name) in running
+
+    def _kill_timed_out_builds(self, host, is_running):
+        """ Kills at once the testing builds of the host whose step exceeded its timeout """
+        timeout = int(self.env['ir.config_parameter'].get_param('runbot.runbot_timeout', default=10000))
+        self.env['runbot.build'].flush(['local_state', 'host', 'job_start', 'active_step', 'repo_id'])
+        self.env.cr.execute("""
+            SELECT bu.id
+            FROM runbot_build bu
+            JOIN runbot_build_config_step st ON (st.id = bu.active_step)
+            WHERE bu.repo_id IN %s
+            AND bu.host = %s
+            AND bu.local_state = 'testing'
+            AND bu.job_start IS NOT NULL
+            AND (now() AT TIME ZONE 'UTC') - bu.job_start > make_interval(secs => LEAST(st.cpu_limit, %s))
+        """, [tuple(self.ids) or (0,), host.name, timeout])
+        builds = self.env['runbot.build'].browse([row[0] for row in self.env.cr.fetchall()])
+        # an ended container gets its results computed instead
+        builds = builds.filtered(lambda build: is_running(build._get_docker_name()))
+        for build in builds:
+            build._log('_schedule', '%s time exceeded (%ss)' % (build.active_step.name, build.job_time))
+        builds._kill(result='killed')
+        return builds
+
+    def _get_builds_to_schedule(self, host, is_running=None):
+        builds = self.env['runbot.build'].search(self.build_domain_host(host, [('local_state', 'in', ['testing', 'running'])]))
+        is_running = is_running or self._get_container_is_running()
+        # only visit builds whose container changed or needs a timeout check
+        return builds.filtered(lambda build: build._requires_scheduling(is_running))
+
+    def _get_scheduler_mode(self):
+        return self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_scheduler', 'slots')
+
+    def _get_used_resources(self, host):
+        """ Returns the (cpu, memory, db connections) reserved by the builds of the host """
+        used = [0, 0, 0]
+        groups = self.env['runbot.build'].read_group(
+            self.build_domain_host(host, [('local_state', 'in', ('testing', 'pending'))]),
+            ['config_id'], ['config_id'])
+        for group in groups:
+            if not group['config_id']:
+                continue
+            config = self.env['runbot.build.config'].browse(group['config_id'][0])
+            for i, cost in enumerate(config._get_cost()):
+                used[i] += cost * group['config_id_count']
+        return used
+
+    def _get_remaining_resources(self, host, reserved_cpu=0):
+        capacity = host._get_capacity()
+        used = self._get_used_resources(host)
+        used[0] += reserved_cpu
+        return [available - used for available, used in zip(capacity, used)]
 
     def _assign_pending_builds(self, host, nb_workers, domain=None):
         if not self.ids or host.assigned_only or nb_workers <= 0:
             return
+        if self._get_scheduler_mode() == 'resources':
+            allocated = self._allocate_builds_by_cost(host, host.get_nb_worker() - nb_workers, domain)
+            if allocated:
+                _logger.debug('Builds %s where allocated to runbot' % allocated)
+            return
         domain_host = self.build_domain_host(host)
         reserved_slots = self.env['runbot.build'].search_count(domain_host + [('local_state', 'in', ('testing', 'pending'))])
         assignable_slots = (nb_workers - reserved_slots)
@@ -501,8 +619,11 @@ class runbot_repo(models.Model):
 
     def _get_builds_to_init(self, host):
         domain_host = self.build_domain_host(host)
-        used_slots = self.env['runbot.build'].search_count(domain_host + [('local_state', '=', 'testing')])
-        available_slots = host.get_nb_worker() - used_slots
+        if self._get_scheduler_mode() == 'resources':
+            # allocation already checked that the pending builds fit on the host
+            return self.env['runbot.build'].search(domain_host + [('local_state', '=', 'pending')])
+        host.invalidate_cache(['nb_testing'], host.ids)
+        available_slots = host.get_nb_worker() - host.nb_testing
         if available_slots <= 0:
             return self.env['runbot.build']
         return self.env['runbot.build'].search(domain_host + [('local_state', '=', 'pending')], limit=available_slots)
@@ -548,10 +669,12 @@ class runbot_repo(models.Model):
         Build = self.env['runbot.build']
         domain_host = self.build_domain_host(host)
         testing_builds = Build.search(domain_host + [('local_state', 'in', ['testing', 'pending']), ('requested_action', '!=', 'deathrow')])
-        used_slots = len(testing_builds)
-        available_slots = host.get_nb_worker() - used_slots
+        if self._get_scheduler_mode() == 'resources':
+            has_room = all(remaining > 0 for remaining in self._get_remaining_resources(host))
+        else:
+            has_room = host.get_nb_worker() - len(testing_builds) > 0
         nb_pending = Build.search_count([('local_state', '=', 'pending'), ('host', '=', False)])
-        if available_slots > 0 or nb_pending == 0:
+        if has_room or nb_pending == 0:
             return
         for build in testing_builds:
             top_parent = build._get_top_parent()
@@ -567,15 +690,24 @@ class runbot_repo(models.Model):
                 if newer_candidates:
                     top_parent._ask_kill(message='Build automatically killed, newer build found %s.' % newer_candidates.ids)
 
-    def _allocate_builds(self, host, nb_slots, domain=None):
-        if nb_slots <= 0:
-            return []
+    def _get_non_allocated_where(self, domain=None):
         non_allocated_domain = [('repo_id', 'in', self.ids), ('local_state', '=', 'pending'), ('host', '=', False)]
         if domain:
             non_allocated_domain = expression.AND([non_allocated_domain, domain])
         e = expression.expression(non_allocated_domain, self.env['runbot.build'])
         assert e.get_tables() == ['"runbot_build"']
-        where_clause, where_params = e.to_sql()
+        return e.to_sql()
+
+    _allocation_order = """
+        array_position(array['normal','rebuild','indirect','scheduled']::varchar[], runbot_build.build_type) ASC,
+        runbot_branch.sticky DESC,
+        runbot_branch.priority DESC,
+        runbot_build.sequence ASC"""
+
+    def _allocate_builds(self, host, nb_slots, domain=None):
+        if nb_slots <= 0:
+            return []
+        where_clause, where_params = self._get_non_allocated_where(domain)
 
         # self-assign to be sure that another runbot instance cannot self assign the same builds
         query = """UPDATE
@@ -591,17 +723,63 @@ class runbot_repo(models.Model):
                             WHERE
                                 %s
                             ORDER BY
-                                array_position(array['normal','rebuild','indirect','scheduled']::varchar[], runbot_build.build_type) ASC,
-                                runbot_branch.sticky DESC,
-                                runbot_branch.priority DESC,
-                                runbot_build.sequence ASC
+                                %s
                             FOR UPDATE OF runbot_build SKIP LOCKED
                             LIMIT %%s
                         )
-                    RETURNING id""" % where_clause
+                    RETURNING id""" % (where_clause, self._allocation_order)
         self.env.cr.execute(query, [host.name] + where_params + [nb_slots])
         return self.env.cr.fetchall()
 
+    def _allocate_builds_by_cost(self, host, reserved_cpu=0, domain=None, limit=100):
+        """ Allocates pending builds to the host as long as the cost of their
+        config fits in the remaining capacity of the host, first fit in the
+        usual allocation order so that small builds fill the gaps left by big
+        ones. A build that does not fit and waited more than max_wait seconds
+        stops the packing, leaving the room it needs to the next allocations.
+        """
+        remaining = self._get_remaining_resources(host, reserved_cpu)
+        idle = not self.env['runbot.build'].search_count(self.build_domain_host(host, [('local_state', 'in', ('testing', 'pending'))]))
+        max_wait = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_scheduler_max_wait', 1800))
+        where_clause, where_params = self._get_non_allocated_where(domain)
+
+        # lock the candidates to be sure that another runbot instance cannot self assign the same builds
+        query = """SELECT runbot_build.id, runbot_build.config_id, runbot_build.create_date
+                    FROM runbot_build
+                    LEFT JOIN runbot_branch
+                    ON runbot_branch.id = runbot_build.branch_id
+                    WHERE
+                        %s
+                    ORDER BY
+                        %s
+                    FOR UPDATE OF runbot_build SKIP LOCKED
+                    LIMIT %%s""" % (where_clause, self._allocation_order)
+        self.env.cr.execute(query, where_params + [limit])
+        candidates = self.env.cr.fetchall()
+
+        costs = {}
+        now = datetime.datetime.now()
+        build_ids = []
+        for build_id, config_id, create_date in candidates:
+            if config_id not in costs:
+                costs[config_id] = self.env['runbot.build.config'].browse(config_id)._get_cost() if config_id else (0, 0, 0)
+            cost = costs[config_id]
+            if idle and not build_ids:
+                # a build too big for the host would never start otherwise
+                fits = True
+            else:
+                fits = all(c <= r for c, r in zip(cost, remaining))
+            if fits:
+                build_ids.append(build_id)
+                remaining = [r - c for c, r in zip(cost, remaining)]
+            elif (now - create_date).total_seconds() > max_wait:
+                break
+
+        if not build_ids:
+            return []
+        self.env.cr.execute("UPDATE runbot_build SET host = %s WHERE id IN %s RETURNING id", [host.name, tuple(build_ids)])
+        return self.env.cr.fetchall()
+
     def _domain(self):
         return self.env.get('ir.config_parameter').get_param('runbot.runbot_domain', fqdn())
 
@@ -668,6 +846,8 @@ class runbot_repo(models.Model):
             repos._update(force=False)
             repos._create_pending_builds()
             self._commit()
+            self.env['runbot.dashboard']._refresh()
+            self._commit()
             time.sleep(update_frequency)
 
     def _cron_fetch_and_build(self, hostname):
@@ -764,6 +944,10 @@ class runbot_repo(models.Model):
                     assert 'static' in source_dir
                     shutil.rmtree(source_dir)
                 _logger.info('%s/%s source folder where deleted (%s kept)' % (len(to_delete), len(to_delete+to_keep), len(to_keep)))
+                # objects of the store that are not linked in any remaining source anymore
+                removed = self._source_store().gc()
+                if removed:
+                    _logger.info('%s objects removed from source store', removed)
         except:
             _logger.error('An exception occured while cleaning sources')
             pass
@@ -17,6 +17,19 @@ class ResConfigSettings(models.TransientModel):
     runbot_update_frequency = fields.Integer('Update frequency (in seconds)')
     runbot_template = fields.Char('Postgresql template', help="Postgresql template to use when creating DB's")
     runbot_message = fields.Text('Frontend warning message')
+    runbot_export_mode = fields.Selection([('archive', 'Git archive'), ('store', 'Hardlinked source store')], 'Sources export mode',
+                                          help="Hardlinked source store only writes the files that changed since previously exported commits. "
+                                               "It does not apply the export-ignore and export-subst git attributes, "
+                                               "commits using them are exported with git archive")
+    runbot_sources_mount = fields.Selection([('readonly', 'Read only'), ('overlay', 'Writable overlay')], 'Sources mount',
+                                            help="Writable overlay lets builds write in the sources, the writes being kept in the build directory")
+    runbot_logging_bulk = fields.Boolean('Bulk build logging', help="Stage build log lines and apply them to builds once per scheduler loop instead of once per line")
+    runbot_scheduler = fields.Selection([('slots', 'Fixed number of workers'), ('resources', 'Step costs against host capacity')], 'Build scheduler',
+                                        help="Step costs against host capacity allocates builds according to the cpu, memory and db connections their steps need")
+    runbot_scheduler_max_wait = fields.Integer('Scheduler max wait (in seconds)', help="Stop filling a host with smaller builds once a bigger one waited that long")
+    runbot_db_template_pool_size = fields.Integer('Template databases per host', help="Number of pooled template databases kept on each host")
+    runbot_docker_images = fields.Boolean('Requirements docker images', help="Run builds in images having the requirements of their commits installed, built on each host when first needed")
+    runbot_docker_image_pool_size = fields.Integer('Requirements images per host', help="Number of requirements images kept on each host")
 
     @api.model
     def get_values(self):
@@ -32,6 +45,14 @@ class ResConfigSettings(models.TransientModel):
                    runbot_update_frequency=int(get_param('runbot.runbot_update_frequency', default=10)),
                    runbot_template=get_param('runbot.runbot_db_template'),
                    runbot_message=get_param('runbot.runbot_message', default=''),
+                   runbot_export_mode=get_param('runbot.runbot_export_mode', default='archive'),
+                   runbot_sources_mount=get_param('runbot.runbot_sources_mount', default='readonly'),
+                   runbot_logging_bulk=bool(get_param('runbot.runbot_logging_bulk', default=False)),
+                   runbot_scheduler=get_param('runbot.runbot_scheduler', default='slots'),
+                   runbot_scheduler_max_wait=int(get_param('runbot.runbot_scheduler_max_wait', default=1800)),
+                   runbot_db_template_pool_size=int(get_param('runbot.runbot_db_template_pool_size', default=5)),
+                   runbot_docker_images=bool(get_param('runbot.runbot_docker_images', default=False)),
+                   runbot_docker_image_pool_size=int(get_param('runbot.runbot_docker_image_pool_size', default=10)),
                    )
         return res
 
@@ -48,3 +69,11 @@ class ResConfigSettings(models.TransientModel):
         set_param('runbot.runbot_update_frequency', self.runbot_update_frequency)
         set_param('runbot.runbot_db_template', self.runbot_template)
         set_param('runbot.runbot_message', self.runbot_message)
+        set_param('runbot.runbot_export_mode', self.runbot_export_mode)
+        set_param('runbot.runbot_sources_mount', self.runbot_sources_mount)
+        set_param('runbot.runbot_logging_bulk', self.runbot_logging_bulk)
+        set_param('runbot.runbot_scheduler', self.runbot_scheduler)
+        set_param('runbot.runbot_scheduler_max_wait', self.runbot_scheduler_max_wait)
+        set_param('runbot.runbot_db_template_pool_size', self.runbot_db_template_pool_size)
+        set_param('runbot.runbot_docker_images', self.runbot_docker_images)
+        set_param('runbot.runbot_docker_image_pool_size', self.runbot_docker_image_pool_size)
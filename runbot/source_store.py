@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Content addressed source store
+
+Exporting a commit with `git archive | tar` writes the full tree for every
+new sha. The store keeps one read-only copy of each blob (keyed by blob sha
+and executable bit) and exports a commit by hardlinking those files in the
+destination directory, so that exporting a commit close to an already
+exported one only writes the changed files.
+
+Exports are mounted read-only in the build containers, this is what makes
+sharing inodes between exports safe.
+
+The store writes the tree as committed, it does not apply the `export-ignore`
+and `export-subst` git attributes the way `git archive` does. Commits using
+them are exported with `git archive` instead so that both export modes give
+the same sources.
+
+When testing this file:
+    python3 source_store.py bench <git_dir> <ref> --count 10 --dest /tmp/bench
+"""
+import argparse
+import errno
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+_logger = logging.getLogger(__name__)
+
+MODE_FILE = '100644'
+MODE_EXEC = '100755'
+MODE_LINK = '120000'
+MODE_SUBMODULE = '160000'
+
+
+class SourceStore():
+
+    def __init__(self, path):
+        self.path = path
+
+    def _object_path(self, blob_sha, executable=False):
+        return os.path.join(self.path, blob_sha[:2], blob_sha[2:] + ('.x' if executable else ''))
+
+    def _ls_tree(self, git_dir, sha):
+        """ Returns a list of (mode, blob_sha, path) for every entry of the tree of sha """
+        output = subprocess.check_output(['git', '--git-dir=%s' % git_dir, 'ls-tree', '-r', '-z', '--full-tree', sha])
+        entries = []
+        for record in output.split(b'\0'):
+            if not record:
+                continue
+            meta, path = record.split(b'\t', 1)
+            mode, _type, blob_sha = meta.decode().split(' ')
+            entries.append((mode, blob_sha, os.fsdecode(path)))
+        return entries
+
+    def _fetch_objects(self, git_dir, objects):
+        """ Write missing objects in the store using a single `git cat-file --batch` process
+        :param objects: iterable of (blob_sha, executable) tuples
+        """
+        p = subprocess.Popen(['git', '--git-dir=%s' % git_dir, 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            for blob_sha, executable in objects:
+                p.stdin.write(blob_sha.encode() + b'\n')
+                p.stdin.flush()
+                header = p.stdout.readline().split()
+                if len(header) != 3:
+                    raise subprocess.CalledProcessError(1, 'git cat-file', 'Object %s is missing' % blob_sha)
+                content = p.stdout.read(int(header[2]))
+                p.stdout.read(1)  # trailing newline
+                self._write_object(blob_sha, executable, content)
+        finally:
+            p.stdin.close()
+            p.wait()
+
+    def _write_object(self, blob_sha, executable, content):
+        object_path = self._object_path(blob_sha, executable)
+        object_dir = os.path.dirname(object_path)
+        os.makedirs(object_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=object_dir, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o555 if executable else 0o444)
+        os.replace(tmp_path, object_path)
+
+    def _uses_export_attributes(self, git_dir, entries):
+        """ Returns True if `git archive` would not export the tree as committed """
+        attributes = []
+        info_attributes = os.path.join(git_dir, 'info', 'attributes')
+        if os.path.isfile(info_attributes):
+            with open(info_attributes, 'rb') as f:
+                attributes.append(f.read())
+        for mode, blob_sha, path in entries:
+            if mode == MODE_FILE and os.path.basename(path) == '.gitattributes':
+                attributes.append(subprocess.check_output(['git', '--git-dir=%s' % git_dir, 'cat-file', 'blob', blob_sha]))
+        return any(b'export-ignore' in content or b'export-subst' in content for content in attributes)
+
+    def export(self, git_dir, sha, export_path):
+        """ Export the tree of sha in export_path, hardlinking files from the store
+        returns a (linked, written) tuple with the number of files reused from the store and written in it
+        """
+        entries = self._ls_tree(git_dir, sha)
+        if self._uses_export_attributes(git_dir, entries):
+            _logger.info('%s uses export attributes, exporting it with git archive', sha)
+            err = git_archive_export(git_dir, sha, export_path)
+            if err:
+                raise subprocess.CalledProcessError(1, 'git archive', err)
+            return 0, 0
+        missing = {}
+        for mode, blob_sha, _path in entries:
+            if mode in (MODE_FILE, MODE_EXEC, MODE_LINK):
+                key = (blob_sha, mode == MODE_EXEC)
+                if key not in missing and not os.path.exists(self._object_path(*key)):
+                    missing[key] = True
+        if missing:
+            self._fetch_objects(git_dir, missing.keys())
+
+        os.makedirs(export_path, exist_ok=True)
+        created_dirs = {export_path}
+        for mode, blob_sha, path in entries:
+            dest = os.path.join(export_path, path)
+            parent = os.path.dirname(dest)
+            if parent not in created_dirs:
+                os.makedirs(parent, exist_ok=True)
+                created_dirs.add(parent)
+            if mode == MODE_SUBMODULE:
+                # git archive also exports submodules as empty directories
+                os.makedirs(dest, exist_ok=True)
+                created_dirs.add(dest)
+            elif mode == MODE_LINK:
+                with open(self._object_path(blob_sha), 'rb') as f:
+                    os.symlink(f.read(), os.fsencode(dest))
+            else:
+                object_path = self._object_path(blob_sha, mode == MODE_EXEC)
+                try:
+                    os.link(object_path, dest)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EMLINK):
+                        raise
+                    shutil.copy2(object_path, dest)
+        return len(entries) - len(missing), len(missing)
+
+    def gc(self):
+        """ Remove objects that are not linked in any export anymore
+        returns the number of removed objects
+        """
+        removed = 0
+        if not os.path.isdir(self.path):
+            return removed
+        for object_dir in os.scandir(self.path):
+            if not object_dir.is_dir():
+                continue
+            for entry in os.scandir(object_dir.path):
+                if entry.stat(follow_symlinks=False).st_nlink == 1:
+                    os.unlink(entry.path)
+                    removed += 1
+        return removed
+
+
+def git_archive_export(git_dir, sha, export_path):
+    """ Export the tree of sha in export_path with `git archive | tar` """
+    os.makedirs(export_path, exist_ok=True)
+    p1 = subprocess.Popen(['git', '--git-dir=%s' % git_dir, 'archive', sha], stdout=subprocess.PIPE)
+    p2 = subprocess.Popen(['tar', '-xmC', export_path], stdin=p1.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
+    (_, err) = p2.communicate()
+    return err
+
+
+def disk_usage(*paths):
+    """ Returns the number of bytes used by paths, counting hardlinked files once """
+    seen = set()
+    total = 0
+    for root, dirs, files in (walked for path in paths for walked in os.walk(path)):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+    return total
+
+
+def bench(args):
+    shas = subprocess.check_output(['git', '--git-dir=%s' % args.git_dir, 'rev-list', '--first-parent', '--reverse', '-n', str(args.count), args.ref]).decode().split()
+    dest = args.dest or tempfile.mkdtemp(prefix='runbot_export_bench')
+    archive_dir = os.path.join(dest, 'archive')
+    store_dir = os.path.join(dest, 'store')
+    store = SourceStore(os.path.join(dest, 'objects'))
+    print('%-12s %12s %12s %10s %10s' % ('commit', 'archive (s)', 'store (s)', 'linked', 'written'))
+    archive_total = store_total = 0
+    for sha in shas:
+        start = time.time()
+        git_archive_export(args.git_dir, sha, os.path.join(archive_dir, sha))
+        archive_time = time.time() - start
+        start = time.time()
+        linked, written = store.export(args.git_dir, sha, os.path.join(store_dir, sha))
+        store_time = time.time() - start
+        archive_total += archive_time
+        store_total += store_time
+        print('%-12s %12.2f %12.2f %10s %10s' % (sha[:12], archive_time, store_time, linked, written))
+    print('%-12s %12.2f %12.2f' % ('total', archive_total, store_total))
+    print('disk usage: archive %.1f MB, store %.1f MB' % (disk_usage(archive_dir) / 1e6, disk_usage(store_dir, store.path) / 1e6))
+    if not args.dest:
+        shutil.rmtree(dest)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    parser = argparse.ArgumentParser()
+    subparser = parser.add_subparsers(dest='command', required='True', help='commands')
+    p_bench = subparser.add_parser('bench', help='Compare git archive and store exports over consecutive commits')
+    p_bench.add_argument('git_dir', help='bare repository')
+    p_bench.add_argument('ref', help='last commit of the sequence')
+    p_bench.add_argument('--count', type=int, default=10, help='number of consecutive commits to export')
+    p_bench.add_argument('--dest', help='keep the exports in this directory instead of a temporary one')
+    p_bench.set_defaults(func=bench)
+    args = parser.parse_args()
+    args.func(args)
@@ -10,3 +10,6 @@ from . import test_build_config_step
 from . import test_event
 from . import test_command
 from . import test_build_stat
+from . import test_dashboard
+from . import test_source_store
+from . import test_common
@@ -137,6 +137,113 @@ class Test_Build(RunbotCase):
         })
         self.assertFalse(build5.duplicate_id)
 
+    def test_fingerprint(self):
+        build = self.create_build({
+            'branch_id': self.branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'extra_params': '--foo',
+        })
+        self.assertTrue(build.fingerprint)
+
+        build2 = self.create_build({
+            'branch_id': self.branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'extra_params': '--bar',
+        })
+        self.assertNotEqual(build2.fingerprint, build.fingerprint)
+        self.assertFalse(build2.duplicate_id)
+
+        build2.extra_params = '--foo'
+        self.assertEqual(build2.fingerprint, build.fingerprint, 'The fingerprint should follow the build values')
+
+    def test_claim_port(self):
+        self.env['ir.config_parameter'].set_param('runbot.runbot_starting_port', 2000)
+        builds = self.Build
+        for extra_params in ('1', '2'):
+            builds |= self.create_build({
+                'branch_id': self.branch.id,
+                'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+                'extra_params': extra_params,
+                'host': 'host.runbot.com',
+            })
+        build1, build2 = builds
+        self.assertEqual(build1._claim_port(), 2000)
+        self.assertEqual(build2._claim_port(), 2003)
+
+        build1.local_state = 'done'
+        build3 = self.create_build({
+            'branch_id': self.branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'extra_params': '3',
+            'host': 'host.runbot.com',
+        })
+        self.assertEqual(build3._claim_port(), 2000, 'A port should be released when its build is done')
+        self.assertFalse(self.env['runbot.build.port']._claim(build3, 2003), 'A leased port should not be claimed again')
+
+    def test_db_template_pool(self):
+        Template = self.env['runbot.db.template']
+        builds = self.Build
+        for extra_params in ('1', '2'):
+            builds |= self.create_build({
+                'branch_id': self.branch.id,
+                'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+                'extra_params': extra_params,
+                'host': 'host.runbot.com',
+            })
+        build1, build2 = builds
+
+        template = Template._acquire(build1, 'web, base', '3')
+        self.assertEqual(template.state, 'creating', 'The first build should install the template')
+        self.assertEqual(template.modules, 'base,web')
+        self.assertFalse(Template._acquire(build2, 'base,web', '3'), 'A template being installed should not be used')
+
+        template.state = 'ready'
+        self.assertEqual(Template._acquire(build2, 'base,web', '3'), template)
+        self.assertNotEqual(Template._acquire(build2, 'base', '3'), template, 'Other modules need another template')
+
+    @patch('odoo.addons.runbot.models.module_index.RunbotModuleIndex._scan')
+    def test_module_index(self, mock_scan):
+        mock_scan.return_value = [
+            {'name': 'good_module', 'addons_path': 'addons', 'manifest': '__manifest__.py', 'installable': True, 'depends': ['base']},
+        ]
+        build = self.create_build({
+            'branch_id': self.branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+        })
+        commit = build._get_server_commit()
+        self.assertEqual(list(build._get_available_modules(commit)), [('addons', 'good_module', '__manifest__.py')])
+        self.assertEqual(list(build._get_available_modules(commit)), [('addons', 'good_module', '__manifest__.py')])
+        self.assertEqual(mock_scan.call_count, 1, 'The modules of a commit should only be scanned once')
+
+        self.repo.addons_paths = 'addons'
+        list(build._get_available_modules(commit))
+        self.assertEqual(mock_scan.call_count, 2, 'The commit should be scanned again when the addons paths change')
+
+    @patch('odoo.addons.runbot.models.docker_image.RunbotDockerImage._start_build')
+    @patch('odoo.addons.runbot.models.docker_image.RunbotDockerImage._get_requirements')
+    def test_docker_image(self, mock_get_requirements, mock_start_build):
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_docker_images', True)
+        mock_get_requirements.return_value = ['foo==1.0\n']
+        builds = self.Build
+        for extra_params in ('1', '2'):
+            builds |= self.create_build({
+                'branch_id': self.branch.id,
+                'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+                'extra_params': extra_params,
+                'host': 'host.runbot.com',
+            })
+        build1, build2 = builds
+
+        self.assertFalse(build1._acquire_docker_image(3), 'The image should be built before being used')
+        self.assertEqual(mock_start_build.call_count, 1)
+        self.assertEqual(build1._cmd(py_version=3).pres, [['sudo', 'pip3', 'install', '-r', 'bar/requirements.txt']])
+
+        image = self.env['runbot.docker.image'].search([('host', '=', 'host.runbot.com')])
+        image.state = 'ready'
+        self.assertEqual(build2._acquire_docker_image(3), image.name)
+        self.assertEqual(mock_start_build.call_count, 1, 'A built image should be reused')
+        self.assertEqual(build2._cmd(py_version=3).pres, [], 'Requirements are installed in the image')
+
 
     @patch('odoo.addons.runbot.models.build.runbot_build._get_repo_available_modules')
     def test_filter_modules(self, mock_get_repo_mods):
@@ -356,6 +463,32 @@ class Test_Build(RunbotCase):
         build._local_cleanup()
         self.patchers['_local_pg_dropdb_patcher'].assert_called_with(dbname)
 
+    def test_build_artifacts_cleanup(self):
+        """ test that expired artifacts of the host are removed """
+        build = self.create_build({
+            'branch_id': self.branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'host': 'host.runbot.com',
+            'local_state': 'testing',
+        })
+        Artifact = self.env['runbot.build.artifact']
+        Artifact._register(build, 'workspace', build.dest)
+        Artifact._register(build, 'database', '%s-all' % build.dest)
+        self.start_patcher('clean_workspace_patcher', 'odoo.addons.runbot.models.build.runbot_build._clean_workspace')
+        self.start_patcher('build_os_path_isdir_patcher', 'odoo.addons.runbot.models.build.os.path.isdir', True)
+
+        self.assertEqual(self.Build._local_cleanup_expired(delay=0), 0, 'Artifacts of a testing build should be kept')
+
+        build.write({'local_state': 'done', 'job_end': datetime.datetime.now() - datetime.timedelta(days=31)})
+        self.env['ir.config_parameter'].set_param('runbot.db_gc_days', 60)
+        self.assertEqual(self.Build._local_cleanup_expired(delay=0), 0, 'Artifacts should follow the retention settings')
+
+        self.env['ir.config_parameter'].set_param('runbot.db_gc_days', 30)
+        self.assertEqual(self.Build._local_cleanup_expired(delay=0), 2)
+        self.patchers['_local_pg_dropdb_patcher'].assert_called_with('%s-all' % build.dest)
+        self.assertEqual(self.patchers['clean_workspace_patcher'].call_count, 1)
+        self.assertFalse(Artifact.search([('build_id', '=', build.id)]))
+
     def test_repo_gc_testing(self):
         """ test that builds are killed when room is needed on a host """
         host = self.env['runbot.host'].create({
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import os
+import pwd
 from unittest.mock import patch, mock_open
 from odoo.exceptions import UserError
 from odoo.addons.runbot.models.repo import RunbotException
@@ -264,6 +266,51 @@ class TestBuildConfigStep(RunbotCase):
 
         self.assertEqual(call_count, 1)
 
+    @patch('odoo.addons.runbot.models.build.runbot_build._checkout')
+    def test_resource_limits(self, mock_checkout):
+        config_step = self.ConfigStep.create({
+            'name': 'default',
+            'job_type': 'install_odoo',
+            'memory_limit': 4096,
+            'cpus_limit': 2,
+        })
+
+        def docker_run(cmd, log_path, *args, **kwargs):
+            self.assertEqual(kwargs['memory_limit'], 4096)
+            self.assertEqual(kwargs['cpus'], 2)
+
+        self.patchers['docker_run'].side_effect = docker_run
+        config_step._run_odoo_install(self.parent_build, 'dev/null/logpath')
+        self.assertEqual(self.patchers['docker_run'].call_count, 1)
+
+    @patch('odoo.addons.runbot.models.build.runbot_build._checkout')
+    def test_db_template(self, mock_checkout):
+        config_step = self.ConfigStep.create({
+            'name': 'all',
+            'job_type': 'install_odoo',
+            'db_template_modules': 'base',
+        })
+        db_user = pwd.getpwuid(os.getuid()).pw_name
+        db_name = '%s-all' % self.parent_build.dest
+
+        def docker_run(cmd, log_path, *args, **kwargs):
+            template = self.env['runbot.db.template'].search([('build_id', '=', self.parent_build.id)])
+            self.assertEqual(template.state, 'creating')
+            pip, chain = cmd.build().split(' && ', 1)
+            populate, odoo = chain.split(' ; } && ', 1)
+            self.assertEqual(pip, 'sudo pip3 install -r bar/requirements.txt')
+            self.assertTrue(populate.startswith('{ ( python3 bar/server.py'))
+            self.assertIn('-d %s -i base --stop-after-init' % template.name, populate)
+            self.assertIn('&& createdb -U %s -T %s %s &&' % (db_user, template.name, db_name), populate)
+            self.assertTrue(populate.endswith(') || createdb -U %s --lc-collate=C -E unicode -T template1 %s || true' % (db_user, db_name)),
+                            'A failed template should never prevent the step from running')
+            self.assertTrue(odoo.startswith('python3 bar/server.py'), 'The step should run once the database is created')
+            self.assertIn('-d %s' % db_name, odoo)
+
+        self.patchers['docker_run'].side_effect = docker_run
+        config_step._run_odoo_install(self.parent_build, 'dev/null/logpath')
+        self.assertEqual(self.patchers['docker_run'].call_count, 1)
+
 
 class TestMakeResult(RunbotCase):
 
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
+import json
+import os
+import socketserver
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler
+
 from odoo.tests import common
-from ..container import Command
+from ..container import Command, DockerClient, docker_cgroup_stats, docker_overlay_mount
 from ..container import sanitize_container_name
 
 
@@ -61,3 +68,90 @@ class TestSanitizeContainerName(common.TransactionCase):
         # 5. test both
         invalid_name = '_.3155889-saas-13.4-##container/-all_at_install'
         self.assertEqual(sanitize_container_name(invalid_name), valid_name)
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    routes = {
+        ('GET', '/containers/json'): (200, [{'Names': ['/12345-master-d0d0ca']}]),
+        ('GET', '/containers/12345-master-d0d0ca/json'): (200, {'State': {'Running': True}}),
+        ('GET', '/networks/bridge'): (200, {'IPAM': {'Config': [{'Gateway': '172.17.0.1'}]}}),
+        ('POST', '/containers/12345-master-d0d0ca/stop?t=10'): (204, None),
+    }
+
+    def _reply(self):
+        status, body = self.routes.get((self.command, self.path), (404, {'message': 'not found'}))
+        body = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_DELETE = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDockerClient(common.TransactionCase):
+
+    def test_docker_client(self):
+        tmp_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(tmp_dir, 'docker.sock')
+        server = socketserver.UnixStreamServer(socket_path, FakeDockerHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        client = DockerClient(socket_path)
+        self.assertEqual(client.ps(), ['12345-master-d0d0ca'])
+        self.assertEqual(client.inspect('12345-master-d0d0ca'), {'Running': True})
+        self.assertIsNone(client.inspect('54321-master-d0d0ca'), 'A missing container has no state')
+        self.assertEqual(client.gateway_ip(), '172.17.0.1')
+        client.stop('12345-master-d0d0ca')
+
+
+class TestCgroupStats(common.TransactionCase):
+
+    def test_cgroup_stats(self):
+        build_dir = tempfile.mkdtemp()
+        cgroup_dir = os.path.join(build_dir, 'cgroup-12345-master-d0d0ca_all')
+        os.makedirs(cgroup_dir)
+        files = {
+            'cpu.stat': 'usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\nnr_periods 0\n',
+            'memory.peak': '%s\n' % (512 * 1024 * 1024),
+            'io.stat': '8:0 rbytes=1048576 wbytes=2097152 rios=10 wios=20\n8:16 rbytes=1048576 wbytes=0 rios=1 wios=0\n',
+            'pids.peak': '',  # not readable in the container
+        }
+        for name, content in files.items():
+            with open(os.path.join(cgroup_dir, name), 'w') as f:
+                f.write(content)
+
+        self.assertEqual(docker_cgroup_stats('12345-master-d0d0ca_all', build_dir), {
+            'cgroup.cpu_usage_sec': 2.5,
+            'cgroup.cpu_user_sec': 2,
+            'cgroup.cpu_system_sec': 0.5,
+            'cgroup.memory_peak_mb': 512,
+            'cgroup.io_read_mb': 2,
+            'cgroup.io_write_mb': 2,
+        })
+        self.assertEqual(docker_cgroup_stats('12345-master-d0d0ca_other', build_dir), {}, 'Counters of a killed container are missing')
+
+
+class TestOverlayMount(common.TransactionCase):
+
+    def test_overlay_mount(self):
+        build_dir = tempfile.mkdtemp()
+        mount = docker_overlay_mount(build_dir, 'odoo', '/runbot/static/sources/odoo/d0d0caca')
+        overlay_dir = os.path.join(build_dir, '.overlay', 'odoo')
+        self.assertTrue(os.path.isdir(os.path.join(overlay_dir, 'upper')))
+        self.assertTrue(os.path.isdir(os.path.join(overlay_dir, 'work')))
+        self.assertEqual(mount, ','.join([
+            'type=volume',
+            'dst=/data/build/odoo',
+            'volume-driver=local',
+            'volume-opt=type=overlay',
+            'volume-opt=device=overlay',
+            '"volume-opt=o=lowerdir=/runbot/static/sources/odoo/d0d0caca,upperdir=%s/upper,workdir=%s/work"' % (overlay_dir, overlay_dir),
+        ]))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import contextlib
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+import psycopg2.extensions
+
+from odoo.tests import common
+from ..common import PGADMIN_POOL_MAXCONN, invalidate_local_dbs, list_local_dbs, local_pgadmin_cursor
+
+
+class TestPgadminCursor(common.TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.connections = []
+        patcher = patch('odoo.addons.runbot.common._pgadmin_pool', None)  # pool of mocked connections
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('odoo.addons.runbot.common.psycopg2.connect', side_effect=self._connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _connect(self, *args, **kwargs):
+        cnx = MagicMock(closed=0)
+        cnx.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        cnx.cursor.return_value.connection = cnx
+        self.connections.append(cnx)
+        return cnx
+
+    def test_connection_reused(self):
+        with local_pgadmin_cursor() as local_cr:
+            first_cnx = local_cr.connection
+        with local_pgadmin_cursor() as local_cr:
+            self.assertIs(local_cr.connection, first_cnx)
+        self.assertFalse(first_cnx.close.called)
+
+    def test_broken_connection_discarded(self):
+        with self.assertRaises(psycopg2.OperationalError):
+            with local_pgadmin_cursor() as local_cr:
+                broken_cnx = local_cr.connection
+                raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.assertTrue(broken_cnx.close.called)
+        for _i in range(PGADMIN_POOL_MAXCONN):
+            with local_pgadmin_cursor() as local_cr:
+                self.assertIsNot(local_cr.connection, broken_cnx, 'A broken connection should not be reused')
+
+    def test_pool_exhausted(self):
+        with contextlib.ExitStack() as stack:
+            pooled = {stack.enter_context(local_pgadmin_cursor()).connection for _i in range(PGADMIN_POOL_MAXCONN)}
+            with local_pgadmin_cursor() as local_cr:
+                extra_cnx = local_cr.connection
+            self.assertNotIn(extra_cnx, pooled)
+            self.assertTrue(extra_cnx.close.called, 'Connections above the pool size should be closed after use')
+
+
+class TestListLocalDbs(common.TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        invalidate_local_dbs()
+        self.addCleanup(invalidate_local_dbs)
+        self.local_cr = MagicMock()
+        self.local_cr.connection.server_version = 120000
+        self.local_cr.fetchall.return_value = [('foo-all',), ('bar-all',)]
+        for target in ('odoo.addons.runbot.common.local_pgadmin_cursor', 'odoo.addons.runbot.models.build.local_pgadmin_cursor'):
+            patcher = patch(target)
+            patcher.start().return_value.__enter__.return_value = self.local_cr
+            self.addCleanup(patcher.stop)
+        patcher = patch('odoo.addons.runbot.models.build.subprocess.call')  # filestore cleanup
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _list_queries(self):
+        return [call for call in self.local_cr.execute.call_args_list if 'pg_database' in str(call[0][0])]
+
+    def test_cache(self):
+        self.assertEqual(list_local_dbs(), ['foo-all', 'bar-all'])
+        self.assertEqual(list_local_dbs(), ['foo-all', 'bar-all'])
+        self.assertEqual(len(self._list_queries()), 1, 'Databases should be listed from cache within the ttl')
+
+        list_local_dbs(["datname like 'foo-%'"])
+        self.assertEqual(len(self._list_queries()), 2, 'Each set of conditions should have its own cache')
+
+        with patch('odoo.addons.runbot.common.LOCAL_DBS_CACHE_TTL', 0):
+            list_local_dbs()
+        self.assertEqual(len(self._list_queries()), 3, 'Databases should be listed again after the ttl')
+
+    def test_invalidate(self):
+        build = self.env['runbot.build']
+        list_local_dbs()
+        build._local_pg_dropdb('foo-all')
+        list_local_dbs()
+        self.assertEqual(len(self._list_queries()), 2, 'Dropping a database should invalidate the cache')
+
+        build._local_pg_createdb('foo-all')
+        list_local_dbs()
+        self.assertEqual(len(self._list_queries()), 3, 'Creating a database should invalidate the cache')
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from odoo.tests import tagged
+from .common import RunbotCase
+
+_logger = logging.getLogger(__name__)
+
+
+class DashboardCase(RunbotCase):
+
+    def setUp(self):
+        super(DashboardCase, self).setUp()
+        self.repo = self.Repo.create({'name': 'bla@example.com:foo/bar'})
+        self.sticky_branch = self.Branch.create({
+            'repo_id': self.repo.id,
+            'name': 'refs/heads/master',
+            'sticky': True,
+        })
+        self.branch = self.Branch.create({
+            'repo_id': self.repo.id,
+            'name': 'refs/heads/master-test-moc',
+            'sticky': False,
+        })
+        self.Dashboard = self.env['runbot.dashboard']
+
+
+class TestDashboard(DashboardCase):
+
+    def test_dashboard_aggregates(self):
+        builds = self.Build
+        for i, state in enumerate(['done', 'done', 'pending', 'testing', 'running']):
+            builds |= self.create_build({
+                'branch_id': self.sticky_branch.id,
+                'name': 'd0d0caca000%sffffffffffffffffffffffffffff' % i,
+                'local_state': state,
+                'local_result': 'ok' if state == 'done' else False,
+                'host': 'runbotxx' if state in ('testing', 'running') else False,
+            })
+        self.create_build({
+            'branch_id': self.branch.id,
+            'name': 'deadbeef0000ffffffffffffffffffffffffffff',
+            'local_state': 'pending',
+        })
+
+        self.Dashboard._refresh()
+        self.assertEqual(self.Dashboard._get_build_counts(), {('pending', False): 2, ('testing', False): 1, ('running', False): 1})
+        self.assertEqual(self.Dashboard._get_state_count('testing', host='runbotxx'), 1)
+        self.assertEqual(self.Dashboard._get_state_count('pending', repo_ids=[0]), 0)
+        self.assertEqual(self.Dashboard._get_sticky_build_ids(self.repo.ids), builds[-3:].ids[::-1], 'Only the 3 last builds of sticky branches should be kept')
+        self.assertEqual(self.Dashboard._get_glances(self.repo.ids), [('foo/bar', 'master', 'ok')])
+
+        # aggregates are only updated on refresh
+        builds[2].local_state = 'testing'
+        self.assertEqual(self.Dashboard._get_state_count('testing'), 1)
+        self.Dashboard._refresh()
+        self.assertEqual(self.Dashboard._get_state_count('testing'), 2)
+
+
+@tagged('-standard', 'benchmark')
+class BenchDashboard(DashboardCase):
+    """ Compares the dashboard queries on runbot_build with the aggregates,
+    on a million builds. Run with --test-tags benchmark
+    """
+
+    def test_bench_dashboard(self):
+        self.cr.execute("""
+            INSERT INTO runbot_build (branch_id, repo_id, name, local_state, global_state, local_result, global_result, host, build_type, config_id, hidden, create_date)
+            SELECT
+                CASE WHEN i %% 10 = 0 THEN %(sticky)s ELSE %(branch)s END,
+                %(repo)s,
+                md5(i::text) || 'ffffffff',
+                CASE WHEN i > 999900 THEN (ARRAY['pending', 'testing', 'running'])[i %% 3 + 1] ELSE 'done' END,
+                CASE WHEN i > 999900 THEN (ARRAY['pending', 'testing', 'running'])[i %% 3 + 1] ELSE 'done' END,
+                'ok', 'ok',
+                'runbot' || (i %% 8),
+                'normal',
+                %(config)s,
+                false,
+                now() at time zone 'UTC'
+            FROM generate_series(1, 1000000) AS i
+        """, {
+            'sticky': self.sticky_branch.id,
+            'branch': self.branch.id,
+            'repo': self.repo.id,
+            'config': self.env.ref('runbot.runbot_build_config_default').id,
+        })
+        self.cr.execute("ANALYZE runbot_build")
+
+        def timed(name, func, runs=10):
+            start = time.time()
+            for _ in range(runs):
+                func()
+            _logger.info('%s: %.2fms', name, (time.time() - start) * 1000 / runs)
+
+        def count_builds():
+            for state in ('pending', 'testing', 'running'):
+                self.Build.search_count([('repo_id', '=', self.repo.id), ('local_state', '=', state)])
+                for host in range(8):
+                    self.Build.search_count([('host', '=', 'runbot%s' % host), ('local_state', '=', state)])
+
+        def count_aggregates():
+            for state in ('pending', 'testing', 'running'):
+                self.Dashboard._get_state_count(state, repo_ids=self.repo.ids)
+                for host in range(8):
+                    self.Dashboard._get_state_count(state, host='runbot%s' % host)
+
+        def glances_builds():
+            self.cr.execute("""
+                SELECT br.branch_name, (array_agg(bu.global_result order by bu.id desc))[1]
+                FROM runbot_build bu
+                JOIN runbot_branch br on (br.id = bu.branch_id)
+                WHERE br.sticky AND br.repo_id in %s
+                AND bu.global_state in ('running', 'done')
+                GROUP BY br.id
+            """, [tuple(self.repo.ids)])
+
+        timed('refresh aggregates', self.Dashboard._refresh, runs=3)
+        timed('state counts from runbot_build', count_builds)
+        timed('state counts from aggregates', count_aggregates)
+        timed('glances from runbot_build', glances_builds)
+        timed('glances from aggregates', lambda: self.Dashboard._get_glances(self.repo.ids))
+        timed('sticky builds from aggregates', lambda: self.Dashboard._get_sticky_build_ids(self.repo.ids))
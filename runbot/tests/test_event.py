@@ -69,6 +69,42 @@ class TestIrLogging(RunbotCase):
         log_lines = self.IrLogging.search([('type', '=', 'runbot'), ('name', '=', 'odoo.runbot'), ('func', '=', 'runbot function'), ('message', '=', 'runbot message'), ('level', '=', 'INFO')])
         self.assertEqual(len(log_lines), 1, '_log should be able to add logs from the runbot')
 
+    def test_ir_logging_bulk(self):
+        build = self.create_build({
+            'branch_id': self.branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'port': '1234',
+            'active_step': self.env.ref('runbot.runbot_build_config_step_test_all').id,
+        })
+        build.log_counter = 10
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_logging_bulk', True)
+
+        self.simulate_log(build, 'bulk function', 'bulk message')
+        self.simulate_log(build, 'bulk function', 'bulk message', level='ERROR')
+        self.simulate_log(build, 'bulk function', 'bulk message', level='WARNING')
+        self.assertFalse(self.IrLogging.search([('func', '=', 'bulk function')]), 'Lines should be staged until flushed')
+
+        self.IrLogging._flush_staged_logs()
+        log_lines = self.IrLogging.search([('func', '=', 'bulk function'), ('build_id', '=', build.id)])
+        self.assertEqual(len(log_lines), 3)
+        self.assertEqual(log_lines.mapped('active_step_id'), self.env.ref('runbot.runbot_build_config_step_test_all'), 'The active step should be set on the log lines')
+        self.assertEqual(build.log_counter, 7, 'server lines should decrement the build log_counter')
+        self.assertEqual(build.triggered_result, 'warn', 'The last non info line should set the triggered result')
+
+        # Test the log limit
+        for i in range(11):
+            self.simulate_log(build, 'limit function', 'limit message')
+        self.IrLogging._flush_staged_logs()
+        log_lines = self.IrLogging.search([('build_id', '=', build.id), ('func', '=', 'limit function')])
+        self.assertEqual(len(log_lines), 6, 'Flush should not insert more lines of logs than log_counter')
+        last_log_line = self.IrLogging.search([('build_id', '=', build.id)], order='id DESC', limit=1)
+        self.assertIn('Log limit reached', last_log_line.message, 'Flush should modify last log message')
+        self.assertEqual(build.log_counter, -4)
+
+        # Lines from the runbot itself are not staged
+        build._log('runbot function', 'runbot message')
+        self.assertEqual(len(self.IrLogging.search([('func', '=', 'runbot function')])), 1)
+
     def test_markdown(self):
         log = self.IrLogging.create({
             'name': 'odoo.runbot',
@@ -349,3 +349,66 @@ class Test_Repo_Scheduler(RunbotCase):
         self.Build.search([('name', '=', 'a')]).write({'local_state': 'done'})
 
         self.foo_repo._scheduler(host)
+
+    def test_repo_scheduler_resources(self):
+        self.env['ir.config_parameter'].set_param('runbot.runbot_scheduler', 'resources')
+        host = self.env['runbot.host']._get_current()
+        host.cpu_capacity = 4
+
+        def make_config(name, cpu_cost):
+            step = self.env['runbot.build.config.step'].create({'name': name, 'job_type': 'install_odoo', 'cpu_cost': cpu_cost})
+            return self.env['runbot.build.config'].create({
+                'name': name,
+                'step_order_ids': [(0, 0, {'sequence': 10, 'step_id': step.id})],
+            })
+        heavy_config = make_config('heavy', 3)
+        light_config = make_config('light', 1)
+        self.assertEqual(heavy_config._get_cost(), (3, 2048, 2))
+
+        builds = self.Build
+        for config in (heavy_config, heavy_config, light_config, light_config):
+            builds |= self.create_build({
+                'branch_id': self.foo_branch.id,
+                'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+                'port': '1234',
+                'local_state': 'pending',
+                'config_id': config.id,
+            })
+        heavy1, heavy2, light1, light2 = builds
+
+        self.foo_repo._assign_pending_builds(host, host.get_nb_worker())
+        builds.invalidate_cache()
+        self.assertEqual(heavy1.host, host.name)
+        self.assertFalse(heavy2.host, "a second heavy build does not fit on the host")
+        self.assertEqual(light1.host, host.name, "a light build fills the remaining cpu")
+        self.assertFalse(light2.host)
+
+        # a build bigger than the host still runs alone on an idle host
+        builds.write({'local_state': 'done'})
+        heavy2.write({'local_state': 'pending'})
+        host.cpu_capacity = 2
+        self.foo_repo._assign_pending_builds(host, host.get_nb_worker())
+        heavy2.invalidate_cache()
+        self.assertEqual(heavy2.host, host.name)
+
+    def test_host_counters(self):
+        host = self.env['runbot.host']._get_current()
+        build = self.create_build({
+            'branch_id': self.foo_branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'port': '1234',
+            'local_state': 'testing',
+            'host': host.name,
+        })
+        host.invalidate_cache()
+        self.assertEqual((host.nb_testing, host.nb_running), (1, 0))
+
+        build.local_state = 'running'
+        build.flush()
+        host.invalidate_cache()
+        self.assertEqual((host.nb_testing, host.nb_running), (0, 1))
+
+        build.local_state = 'done'
+        build.flush()
+        host.invalidate_cache()
+        self.assertEqual((host.nb_testing, host.nb_running), (0, 0))
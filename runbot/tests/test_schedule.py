@@ -48,3 +48,58 @@ class TestSchedule(RunbotCase):
         build_ids._schedule()
         self.assertEqual(build.local_state, 'done')
         self.assertEqual(build.local_result, 'ok')
+
+    @patch('odoo.addons.runbot.models.repo.get_docker_event_watcher')
+    def test_schedule_docker_events(self, mock_watcher):
+        """ Test that builds with a running container are not visited when docker events are watched """
+        watcher = mock_watcher.return_value
+        host = self.env['runbot.host'].create({'name': 'runbotxx'})
+        build = self.Build.create({
+            'local_state': 'testing',
+            'branch_id': self.branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'port': '1234',
+            'host': 'runbotxx',
+            'job_start': datetime.datetime.now(),
+            'config_id': self.env.ref('runbot.runbot_build_config_default').id,
+            'active_step': self.env.ref('runbot.runbot_build_config_step_test_all').id,
+        })
+
+        watcher.is_running.return_value = True
+        self.assertFalse(self.repo._get_builds_to_schedule(host), 'A running container should not be visited')
+
+        build.job_start = datetime.datetime.now() - datetime.timedelta(seconds=20000)
+        self.assertEqual(self.repo._get_builds_to_schedule(host), build, 'A timed out build should be visited')
+
+        build.job_start = datetime.datetime.now()
+        watcher.is_running.return_value = False
+        self.assertEqual(self.repo._get_builds_to_schedule(host), build, 'An ended container should be visited')
+
+    @patch('odoo.addons.runbot.models.build.runbot_build._github_status')
+    @patch('odoo.addons.runbot.models.build.docker_stop')
+    def test_kill_timed_out_builds(self, mock_docker_stop, mock_github_status):
+        """ Test that timed out builds with a running container are killed in one pass """
+        host = self.env['runbot.host'].create({'name': 'host.runbot.com'})
+        builds = self.Build
+        for job_start in (20000, 20000, 10, 20000):
+            builds |= self.Build.create({
+                'local_state': 'testing',
+                'branch_id': self.branch.id,
+                'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+                'port': '1234',
+                'host': 'host.runbot.com',
+                'job_start': datetime.datetime.now() - datetime.timedelta(seconds=job_start),
+                'config_id': self.env.ref('runbot.runbot_build_config_default').id,
+                'active_step': self.env.ref('runbot.runbot_build_config_step_test_all').id,
+            })
+        timed_out, timed_out_2, recent, ended = builds
+        ended_container = ended._get_docker_name()
+
+        killed = self.repo._kill_timed_out_builds(host, lambda container_name: container_name != ended_container)
+
+        self.assertEqual(killed, timed_out | timed_out_2)
+        self.assertEqual(mock_docker_stop.call_count, 2)
+        self.assertEqual((timed_out | timed_out_2).mapped('local_state'), ['done'])
+        self.assertEqual((timed_out | timed_out_2).mapped('local_result'), ['killed'])
+        self.assertEqual(recent.local_state, 'testing')
+        self.assertEqual(ended.local_state, 'testing', 'An ended container should get its results computed instead')
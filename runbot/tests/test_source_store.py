@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+import tempfile
+
+from odoo.tests import common
+from ..source_store import SourceStore
+
+
+class TestSourceStore(common.TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.work_tree = os.path.join(self.tmp_dir, 'repo')
+        self.git_dir = os.path.join(self.work_tree, '.git')
+        self._git('init', '-q', self.work_tree)
+        self.store = SourceStore(os.path.join(self.tmp_dir, 'store'))
+
+    def _git(self, *args):
+        return subprocess.check_output(['git', '-c', 'user.name=runbot', '-c', 'user.email=runbot@example.com'] + list(args)).decode().strip()
+
+    def _commit(self, files):
+        for path, content in files.items():
+            full_path = os.path.join(self.work_tree, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'w') as f:
+                f.write(content)
+        self._git('-C', self.work_tree, 'add', '-A')
+        self._git('-C', self.work_tree, 'commit', '-q', '-m', 'commit')
+        return self._git('-C', self.work_tree, 'rev-parse', 'HEAD')
+
+    def _export(self, sha):
+        export_path = os.path.join(self.tmp_dir, 'exports', sha)
+        return export_path, self.store.export(self.git_dir, sha, export_path)
+
+    def _inode(self, *path):
+        return os.stat(os.path.join(*path)).st_ino
+
+    def test_export(self):
+        sha1 = self._commit({'README': 'readme', 'addons/foo/__init__.py': 'foo'})
+        sha2 = self._commit({'addons/foo/__init__.py': 'bar'})
+
+        export1, (linked, written) = self._export(sha1)
+        self.assertEqual((linked, written), (0, 2))
+        with open(os.path.join(export1, 'addons/foo/__init__.py')) as f:
+            self.assertEqual(f.read(), 'foo')
+
+        export2, (linked, written) = self._export(sha2)
+        self.assertEqual((linked, written), (1, 1))
+        self.assertEqual(self._inode(export1, 'README'), self._inode(export2, 'README'), 'Unchanged file should be hardlinked')
+        self.assertNotEqual(self._inode(export1, 'addons/foo/__init__.py'), self._inode(export2, 'addons/foo/__init__.py'), 'Changed file should be rewritten')
+        with open(os.path.join(export2, 'addons/foo/__init__.py')) as f:
+            self.assertEqual(f.read(), 'bar')
+
+    def test_gc(self):
+        sha1 = self._commit({'README': 'readme', 'foo.py': 'foo'})
+        sha2 = self._commit({'foo.py': 'bar'})
+        export1, _ = self._export(sha1)
+        export2, _ = self._export(sha2)
+
+        self.assertEqual(self.store.gc(), 0, 'Objects linked in an export should be kept')
+
+        shutil.rmtree(export1)
+        self.assertEqual(self.store.gc(), 1, 'Only the object of the removed version of foo.py should be removed')
+        self.assertEqual(os.stat(os.path.join(export2, 'README')).st_nlink, 2)
+        self.assertEqual(os.stat(os.path.join(export2, 'foo.py')).st_nlink, 2)
+
+        shutil.rmtree(export2)
+        self.assertEqual(self.store.gc(), 2)
+
+    def test_export_attributes(self):
+        sha = self._commit({'.gitattributes': 'ignored.txt export-ignore\n', 'ignored.txt': 'ignored', 'README': 'readme'})
+        export_path, (linked, written) = self._export(sha)
+        self.assertEqual((linked, written), (0, 0), 'Commits using export attributes should be exported with git archive')
+        self.assertTrue(os.path.isfile(os.path.join(export_path, 'README')))
+        self.assertFalse(os.path.exists(os.path.join(export_path, 'ignored.txt')))
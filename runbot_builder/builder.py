@@ -2,7 +2,9 @@
 import argparse
 import logging
 import os
+import select
 import sys
+import time
 import threading
 import signal
 
@@ -18,9 +20,17 @@ _logger = logging.getLogger(__name__)
 
 class RunbotClient():
 
-    def __init__(self, env):
+    def __init__(self, env, docker_events=False, housekeeping_interval=60, full_cleanup_interval=86400):
         self.env = env
+        self.docker_events = docker_events
+        self.housekeeping_interval = housekeeping_interval
+        self.full_cleanup_interval = full_cleanup_interval
+        self.last_full_cleanup = 0
+        self.last_conn_count = 0
         self.ask_interrupt = threading.Event()
+        # sources cleanup must not run while builds are being allocated and initialized
+        self.sources_lock = threading.Lock()
+        self.listener = None
 
     def main_loop(self):
         from odoo import fields
@@ -28,25 +38,26 @@ class RunbotClient():
         signal.signal(signal.SIGTERM, self.signal_handler)
         host = self.env['runbot.host']._get_current()
         host._bootstrap()
-        count = 0
+        self.env.cr.commit()
+        housekeeping = threading.Thread(target=self.housekeeping_loop, args=(host.id,), name='runbot-housekeeping', daemon=True)
+        housekeeping.start()
+        self.listen()
+        _logger.info('Scheduling...')
         while True:
             try:
+                # config parameters are cached, pick up the ones changed by other processes
+                self.env.registry.check_signaling()
                 host.last_start_loop = fields.Datetime.now()
-                count = count % 60
-                if count == 0:
-                    logging.info('Host %s running with %s slots on pid %s%s', host.name, host.get_nb_worker(), os.getpid(), ' (assigned only)' if host.assigned_only else '')
-                    self.env['runbot.repo']._source_cleanup()
-                    self.env['runbot.build']._local_cleanup()
-                    self.env['runbot.repo']._docker_cleanup()
+                if time.time() - self.last_conn_count > self.housekeeping_interval:
+                    # written by the main loop transaction like the loop times, the host row being updated every turn
                     host.set_psql_conn_count()
-                    host._docker_build()
-                    _logger.info('Scheduling...')
-                count += 1
-                sleep_time = self.env['runbot.repo']._scheduler_loop_turn(host)
+                    self.last_conn_count = time.time()
+                with self.sources_lock:
+                    sleep_time = self.env['runbot.repo']._scheduler_loop_turn(host)
                 host.last_end_loop = fields.Datetime.now()
                 self.env.cr.commit()
                 self.env.clear()
-                self.sleep(sleep_time)
+                self.wait(sleep_time)
             except Exception as e:
                 _logger.exception('Builder main loop failed with: %s', e)
                 self.env.cr.rollback()
@@ -54,6 +65,98 @@ class RunbotClient():
                 self.sleep(10)
 
             if self.ask_interrupt.is_set():
+                self.close_listener()
+                return
+
+    def housekeeping_loop(self, host_id):
+        """ Runs the slow cleanups on their own cursor so that they don't
+        delay the allocation of builds in the main loop
+        """
+        import odoo
+        with odoo.api.Environment.manage():
+            while not self.ask_interrupt.is_set():
+                try:
+                    self.env.registry.check_signaling()
+                    with self.env.registry.cursor() as cr:
+                        env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+                        self.housekeeping(env, env['runbot.host'].browse(host_id))
+                except Exception as e:
+                    _logger.exception('Builder housekeeping failed with: %s', e)
+                self.sleep(self.housekeeping_interval)
+
+    def housekeeping(self, env, host):
+        _logger.info('Host %s running with %s slots on pid %s%s', host.name, host.get_nb_worker(), os.getpid(), ' (assigned only)' if host.assigned_only else '')
+        with self.sources_lock:
+            env['runbot.repo']._source_cleanup()
+        if time.time() - self.last_full_cleanup > self.full_cleanup_interval:
+            # catches what is missing from the artifacts inventory
+            env['runbot.build']._local_cleanup()
+            self.last_full_cleanup = time.time()
+        while env['runbot.build']._local_cleanup_expired() and not self.ask_interrupt.is_set():
+            pass
+        env['runbot.repo']._docker_cleanup()
+        host._docker_build()
+        env.cr.commit()
+        if self.docker_events:
+            # (re)start the watcher, scheduling falls back to polling if it died
+            from odoo.addons.runbot.container import start_docker_event_watcher
+            start_docker_event_watcher()
+
+    def listen(self):
+        """ Opens the listener, a connection notified on the runbot_build
+        channel when builds are created, killed or forced. The listener is
+        None if the connection failed, the builder polling meanwhile.
+        """
+        import odoo
+        import psycopg2
+        from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+        try:
+            self.listener = odoo.sql_db.db_connect(self.env.cr.dbname).cursor()
+            self.listener._cnx.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            self.listener.execute('LISTEN runbot_build')
+        except psycopg2.Error as e:
+            _logger.warning('Cannot listen to build notifications, polling instead: %s', e)
+            self.close_listener()
+
+    def close_listener(self):
+        if self.listener is not None:
+            try:
+                self.listener.close()
+            except Exception as e:
+                _logger.debug('Error while closing the listener: %s', e)
+            self.listener = None
+
+    def wait(self, timeout):
+        """ Waits up to timeout seconds, returning as soon as a build
+        notification is received or an interruption is asked
+        """
+        import psycopg2
+        if self.listener is None:
+            self.listen()
+            if self.listener is None:
+                self.sleep(timeout)
+                return
+        conn = self.listener._cnx
+        end = time.time() + timeout
+        while not self.ask_interrupt.is_set():
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            try:
+                # wake up regularly to check for interruptions
+                if select.select([conn], [], [], min(remaining, 1)) != ([], [], []):
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, OSError, ValueError) as e:
+                # ValueError/OSError when select is given the fd of a closed connection
+                _logger.warning('Build notifications connection lost, reconnecting: %s', e)
+                self.close_listener()
+                self.listen()
+                if self.listener is None:
+                    self.sleep(end - time.time())
+                # notifications may have been missed while disconnected
                 return
 
     def signal_handler(self, signal, frame):
@@ -78,6 +181,9 @@ def run():
     parser.add_argument('--db_password')
     parser.add_argument('-d', '--database', default='runbot', help='name of runbot db')
     parser.add_argument('--logfile', default=False)
+    parser.add_argument('--docker-events', action='store_true', help='Follow docker events instead of polling each testing build')
+    parser.add_argument('--housekeeping-interval', type=int, default=60, help='Seconds between two cleanups of sources, databases and containers')
+    parser.add_argument('--full-cleanup-interval', type=int, default=86400, help='Seconds between two scans of all databases and build directories')
     args = parser.parse_args()
     if args.logfile:
         dirname = os.path.dirname(args.logfile)
@@ -106,7 +212,7 @@ def run():
     with odoo.api.Environment.manage():
         with registry.cursor() as cr:
             env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
-            runbot_client = RunbotClient(env)
+            runbot_client = RunbotClient(env, docker_events=args.docker_events, housekeeping_interval=args.housekeeping_interval, full_cleanup_interval=args.full_cleanup_interval)
             # run main loop
             runbot_client.main_loop()
 
@@ -29,9 +29,10 @@ class MergebotController(Controller):
         repo = request.jsonrequest['repository']['full_name']
         env = request.env(user=1)
 
-        secret = env['runbot_merge.repository'].search([
+        project = env['runbot_merge.repository'].search([
             ('name', '=', repo),
-        ]).project_id.secret
+        ]).project_id
+        secret = project.secret
         if secret:
             signature = 'sha1=' + hmac.new(secret.encode('ascii'), req.get_data(), hashlib.sha1).hexdigest()
             if not hmac.compare_digest(signature, req.headers.get('X-Hub-Signature', '')):
@@ -39,6 +40,9 @@ class MergebotController(Controller):
                              req.headers.get('X-Hub-Signature'))
                 return werkzeug.exceptions.Forbidden()
 
+        if project.queue_webhooks and event != 'ping':
+            return queue_event(env, event, req.headers.get('X-Github-Delivery'), request.jsonrequest)
+
         return c(env, request.jsonrequest)
 
     def _format(self, request):
@@ -54,6 +58,26 @@ vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv
             body=utils.shorten(request.get_data(as_text=True).strip(), 400)
         )
 
+def queue_event(env, event_type, delivery, event):
+    """ Stores the event for the events cron (runbot_merge.event._process)
+    instead of handling it during the webhook request
+    """
+    Events = env['runbot_merge.event']
+    if delivery and Events.search_count([('delivery', '=', delivery)]):
+        return 'Already queued'
+
+    coalesce_key = False
+    if event_type == 'status':
+        # only the last status of a context matters
+        coalesce_key = 'status:%s:%s' % (event['sha'], event['context'])
+    Events.create({
+        'event': event_type,
+        'delivery': delivery,
+        'payload': json.dumps(event),
+        'coalesce_key': coalesce_key,
+    })
+    return 'Queued'
+
 def handle_pr(env, event):
     if event['action'] in [
         'assigned', 'unassigned', 'review_requested', 'review_request_removed',
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from odoo.http import Controller, route, request
 
+from .. import github
+
 LIMIT = 20
 class MergebotDashboard(Controller):
     @route('/runbot_merge', auth="public", type="http", website=True)
@@ -21,3 +23,10 @@ class MergebotDashboard(Controller):
             'stagings': stagings[:LIMIT],
             'next': stagings[-1].staged_at if len(stagings) > LIMIT else None,
         })
+
+    @route('/runbot_merge/github_stats', auth='user', type='json')
+    def github_stats(self):
+        """ Conditional requests cache counters and remaining github quota
+        (of the current worker)
+        """
+        return github.cache.report()
@@ -7,6 +7,7 @@ import os
 import pathlib
 import pprint
 import textwrap
+import threading
 import unicodedata
 
 import requests
@@ -46,6 +47,20 @@ def _init_gh_logger():
 if odoo.netsvc._logger_init:
     _init_gh_logger()
 
+# base urls of the API and of the git remotes, can be overridden to run
+# against a stand-in (e.g. the github emulator of the test suite)
+API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+WEB_URL = os.environ.get('GITHUB_URL', 'https://github.com')
+
+def git_url(repository, login=None, token=None):
+    """ Returns the url to clone from / push to ``repository`` (an
+    ``owner/name`` string), with the credentials embedded if provided
+    """
+    url = werkzeug.urls.url_parse(WEB_URL)
+    if token:
+        url = url.replace(netloc='{}:{}@{}'.format(login, token, url.netloc))
+    return '{}/{}'.format(url.to_url(), repository)
+
 GH_LOG_PATTERN = """=> {method} /{self._repo}/{path}{qs}{body}
 
 <= {r.status_code} {r.reason}
@@ -53,13 +68,82 @@ GH_LOG_PATTERN = """=> {method} /{self._repo}/{path}{qs}{body}
 {body2}
 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
 """
+class ResponseCache(object):
+    """ LRU of the last GET responses carrying an ETag or a Last-Modified,
+    used to send conditional requests: github replies 304 (which does not
+    count against the rate limit) if the resource did not change, and the
+    cached response is used instead.
+    """
+    def __init__(self, size=1000):
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.rate_limits = {}
+
+    def get(self, key):
+        with self._lock:
+            r = self._entries.get(key)
+            if r is not None:
+                self._entries.move_to_end(key)
+            return r
+
+    def set(self, key, response):
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def record(self, token_key, response, conditional):
+        """ Updates the counters after a request """
+        self.stats['requests'] += 1
+        if conditional:
+            self.stats['conditional'] += 1
+        if response.status_code == 304:
+            self.stats['not_modified'] += 1
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        if remaining is not None:
+            self.rate_limits[token_key] = {
+                'limit': int(response.headers.get('X-RateLimit-Limit', 0)),
+                'remaining': int(remaining),
+                'reset': int(response.headers.get('X-RateLimit-Reset', 0)),
+            }
+
+    def report(self):
+        """ Returns the cache counters, the ratio of requests answered by a
+        304 and the last known rate limit of each token (identified by its
+        last 4 characters)
+        """
+        stats = dict(self.stats)
+        stats['hit_ratio'] = self.stats['not_modified'] / self.stats['requests'] if self.stats['requests'] else 0.0
+        stats['rate_limits'] = dict(self.rate_limits)
+        return stats
+
+cache = ResponseCache()
+_sessions = {}
+_sessions_lock = threading.Lock()
+def _session_for(token):
+    """ Returns a session per token so connections to github are kept alive
+    and reused between GH instances
+    """
+    with _sessions_lock:
+        session = _sessions.get(token)
+        if session is None:
+            session = _sessions[token] = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Authorization'] = 'token {}'.format(token)
+            session.headers['Accept'] = 'application/vnd.github.symmetra-preview+json'
+        return session
+
 class GH(object):
-    def __init__(self, token, repo):
-        self._url = 'https://api.github.com'
+    def __init__(self, token, repo, url=None):
+        self._url = url or API_URL
         self._repo = repo
-        session = self._session = requests.Session()
-        session.headers['Authorization'] = 'token {}'.format(token)
-        session.headers['Accept'] = 'application/vnd.github.symmetra-preview+json'
+        self._token_key = (token or '')[-4:]
+        self._session = _session_for(token)
 
     def _log_gh(self, logger, method, path, params, json, response, level=logging.INFO):
         """ Logs a pair of request / response to github, to the specified
@@ -68,7 +152,12 @@ class GH(object):
         Tries to format all the information (including request / response
         bodies, at least in part) so we have as much information as possible
         for post-mortems.
+
+        Nothing is formatted if the logger is not enabled for the level.
         """
+        if not logger.isEnabledFor(level):
+            return ''
+
         body = body2 = ''
 
         if json:
@@ -104,13 +193,28 @@ class GH(object):
         """
         :type check: bool | dict[int:Exception]
         """
-        r = self._session.request(
-            method,
-            '{}/repos/{}/{}'.format(self._url, self._repo, path),
-            params=params,
-            json=json
-        )
+        url = '{}/repos/{}/{}'.format(self._url, self._repo, path)
+        headers = {}
+        cache_key = cached = None
+        if method.lower() == 'get':
+            cache_key = (self._session.headers['Authorization'], url, tuple(sorted((params or {}).items())))
+            cached = cache.get(cache_key)
+            if cached is not None:
+                if cached.headers.get('ETag'):
+                    headers['If-None-Match'] = cached.headers['ETag']
+                if cached.headers.get('Last-Modified'):
+                    headers['If-Modified-Since'] = cached.headers['Last-Modified']
+
+        r = self._session.request(method, url, params=params, json=json, headers=headers)
+        cache.record(self._token_key, r, bool(headers))
+        if r.status_code == 304 and cached is not None:
+            _gh.debug("=> %s /%s/%s <= 304 Not Modified (cached)", method, self._repo, path)
+            return cached
+
         self._log_gh(_gh, method, path, params, json, r)
+        if cache_key and r.status_code == 200 and (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+            r.content  # make sure the body is loaded before storing the response
+            cache.set(cache_key, r)
         if check:
             if isinstance(check, collections.Mapping):
                 exc = check.get(r.status_code)
@@ -64,6 +64,10 @@ class Project(models.Model):
              "of (valid) incoming webhook signatures, failing signatures "
              "will lead to webhook rejection. Should only use ASCII."
     )
+    queue_webhooks = fields.Boolean(
+        help="Store incoming webhooks and handle them asynchronously, in "
+             "batches, rather than during the webhook request"
+    )
 
     def _create_stagings(self, commit=False):
         pass
@@ -170,7 +174,8 @@ class Project(models.Model):
         }).json()
         gh('POST', 'deployments/{}/statuses'.format(deployment['id']), json={
             'state': 'success',
-            'target_url': 'https://github.com/{}/commit/{}'.format(
+            'target_url': '{}/{}/commit/{}'.format(
+                github.WEB_URL,
                 pr.repository.name,
                 payload['sha'],
             ),
@@ -537,7 +542,7 @@ For-Commit-Id: %s
         # v1 protocol provides URL for ref discovery: https://github.com/git/git/blob/6e0cc6776106079ed4efa0cc9abace4107657abf/Documentation/technical/http-protocol.txt#L187
         # for more complete client this is also the capabilities discovery and
         # the "entry point" for the service
-        url = 'https://github.com/{}.git/info/refs?service=git-upload-pack'.format(repo.name)
+        url = '{}/{}.git/info/refs?service=git-upload-pack'.format(github.WEB_URL, repo.name)
         with requests.get(url, stream=True, auth=(token, '')) as resp:
             if not resp.ok:
                 return False
@@ -1888,6 +1893,57 @@ class FetchJob(models.Model):
     repository = fields.Many2one('runbot_merge.repository', required=True)
     number = fields.Integer(required=True)
 
+class Event(models.Model):
+    """ Webhook stored by the controller, to be handled by the events cron
+    """
+    _name = _description = 'runbot_merge.event'
+    _order = 'id'
+
+    event = fields.Char(required=True, help="X-Github-Event header")
+    delivery = fields.Char(index=True, help="X-Github-Delivery header, identical on redeliveries")
+    payload = fields.Text(required=True, help="json-encoded event body")
+    coalesce_key = fields.Char(
+        help="Events with the same key only need the last one handled, e.g. "
+             "statuses for the same sha and context"
+    )
+
+    def _process(self, batch_size=100, commit=False):
+        """ Handles stored events in batches, oldest first. Events
+        superseded by a newer event of the same batch are skipped.
+
+        :param bool commit: commit after each batch
+        """
+        env = self.env(user=1)
+        while True:
+            self.env.cr.execute("""
+            SELECT id FROM runbot_merge_event
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+            """, [batch_size])
+            batch = self.browse(id_ for [id_] in self.env.cr.fetchall())
+            if not batch:
+                return
+
+            last = {e.coalesce_key: e for e in batch if e.coalesce_key}
+            skipped = 0
+            for e in batch:
+                if e.coalesce_key and last[e.coalesce_key] != e:
+                    skipped += 1
+                    continue
+                handler = controllers.EVENTS[e.event]
+                self.env.cr.execute("SAVEPOINT runbot_merge_before_event")
+                try:
+                    handler(env, json.loads(e.payload))
+                except Exception:
+                    self.env.cr.execute("ROLLBACK TO SAVEPOINT runbot_merge_before_event")
+                    _logger.exception("Failed to handle %s event %s, skipping it", e.event, e.delivery)
+                self.env.cr.execute("RELEASE SAVEPOINT runbot_merge_before_event")
+            _logger.info("Handled %d events (%d superseded)", len(batch) - skipped, skipped)
+            batch.unlink()
+            if commit:
+                self.env.cr.commit()
+
 # The commit (and PR) statuses was originally a map of ``{context:state}``
 # however it turns out to clarify error messages it'd be useful to have
 # a bit more information e.g. a link to the CI's build info on failure and
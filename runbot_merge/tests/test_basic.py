@@ -324,6 +324,35 @@ class TestWebhookSecurity:
             ('number', '=', pr0.number),
         ])
 
+def test_queued_webhooks(env, project, repo):
+    """ With queue_webhooks, hooks are only handled by the events cron, and
+    successive statuses of a context are coalesced
+    """
+    project.queue_webhooks = True
+    with repo:
+        m = repo.make_commit(None, "initial", None, tree={'a': 'some content'})
+        repo.make_ref('heads/master', m)
+
+        c0 = repo.make_commit(m, 'replace file contents', None, tree={'a': 'some other content'})
+        pr0 = repo.make_pr(title="gibberish", body="blahblah", target='master', head=c0)
+        repo.post_status(c0, 'pending', 'ci/runbot')
+        repo.post_status(c0, 'success', 'ci/runbot')
+
+    assert not env['runbot_merge.pull_requests'].search([
+        ('repository.name', '=', repo.name),
+        ('number', '=', pr0.number),
+    ])
+    assert env['runbot_merge.event'].search_count([]) == 3
+
+    env.run_crons('runbot_merge.process_events')
+    assert not env['runbot_merge.event'].search_count([])
+    assert env['runbot_merge.pull_requests'].search([
+        ('repository.name', '=', repo.name),
+        ('number', '=', pr0.number),
+    ])
+    c = env['runbot_merge.commit'].search([('sha', '=', c0)])
+    assert json.loads(c.statuses)['ci/runbot']['state'] == 'success'
+
 def test_staging_conflict(env, repo, config):
     with repo:
         # create base branch
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+""" End-to-end benchmarks of the merge bot, only run against the github
+emulator as they replay synthetic workloads too large for github::
+
+    pytest --github-emulator --addons-path=... -k benchmark runbot_merge \\
+        --bench-prs=50 --bench-statuses=5 --bench-failures=2
+
+The workload is ``--bench-prs`` independent PRs each getting
+``--bench-statuses`` statuses then an r+, which are then staged until all
+are merged, the first ``--bench-failures`` stagings of more than one batch
+failing (which splits them).
+
+Reports the time spent staging and merging, the time taken by the mergebot
+to handle each kind of webhook and the number of API calls the mergebot made
+per merged PR.
+"""
+import time
+
+import pytest
+
+def _summary(durations):
+    durations = sorted(durations)
+    if not durations:
+        return 'n/a'
+    return 'mean %.3fs p50 %.3fs p95 %.3fs max %.3fs (%d)' % (
+        sum(durations) / len(durations),
+        durations[len(durations) // 2],
+        durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        durations[-1],
+        len(durations),
+    )
+
+@pytest.fixture
+def emulator(github_emulator):
+    if not github_emulator:
+        pytest.skip("benchmarks only run against the github emulator (--github-emulator)")
+    github_emulator.reset_stats()
+    return github_emulator
+
+def test_benchmark_staging(env, emulator, make_repo, setreviewers, config, pytestconfig, capsys):
+    prs_count = pytestconfig.getoption('--bench-prs')
+    statuses_count = pytestconfig.getoption('--bench-statuses')
+    failures = pytestconfig.getoption('--bench-failures')
+    contexts = ['ci'] + ['extra/%d' % i for i in range(1, statuses_count)]
+
+    bot = emulator.add_user('bench-mergebot')
+    repo = make_repo('bench')
+    project = env['runbot_merge.project'].create({
+        'name': 'bench',
+        'github_token': bot.token,
+        'github_prefix': 'hansen',
+        'branch_ids': [(0, 0, {'name': 'master'})],
+        'repo_ids': [(0, 0, {'name': repo.name, 'required_statuses': 'ci'})],
+    })
+    setreviewers(*project.repo_ids)
+
+    setup_start = time.time()
+    with repo:
+        [m] = repo.make_commits(None, repo.Commit('initial', tree={'m': 'm'}), ref='heads/master')
+        prs = []
+        for i in range(prs_count):
+            [c] = repo.make_commits(m, repo.Commit('pr %d' % i, tree={'f%d' % i: str(i)}), ref='heads/bench%d' % i)
+            pr = repo.make_pr(target='master', head='bench%d' % i)
+            for context in contexts:
+                repo.post_status(c, 'success', context)
+            pr.post_comment('hansen r+', config['role_reviewer']['token'])
+            prs.append(pr)
+    setup_time = time.time() - setup_start
+
+    pr_ids = env['runbot_merge.pull_requests'].search([('repository.name', '=', repo.name)])
+    assert len(pr_ids) == prs_count
+
+    staging_times = []
+    merge_times = []
+    merged_after = {}
+    start = time.time()
+    for _ in range(prs_count * 4):
+        t0 = time.time()
+        env.run_crons()
+        staging_times.append(time.time() - t0)
+
+        staging = env['runbot_merge.stagings'].search([('target.project_id', '=', project.id)])
+        if not staging:
+            break
+        fail = failures and len(staging.batch_ids) > 1
+        failures -= bool(fail)
+        with repo:
+            repo.post_status('heads/staging.master', 'failure' if fail else 'success', 'ci')
+
+        t0 = time.time()
+        env.run_crons()
+        merge_times.append(time.time() - t0)
+        merged = env['runbot_merge.pull_requests'].search([
+            ('id', 'in', pr_ids.ids),
+            ('state', '=', 'merged'),
+        ])
+        for pr_id in merged.ids:
+            merged_after.setdefault(pr_id, time.time() - start)
+    total = time.time() - start
+
+    assert len(merged_after) == prs_count, "all PRs should have been merged"
+
+    bot_calls = emulator.stats.api_calls(bot.login)
+    report = emulator.stats.report()
+    with capsys.disabled():
+        print()
+        print("benchmark: %d PRs, %d statuses per PR, %d stagings" % (
+            prs_count, statuses_count, len(merge_times)))
+        print("  setup (PRs, statuses, r+): %.3fs" % setup_time)
+        print("  staging crons:   %s" % _summary(staging_times))
+        print("  validation crons: %s" % _summary(merge_times))
+        print("  PR merged after: %s" % _summary(merged_after.values()))
+        print("  all PRs merged in %.3fs" % total)
+        for event, durations in sorted(emulator.stats.deliveries.items()):
+            print("  webhook %-20s %s" % (event, _summary(durations)))
+        print("  failed webhook deliveries: %d" % report['failed_deliveries'])
+        print("  mergebot API calls: %d (%.1f per merged PR)" % (bot_calls, bot_calls / prs_count))
+        for (login, method, pattern), count in sorted(report['api_calls'].items(), key=lambda i: -i[1]):
+            if login == bot.login:
+                print("    %5d %-6s %s" % (count, method, pattern))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import http.server
+import json
+import threading
+
+import pytest
+
+import odoo
+
+@pytest.fixture(scope='module')
+def github(request):
+    odoo.tools.config['addons_path'] = request.config.getoption('--addons-path')
+    odoo.modules.module.initialize_sys_path()
+    from odoo.addons.runbot_merge import github
+    return github
+
+@pytest.fixture
+def stub():
+    """ Local HTTP server answering like github for ``/repos/owner/repo/git/refs/heads/master``
+    and honoring ``If-None-Match``
+    """
+    state = {'sha': 'a' * 40, 'requests': []}
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            state['requests'].append((self.path, self.headers.get('If-None-Match')))
+            etag = '"%s"' % state['sha']
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('X-RateLimit-Remaining', '4999')
+                self.end_headers()
+                return
+            body = json.dumps({
+                'ref': 'refs/heads/master',
+                'object': {'type': 'commit', 'sha': state['sha']},
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('X-RateLimit-Limit', '5000')
+            self.send_header('X-RateLimit-Remaining', '4998')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(('localhost', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state['url'] = 'http://localhost:%s' % server.server_address[1]
+    yield state
+    server.shutdown()
+    server.server_close()
+
+def test_conditional_requests(github, stub):
+    gh = github.GH('sometoken', 'owner/repo', url=stub['url'])
+    before = github.cache.report()
+
+    assert gh.head('master') == 'a' * 40
+    assert stub['requests'][-1] == ('/repos/owner/repo/git/refs/heads/master', None)
+
+    # unchanged resource: conditional request answered by a 304, cached response used
+    assert gh.head('master') == 'a' * 40
+    assert stub['requests'][-1] == ('/repos/owner/repo/git/refs/heads/master', '"%s"' % ('a' * 40))
+
+    # updated resource: new response is returned and cached
+    stub['sha'] = 'b' * 40
+    assert gh.head('master') == 'b' * 40
+    assert gh.head('master') == 'b' * 40
+
+    after = github.cache.report()
+    assert after['requests'] - before.get('requests', 0) == 4
+    assert after['conditional'] - before.get('conditional', 0) == 3
+    assert after['not_modified'] - before.get('not_modified', 0) == 2
+    assert after['rate_limits'][gh._token_key]['remaining'] == 4999
+
+    # sessions (and their connection pool) are shared between clients of a token
+    assert github.GH('sometoken', 'owner/other', url=stub['url'])._session is gh._session